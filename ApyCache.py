@@ -0,0 +1,252 @@
+import os
+import json
+import hashlib
+import numpy as np
+from ApyEngine import apys_at
+
+
+def fingerprint(timestamps_ns, liq_idx):
+    """Fingerprint of a liquidity index series, to tell whether cached values still apply"""
+    digest = hashlib.sha1(np.ascontiguousarray(timestamps_ns, dtype=np.int64).tobytes())
+    digest.update(np.ascontiguousarray(liq_idx, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+def _safe_name(name):
+    return str(name).replace(os.sep, "_")
+
+
+class ApyCache(object):
+    """
+    On-disk cache of the APY series derived from each token's liquidity indices, so that
+    restarts and repeated backtests do not convert the same liquidity indices again.
+
+    For every token the liquidity index history (int64 ns timestamps and liquidity indices)
+    is kept as raw binary columns, together with one APY column per lookback, where the APY
+    at bar i is measured against bar max(i - lookback, 0) of the history (NaN at bar 0).
+    Columns are read back as read-only memory maps, so only the parts used are loaded.
+
+    Entries are keyed by token, lookback and a fingerprint of the source data. When update
+    is called with a history that extends the cached one (the fingerprint of its first bars
+    matches), only the new bars are appended and converted. Any other change to the history
+    invalidates all of the token's entries, which are then rebuilt.
+
+    Windows whose APYs are measured against the start of the window (within lookback bars
+    of it) are not in the cache, and are computed as usual.
+
+    The strategies fill the cache through record, with the windows their ApyEngine sees:
+    the bars of a window that follow on from the token's cached history are held back and
+    appended every flush_every bars (and on flush), so a cold-start run leaves the history
+    it went through cached for the next one. Windows that do not follow on from it (e.g.
+    after a gap longer than the window) are not recorded, and update with the full history
+    fills it.
+    """
+
+    def __init__(self, directory, flush_every=16):
+        self.directory = directory
+        self.flush_every = flush_every
+        os.makedirs(directory, exist_ok=True)
+        self._maps = {} # path -> memory map of the column, reopened when the file grows
+        self._meta = {} # path -> metadata as last saved or loaded, so that it is read from disk once
+        self._ends = {} # token -> (timestamp, liquidity index) of the last bar cached or held back
+        self._pending = {} # token -> (timestamp arrays, liquidity index arrays, lookbacks) held back by record
+
+        # Counters
+        self.hits = 0
+        self.misses = 0
+        self.bars_converted = 0
+        self.invalidations = 0
+
+    def _token_dir(self, token):
+        return os.path.join(self.directory, _safe_name(token))
+
+    def _meta_path(self, path):
+        return os.path.join(path, "meta.json")
+
+    def _load_meta(self, path):
+        """A copy of the metadata, which the callers update before saving it"""
+        meta = self._meta.get(path)
+        if meta is None:
+            try:
+                with open(self._meta_path(path)) as f:
+                    meta = self._meta[path] = json.load(f)
+            except (OSError, ValueError):
+                return None
+        return dict(meta, lookbacks=list(meta["lookbacks"]))
+
+    def _save_meta(self, path, meta):
+        tmp = self._meta_path(path) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(meta, f)
+        os.replace(tmp, self._meta_path(path)) # Written last, so a half-written update is never used
+        self._meta[path] = dict(meta, lookbacks=list(meta["lookbacks"]))
+
+    def _column(self, path, dtype, length):
+        if length == 0:
+            return np.empty(0, dtype=dtype) # Empty files cannot be memory mapped
+        mapped = self._maps.get(path)
+        if mapped is None or len(mapped) < length:
+            mapped = self._maps[path] = np.memmap(path, dtype=dtype, mode="r")
+        return mapped[:length]
+
+    def _append(self, path, values, dtype, start):
+        """
+        Write values after the first start entries of the column, dropping anything beyond them
+        (left by an update interrupted before its metadata was saved)
+        """
+        self._maps.pop(path, None)
+        with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+            f.truncate(start*np.dtype(dtype).itemsize)
+            f.seek(0, os.SEEK_END)
+            f.write(np.ascontiguousarray(values, dtype=dtype).tobytes())
+
+    def _clear(self, path):
+        self._maps = {p: m for p, m in self._maps.items() if not p.startswith(path + os.sep)}
+        self._meta.pop(path, None)
+        if os.path.isdir(path):
+            for name in os.listdir(path):
+                os.remove(os.path.join(path, name))
+        os.makedirs(path, exist_ok=True)
+
+    def update(self, token, timestamps_ns, liq_idx):
+        """
+        Bring the token's cached history in line with the given one, appending new bars
+        (and their APYs, for every lookback cached) or rebuilding it if the history changed
+        """
+        path = self._token_dir(token)
+        timestamps_ns = np.asarray(timestamps_ns, dtype=np.int64)
+        liq_idx = np.asarray(liq_idx, dtype=np.float64)
+        n = len(liq_idx)
+        self._ends.pop(token, None) # The bars held back by record may not follow on from this history
+        self._pending.pop(token, None)
+
+        meta = self._load_meta(path)
+        if meta is not None and meta["n"] <= n and fingerprint(timestamps_ns[:meta["n"]], liq_idx[:meta["n"]]) == meta["fingerprint"]:
+            n_old = meta["n"]
+            if n_old == n:
+                return meta
+        else:
+            if meta is not None:
+                self.invalidations += 1
+            self._clear(path)
+            meta = {"n": 0, "fingerprint": None, "lookbacks": []}
+            n_old = 0
+
+        self._append(os.path.join(path, "timestamps.bin"), timestamps_ns[n_old:], np.int64, n_old)
+        self._append(os.path.join(path, "liq_idx.bin"), liq_idx[n_old:], np.float64, n_old)
+        for lookback in meta["lookbacks"]:
+            self._append(os.path.join(path, f"apys_{lookback}.bin"), self._convert(timestamps_ns, liq_idx, lookback, n_old), np.float64, n_old)
+        meta.update(n=n, fingerprint=fingerprint(timestamps_ns, liq_idx))
+        self._save_meta(path, meta)
+        return meta
+
+    def record(self, token, lookback, timestamps_ns, liq_idx):
+        """
+        Hold back the bars of a window of the token's liquidity indices that follow on from
+        its cached history, to be appended (with their APYs for the lookback) on the next flush
+        """
+        end = self._ends.get(token)
+        if end is None:
+            cached_ts, cached_liq = self.history(token)
+            end = self._ends[token] = (cached_ts[-1], cached_liq[-1]) if cached_ts is not None and len(cached_ts) else (None, None)
+        last_ns, last_liq = end
+        if last_ns is None:
+            start = 0
+        else:
+            if timestamps_ns[-1] <= last_ns:
+                return
+            pos = np.searchsorted(timestamps_ns, last_ns)
+            if timestamps_ns[pos] != last_ns or not np.array_equal(liq_idx[pos], last_liq, equal_nan=True):
+                return # A gap after the cached history, or a revised bar
+            start = pos + 1
+
+        timestamps, liq_idxs, lookbacks = self._pending.setdefault(token, ([], [], set()))
+        timestamps.append(np.array(timestamps_ns[start:], dtype=np.int64)) # Copied, as the window may be a view of a rates buffer
+        liq_idxs.append(np.array(liq_idx[start:], dtype=np.float64))
+        lookbacks.add(lookback)
+        self._ends[token] = (timestamps_ns[-1], liq_idx[-1])
+        if last_ns is None or sum(len(t) for t in timestamps) >= self.flush_every:
+            self._flush(token)
+
+    def _flush(self, token):
+        pending = self._pending.pop(token, None)
+        if pending is None:
+            return
+        timestamps, liq_idxs, lookbacks = pending
+        cached_ts, cached_liq = self.history(token)
+        if cached_ts is not None:
+            timestamps, liq_idxs = [cached_ts] + timestamps, [cached_liq] + liq_idxs
+        end = self._ends.get(token)
+        meta = self.update(token, np.concatenate(timestamps), np.concatenate(liq_idxs))
+        self._ends[token] = end
+        for lookback in lookbacks:
+            if lookback not in meta["lookbacks"]:
+                self.apys(token, lookback)
+
+    def flush(self):
+        """Append the bars held back by record to the cache"""
+        for token in list(self._pending):
+            self._flush(token)
+
+    def _convert(self, timestamps_ns, liq_idx, lookback, start):
+        """APYs of the bars from start on, NaN at bar 0 (which has no APY)"""
+        idx = np.arange(start, len(liq_idx))
+        apys = np.full(len(idx), np.nan)
+        valid = idx > 0
+        apys[valid] = apys_at(timestamps_ns, liq_idx, lookback, idx[valid])
+        self.bars_converted += int(valid.sum())
+        return apys
+
+    def apys(self, token, lookback, timestamps_ns=None, liq_idx=None):
+        """
+        Memory-mapped APY series of the token for the lookback, over the whole cached history
+        (after updating it with the given history, if any)
+        """
+        path = self._token_dir(token)
+        meta = self.update(token, timestamps_ns, liq_idx) if liq_idx is not None else self._load_meta(path)
+        if meta is None:
+            return None
+        n = meta["n"]
+        if lookback not in meta["lookbacks"]:
+            self.misses += 1
+            timestamps_ns, liq_idx = self.history(token, meta)
+            self._append(os.path.join(path, f"apys_{lookback}.bin"), self._convert(timestamps_ns, liq_idx, lookback, 0), np.float64, 0)
+            meta["lookbacks"].append(lookback)
+            self._save_meta(path, meta)
+        else:
+            self.hits += 1
+        return self._column(os.path.join(path, f"apys_{lookback}.bin"), np.float64, n)
+
+    def history(self, token, meta=None):
+        """Memory-mapped timestamps (int64 ns) and liquidity indices cached for the token"""
+        path = self._token_dir(token)
+        meta = self._load_meta(path) if meta is None else meta
+        if meta is None:
+            return None, None
+        return (self._column(os.path.join(path, "timestamps.bin"), np.int64, meta["n"]),
+            self._column(os.path.join(path, "liq_idx.bin"), np.float64, meta["n"]))
+
+    def window_apys(self, token, lookback, timestamps_ns, liq_idx):
+        """
+        APYs of a window of the token's liquidity indices (measured against the start of the
+        window, within lookback bars of it), read from the cache where the lookback is not
+        clipped, or None if the window is not part of the cached history
+        """
+        n = len(liq_idx)
+        path = self._token_dir(token)
+        meta = self._load_meta(path)
+        if meta is None or lookback not in meta["lookbacks"] or n <= lookback:
+            return None
+        cached_ts, cached_liq = self.history(token, meta)
+        pos = np.searchsorted(cached_ts, timestamps_ns[0])
+        if pos + n > meta["n"] or not np.array_equal(cached_ts[pos:pos+n], timestamps_ns) \
+                or not np.array_equal(cached_liq[pos:pos+n], liq_idx):
+            return None
+
+        self.hits += 1
+        apys = np.empty(n-1)
+        head = lookback - 1 # Number of APYs with a clipped lookback
+        if head > 0:
+            apys[:head] = apys_at(timestamps_ns, liq_idx, lookback, np.arange(1, head+1))
+        apys[head:] = self._column(os.path.join(path, f"apys_{lookback}.bin"), np.float64, meta["n"])[pos+head+1:pos+n]
+        return apys
@@ -0,0 +1,183 @@
+import numpy as np
+import pandas as pd
+
+SECONDS_IN_YEAR = 31536000
+NANOSECONDS_IN_SECOND = 1e9
+
+
+def timestamps_to_ns(timestamps):
+    """
+    Convert an array of timestamps (datetime, pd.Timestamp or datetime64) into
+    int64 nanoseconds since the epoch, so that time differences are plain integer
+    array operations
+    """
+    return pd.DatetimeIndex(timestamps).as_unit("ns").asi8
+
+
+def unpack_rates(rates):
+    """
+    Split the (token, timestamp, liquidity_index) tuples returned by
+    rates.get_latest_rates into timestamp and liquidity index arrays
+    """
+    timestamps = np.array([r[1] for r in rates])
+    liq_idx = np.array([r[2] for r in rates], dtype=float)
+    return timestamps, liq_idx
+
+
+def apys_between(timestamps_ns, liq_idx, idx, base_idx):
+    """
+    Annualised APYs of the liquidity index from positions base_idx to positions idx,
+    which can be arrays of any (matching) shape
+    """
+    variable_rate = liq_idx[idx]/liq_idx[base_idx] - 1.0
+    # Annualise the rate
+    compounding_periods = SECONDS_IN_YEAR / ((timestamps_ns[idx] - timestamps_ns[base_idx]) / NANOSECONDS_IN_SECOND)
+    return ((1 + variable_rate)**compounding_periods) - 1
+
+
+def apys_at(timestamps_ns, liq_idx, lookback, idx):
+    """
+    Annualised APYs at the positions idx of a liquidity index window. The rate at
+    position i is measured against position i-lookback, clipped to the start of
+    the window, which is the convention used by all of the strategies
+    """
+    return apys_between(timestamps_ns, liq_idx, idx, np.maximum(idx - lookback, 0))
+
+
+def sliding_window_apys(timestamps_ns, liq_idx, lookback, window, history_apys=None):
+    """
+    APYs of every full window of window liquidity indices along a whole history, as a
+    (windows, window-1) matrix where row t holds the APYs of the window ending at
+    position t+window-1. Each row is identical to the APYs of that window on its own.
+    If the APYs over the whole history (e.g. from an ApyCache) are given, only those with
+    a lookback clipped to the start of their window are computed.
+    """
+    starts = np.arange(len(liq_idx) - window + 1)[:, None]
+    idx = starts + np.arange(1, window)[None, :]
+    if history_apys is None:
+        return apys_between(timestamps_ns, liq_idx, idx, np.maximum(idx - lookback, starts))
+
+    apys = np.asarray(history_apys)[idx]
+    head = min(lookback, window) - 1 # Number of APYs with a clipped lookback
+    if head > 0:
+        apys[:, :head] = apys_between(timestamps_ns, liq_idx, idx[:, :head], np.maximum(idx[:, :head] - lookback, starts))
+    return apys
+
+
+def liquidity_index_to_apy(timestamps_ns, liq_idx, lookback):
+    """
+    Vectorised APYs for every position of the window but the first
+    """
+    return apys_at(timestamps_ns, liq_idx, lookback, np.arange(1, len(liq_idx)))
+
+
+class ApyEngine(object):
+    """
+    Shared APY engine for the strategies. APYs are computed as NumPy array operations
+    over the full window, and in streaming mode the previous window for each key
+    (usually the token) is cached so that when the window moves forward by a bar only
+    the newest APY, together with the few leading APYs whose lookback is clipped to the
+    start of the window, is recomputed. All other APYs are reused as is.
+
+    The APYs are computed by apys_at, or by the apys_at of the KernelSet given as kernels
+    (see Kernels.get_kernels).
+
+    Bars without a liquidity index (NaN, e.g. from a columnar rates store) are skipped, so
+    that each APY is measured against the lookback-th bar with a value before it, as for the
+    rate tuples, which leave them out. The APYs of a window with such bars are NaN at them.
+    """
+
+    def __init__(self, lookback, streaming=True, cache=None, kernels=None):
+        self.lookback = lookback
+        self.streaming = streaming
+        self.cache = cache # Optional ApyCache, read for windows that are not cached in memory and filled with the others
+        self.apys_at = apys_at if kernels is None else kernels.apys_at
+        # key -> (length, first, second and last timestamps, last liquidity index, apys) of the
+        # last window seen. Only the ends of the window are kept, not the arrays themselves,
+        # which may be views into a rates buffer that is overwritten as new bars arrive
+        self._cache = {}
+
+        # Counters to check how often the cache is actually used
+        self.full_updates = 0
+        self.incremental_updates = 0
+
+    def reset(self, key=None):
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    def window_apys(self, key, timestamps_ns, liq_idx):
+        n = len(liq_idx)
+        if n < 2:
+            return np.array([])
+        valid = ~np.isnan(liq_idx)
+        if not valid.all():
+            positions = np.flatnonzero(valid)
+            apys = np.full(n-1, np.nan)
+            apys[positions[1:]-1] = self.window_apys(key, timestamps_ns[positions], liq_idx[positions])
+            return apys
+
+        cached = self._cache.get(key) if self.streaming else None
+        apys = self._incremental_apys(cached, timestamps_ns, liq_idx) if cached is not None else None
+        if apys is None and self.cache is not None:
+            apys = self.cache.window_apys(key, self.lookback, timestamps_ns, liq_idx)
+            if apys is None:
+                self.cache.record(key, self.lookback, timestamps_ns, liq_idx)
+        elif self.cache is not None:
+            self.cache.record(key, self.lookback, timestamps_ns, liq_idx)
+        if apys is None:
+            apys = self.apys_at(timestamps_ns, liq_idx, self.lookback, np.arange(1, n))
+            self.full_updates += 1
+        else:
+            self.incremental_updates += 1
+
+        if self.streaming:
+            self._cache[key] = (n, timestamps_ns[0], timestamps_ns[1], timestamps_ns[-1], liq_idx[-1], apys)
+        return apys
+
+    def panel_apys(self, tokens, timestamps_ns, liq_panel):
+        """
+        APYs of an aligned (bars, tokens) liquidity index panel, keyed by token, as a
+        (bars-1, tokens) array
+        """
+        return np.column_stack([self.window_apys(token, timestamps_ns, liq_panel[:, j]) for j, token in enumerate(tokens)])
+
+    def rates_to_apys(self, key, rates):
+        """
+        Convenience wrapper around window_apys for the tuples returned by
+        rates.get_latest_rates. Returns the timestamps of the APYs together with the APYs
+        """
+        timestamps, liq_idx = unpack_rates(rates)
+        if len(liq_idx) < 2:
+            return timestamps[1:], np.array([])
+        return timestamps[1:], self.window_apys(key, timestamps_to_ns(timestamps), liq_idx)
+
+    def _incremental_apys(self, cached, timestamps_ns, liq_idx):
+        n_prev, prev_first, prev_second, prev_last, prev_liq_last, prev_apys = cached
+        n = len(liq_idx)
+
+        # Same window as before, e.g. the same token being used by several pairs
+        if n == n_prev and timestamps_ns[0] == prev_first and timestamps_ns[-1] == prev_last \
+                and liq_idx[-1] == prev_liq_last:
+            return prev_apys
+
+        # Growing window during the warm-up, the start of the window is unchanged and
+        # so are all of the previous APYs
+        if n == n_prev+1 and timestamps_ns[0] == prev_first and timestamps_ns[-2] == prev_last \
+                and liq_idx[-2] == prev_liq_last:
+            return np.append(prev_apys, self.apys_at(timestamps_ns, liq_idx, self.lookback, np.array([n-1])))
+
+        # Window rolled forward by one bar: the APYs that look back a full lookback are
+        # unchanged, the clipped ones at the start of the window are recomputed
+        if n == n_prev and n > 2 and timestamps_ns[0] == prev_second and timestamps_ns[-2] == prev_last \
+                and liq_idx[-2] == prev_liq_last:
+            apys = np.empty(n-1)
+            head = max(min(self.lookback, n) - 1, 0) # Number of APYs with a clipped lookback
+            if head > 0:
+                apys[:head] = self.apys_at(timestamps_ns, liq_idx, self.lookback, np.arange(1, head+1))
+            apys[head:-1] = prev_apys[head+1:]
+            apys[-1] = self.apys_at(timestamps_ns, liq_idx, self.lookback, np.array([n-1]))[0]
+            return apys
+
+        return None
@@ -0,0 +1,124 @@
+import time
+import numpy as np
+from types import SimpleNamespace
+from RollingStats import BatchedRollingWindowStats
+
+
+def strategy_observations(latest_rates):
+    """
+    Observation vectors and observed rates for each basket, built from the latest APYs
+    (one row per basket) in the same way as KalmanFilterStatArb: the hedge ratios apply to
+    all rates but the last, plus an intercept, and the rate indexed at 1 is the observation
+    """
+    latest_rates = np.atleast_2d(latest_rates)
+    F = np.concatenate([latest_rates[:, :-1], np.ones((len(latest_rates), 1))], axis=1)
+    y = latest_rates[:, 1]
+    return F, y
+
+
+class BatchedKalmanFilter(object):
+    """
+    Kalman filters for many pairs/baskets at once. The hidden states (theta), their
+    covariances (C, R) and the noise parameters of every basket are held in stacked NumPy
+    arrays, and all of the baskets are advanced with one vectorised update per bar. Each
+    basket gets its own forecast error, et z-score (over its own lookback window) and
+    hedge ratios. All of the baskets in one engine must have the same number of tokens.
+
+    The update is the same as KalmanFilterStatArb.kalman_update, so a single basket tracks
+    the strategy's filter exactly. delta and vt can be scalars or one value per basket.
+    """
+
+    def __init__(self, n_baskets, n_tokens, delta=1e-4, vt=1e-3, lookback_window=10):
+        self.n_baskets = n_baskets
+        self.n_tokens = n_tokens
+        self.delta = np.broadcast_to(np.asarray(delta, dtype=float), (n_baskets,)).copy()
+        self.vt = np.broadcast_to(np.asarray(vt, dtype=float), (n_baskets,)).copy()
+        self.wt = (self.delta/(1-self.delta))[:, None, None] * np.eye(n_tokens) # Starting system errors
+
+        self.theta = np.zeros((n_baskets, n_tokens)) # Starting hidden states
+        self.C = np.zeros((n_baskets, n_tokens, n_tokens))
+        self.R = None
+        self.Qt = None # Variances of the latest predictions, for the likelihood of the forecast errors
+        self.days = 0
+
+        self.et_stats = BatchedRollingWindowStats(n_baskets, lookback_window)
+
+    def update(self, F, y):
+        """
+        Advance every basket by one bar, with F the (baskets, tokens) observation vectors
+        and y the observed rates. Returns the forecast errors, their z-scores and the
+        normalised hedge ratios of every basket.
+        """
+        F = np.asarray(F, dtype=float)
+        y = np.asarray(y, dtype=float)
+
+        # Prior covariance of the hidden states
+        if self.R is not None:
+            self.R = self.C + self.wt
+        else:
+            self.R = np.zeros((self.n_baskets, self.n_tokens, self.n_tokens))
+
+        # 1) Prediction of the new observations and their forecast errors
+        et = y - np.einsum("bi,bi->b", F, self.theta)
+
+        # 2) Variance of the predictions
+        FR = np.einsum("bi,bij->bj", F, self.R)
+        Qt = np.einsum("bj,bj->b", FR, F) + self.vt
+        self.Qt = Qt
+
+        # 3) Kalman gains, state and covariance updates (the covariance update matches the
+        # single filter, where the gain multiplies F.R elementwise)
+        At = np.einsum("bij,bj->bi", self.R, F)/Qt[:, None]
+        self.theta = self.theta + At*et[:, None]
+        self.C = self.R - (At*FR)[:, None, :]
+        self.days += 1
+
+        # 4) Moving average and std of the forecast errors per basket
+        self.et_stats.push(et)
+        et_z = (et - self.et_stats.mean)/self.et_stats.std
+        hedge_ratios = self.theta/self.theta[:, -1:]
+        return et, et_z, hedge_ratios
+
+
+def benchmark(n_baskets=200, n_tokens=2, n_bars=500, lookback_window=10, seed=0):
+    """
+    Time the batched engine against running the current single-filter path
+    (KalmanFilterStatArb.kalman_update) once per basket, on random APY paths.
+    Returns the timings and the largest difference in the forecast errors.
+    """
+    from KalmanFilterStatArb import KalmanFilterStatArb
+
+    rng = np.random.default_rng(seed)
+    apys = 0.05 + np.cumsum(rng.normal(0, 1e-3, (n_bars, n_baskets, n_tokens)), axis=0)
+
+    single_filters = [KalmanFilterStatArb(events=None, rates=SimpleNamespace(token_list=list(range(n_tokens))),
+        lookback_window=lookback_window) for _ in range(n_baskets)]
+    single_et = np.empty((n_bars, n_baskets))
+    start = time.perf_counter()
+    for t in range(n_bars):
+        for b, kf in enumerate(single_filters):
+            F = np.append(apys[t, b, :-1], 1.0)
+            single_et[t, b] = kf.kalman_update(F, apys[t, b, 1])
+            kf.et_stats.push(single_et[t, b])
+    single_time = time.perf_counter() - start
+
+    batched = BatchedKalmanFilter(n_baskets, n_tokens, lookback_window=lookback_window)
+    batched_et = np.empty((n_bars, n_baskets))
+    start = time.perf_counter()
+    for t in range(n_bars):
+        F, y = strategy_observations(apys[t])
+        batched_et[t] = batched.update(F, y)[0]
+    batched_time = time.perf_counter() - start
+
+    return {
+        "n_baskets": n_baskets, "n_tokens": n_tokens, "n_bars": n_bars,
+        "single_seconds": single_time, "batched_seconds": batched_time,
+        "single_us_per_bar": 1e6*single_time/n_bars, "batched_us_per_bar": 1e6*batched_time/n_bars,
+        "speedup": single_time/batched_time,
+        "max_abs_et_diff": float(np.max(np.abs(single_et - batched_et))),
+    }
+
+
+if __name__ == "__main__":
+    for n_baskets in [10, 100, 1000]:
+        print(benchmark(n_baskets=n_baskets))
@@ -0,0 +1,267 @@
+import io
+import sys
+import json
+import time
+import queue
+import platform
+import argparse
+import traceback
+import contextlib
+import numpy as np
+import pandas as pd
+from itertools import combinations
+
+
+class SyntheticRates(object):
+    """
+    Synthetic rates provider with the get_latest_rates/token_list interface of the rates
+    handler, replaying generated liquidity indices one bar at a time (advance).
+
+    The variable rate of every token is either a common random-walk rate plus a
+    stationary AR(1) deviation per token (cointegrated=True), or an independent random
+    walk per token, and the liquidity indices compound these rates from bar to bar.
+    """
+
+    def __init__(self, token_list, n_bars=500, cointegrated=True, seed=0, start="2022-01-01", freq="D",
+            base_rate=0.03, rate_vol=0.002, spread_vol=0.002, ar=0.8):
+        rng = np.random.default_rng(seed)
+        self.token_list = list(token_list)
+        index = pd.date_range(start, periods=n_bars, freq=freq)
+        self.timestamps = list(index)
+        n_tokens = len(self.token_list)
+
+        if cointegrated:
+            common = np.cumsum(rng.normal(0, rate_vol, n_bars))
+            spreads = np.zeros((n_bars, n_tokens))
+            shocks = rng.normal(0, spread_vol, (n_bars, n_tokens))
+            for t in range(1, n_bars):
+                spreads[t] = ar*spreads[t-1] + shocks[t]
+            rates = base_rate + common[:, None] + spreads + 0.005*np.arange(n_tokens)
+        else:
+            rates = base_rate + np.cumsum(rng.normal(0, rate_vol, (n_bars, n_tokens)), axis=0)
+
+        years = np.diff(index.asi8, prepend=index.asi8[0])/1e9/(365*24*3600) # Year fraction since the previous bar
+        growth = 1 + np.abs(rates)*years[:, None]
+        self.liq_idx = {token: np.cumprod(growth[:, j]) for j, token in enumerate(self.token_list)}
+        self.cursor = 0
+
+    def advance(self, bars=1):
+        self.cursor = min(self.cursor + bars, len(self.timestamps))
+
+    def get_latest_rates(self, token, N=1):
+        lo = max(0, self.cursor - N)
+        liq_idx = self.liq_idx[token]
+        return [(token, self.timestamps[i], liq_idx[i]) for i in range(lo, self.cursor)]
+
+    def panel(self):
+        """Liquidity index panel of the whole history, one column per token"""
+        return pd.DataFrame(self.liq_idx, index=pd.DatetimeIndex(self.timestamps))
+
+
+def time_strategy(strategy, rates, events, n_bars, warmup):
+    """
+    Time calculate_signals for n_bars bars after warmup bars of history, returning the
+    latencies in seconds of the bars that completed, the number of events emitted and the
+    failed bars (bar, exception type, message and traceback), which are left out of the
+    latencies so that a failing strategy does not look fast
+    """
+    from event import MarketEvent
+
+    rates.advance(warmup)
+    latencies = []
+    n_events = 0
+    failures = []
+    with contextlib.redirect_stdout(io.StringIO()): # The pairs strategy prints on every cointegrated bar
+        for t in range(n_bars):
+            rates.advance()
+            start = time.perf_counter()
+            try:
+                strategy.calculate_signals(MarketEvent())
+            except Exception as e:
+                failures.append({"bar": t, "type": type(e).__name__, "message": str(e), "traceback": traceback.format_exc()})
+            else:
+                latencies.append(time.perf_counter() - start)
+            while not events.empty():
+                events.get()
+                n_events += 1
+    return np.array(latencies), n_events, failures
+
+
+def _latency_stats(latencies):
+    if len(latencies) == 0:
+        return {"mean_us": np.nan, "p50_us": np.nan, "p95_us": np.nan, "max_us": np.nan, "total_s": 0.0}
+    us = 1e6*latencies
+    return {
+        "mean_us": float(us.mean()), "p50_us": float(np.percentile(us, 50)), "p95_us": float(np.percentile(us, 95)),
+        "max_us": float(us.max()), "total_s": float(latencies.sum()),
+    }
+
+
+def benchmark_cases(token_counts=(2, 4), pair_counts=(1, 4), lookbacks=(10, 30), cointegrated=(True, False), kernels=None):
+    """
+    Benchmark cases (strategy and parameters) over the token counts, pair counts and lookbacks,
+    and, if given, over the kernel backends (see Kernels.get_kernels)
+    """
+    cases = []
+    for coint in cointegrated:
+        for lookback in lookbacks:
+            for n_pairs in pair_counts:
+                cases.append(dict(strategy="pairs", monthly=False, n_pairs=n_pairs, lookback=lookback, cointegrated=coint))
+            for n_tokens in token_counts:
+                cases.append(dict(strategy="multi", n_tokens=n_tokens, lookback=lookback, cointegrated=coint))
+            cases.append(dict(strategy="kalman", n_tokens=2, lookback=lookback, cointegrated=coint))
+        for n_pairs in pair_counts:
+            cases.append(dict(strategy="pairs", monthly=True, n_pairs=n_pairs, lookback=90, cointegrated=coint))
+    if kernels is not None:
+        cases = [dict(case, kernels=backend) for backend in kernels for case in cases]
+    return cases
+
+
+def run_case(case, n_bars=200, seed=0):
+    """Build the strategy of a benchmark case on synthetic rates and time it"""
+    from StatisticalArbitragePairs import StatisticalArbitragePairs
+    from StatArbMultiTrade import StatArbMultiTrade
+    from KalmanFilterStatArb import KalmanFilterStatArb
+
+    events = queue.Queue()
+    lookback = case["lookback"]
+    kernels = case.get("kernels", "numpy")
+    warmup = lookback + 2
+    if case["strategy"] == "pairs":
+        # Enough tokens for the pairs, taken in order from all combinations
+        n_tokens = 2
+        while n_tokens*(n_tokens-1)//2 < case["n_pairs"]:
+            n_tokens += 1
+        tokens = [f"T{i}" for i in range(n_tokens)]
+        rates = SyntheticRates(tokens, n_bars=warmup+n_bars+1, cointegrated=case["cointegrated"], seed=seed)
+        pairs = list(combinations(tokens, 2))[:case["n_pairs"]]
+        strategy = StatisticalArbitragePairs(rates, events, pairs, lookback_window=lookback,
+            strategy_start=rates.timestamps[warmup], monthly=case["monthly"], kernels=kernels)
+    else:
+        tokens = [f"T{i}" for i in range(case["n_tokens"])]
+        rates = SyntheticRates(tokens, n_bars=warmup+n_bars+1, cointegrated=case["cointegrated"], seed=seed)
+        if case["strategy"] == "multi":
+            strategy = StatArbMultiTrade(events, rates, lookback_window=lookback, kernels=kernels)
+        else:
+            strategy = KalmanFilterStatArb(events, rates, lookback_window=lookback, kernels=kernels)
+
+    latencies, n_events, failures = time_strategy(strategy, rates, events, n_bars, warmup)
+    # Every failed bar by exception type, with the traceback of the first one
+    error_types = {}
+    for failure in failures:
+        error_types[failure["type"]] = error_types.get(failure["type"], 0) + 1
+    return dict(case, n_bars=n_bars, n_timed=len(latencies), n_events=n_events, errors=len(failures), error_types=error_types,
+        first_error=failures[0]["traceback"] if failures else None, **_latency_stats(latencies))
+
+
+def time_kernels(backend="numpy", n_tokens=(2, 4), lookbacks=(10, 30), repeats=2000, seed=0):
+    """
+    Per-call latencies of the kernels of a backend on their own, for the window sizes of a bar:
+    the APYs of a lookback window, one Kalman step and the spread of n_tokens rates. The first
+    call (which compiles the numba kernels) is not timed.
+    """
+    from Kernels import get_kernels
+
+    kernels = get_kernels(backend)
+    rng = np.random.default_rng(seed)
+    rows = []
+    for lookback in lookbacks:
+        timestamps_ns = np.arange(lookback+1, dtype=np.int64)*86400*10**9
+        liq_idx = np.cumprod(1 + rng.uniform(0, 2e-4, lookback+1))
+        idx = np.arange(1, lookback+1)
+        rows.append(_time_kernel(kernels.apys_at, (timestamps_ns, liq_idx, lookback, idx), repeats,
+            kernel="apys_at", backend=kernels.name, lookback=lookback))
+    for n in n_tokens:
+        theta, C, wt = rng.normal(size=n), np.abs(rng.normal(size=(n, n))), 1e-4*np.eye(n)
+        F, rates, evecs = rng.normal(size=n), rng.normal(size=n), rng.normal(size=n)
+        rows.append(_time_kernel(kernels.kalman_step, (theta, C, wt, 1e-3, F, 0.03, False), repeats,
+            kernel="kalman_step", backend=kernels.name, n_tokens=n))
+        rows.append(_time_kernel(kernels.spread, (rates, evecs), repeats, kernel="spread", backend=kernels.name, n_tokens=n))
+    return rows
+
+
+def _time_kernel(function, args, repeats, **case):
+    function(*args)
+    latencies = np.empty(repeats)
+    for i in range(repeats):
+        start = time.perf_counter()
+        function(*args)
+        latencies[i] = time.perf_counter() - start
+    return dict(case, repeats=repeats, **_latency_stats(latencies))
+
+
+def run_benchmarks(cases=None, n_bars=200, seed=0, output=None, progress=print):
+    """
+    Run the benchmark cases, returning the results together with the environment, and
+    writing them as JSON to output if given
+    """
+    cases = benchmark_cases() if cases is None else cases
+    results = []
+    for case in cases:
+        result = run_case(case, n_bars=n_bars, seed=seed)
+        results.append(result)
+        if progress is not None:
+            failed = f", {result['errors']} failed bars {result['error_types']}" if result["errors"] else ""
+            progress(f"{_case_name(result)}: mean {result['mean_us']:.0f}us, p95 {result['p95_us']:.0f}us per bar{failed}")
+
+    report = {
+        "created": pd.Timestamp.now(tz="UTC").isoformat(),
+        "environment": {"python": sys.version.split()[0], "numpy": np.__version__, "pandas": pd.__version__,
+            "platform": platform.platform()},
+        "results": results,
+    }
+    if output is not None:
+        with open(output, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def _case_name(case):
+    keys = ["strategy", "monthly", "n_tokens", "n_pairs", "lookback", "cointegrated", "kernels"]
+    return ",".join(f"{k}={case[k]}" for k in keys if k in case)
+
+
+def compare_results(baseline, current, stat="p50_us", tolerance=0.1):
+    """
+    Compare two benchmark reports (or paths to them) case by case, returning a DataFrame
+    with the baseline and current latencies, their ratio and whether the case regressed
+    by more than tolerance (relative) or has more failed bars than the baseline
+    """
+    reports = []
+    for report in (baseline, current):
+        if isinstance(report, str):
+            with open(report) as f:
+                report = json.load(f)
+        reports.append({_case_name(r): r for r in report["results"]})
+
+    rows = []
+    for name in reports[1]:
+        if name in reports[0]:
+            before, after = reports[0][name][stat], reports[1][name][stat]
+            new_errors = reports[1][name].get("errors", 0) - reports[0][name].get("errors", 0)
+            rows.append({"case": name, "baseline": before, "current": after, "ratio": after/before, "new_errors": new_errors,
+                "regressed": after > before*(1 + tolerance) or new_errors > 0})
+    return pd.DataFrame(rows, columns=["case", "baseline", "current", "ratio", "new_errors", "regressed"])
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time calculate_signals of the strategies on synthetic rates")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--bars", type=int, default=200)
+    parser.add_argument("--tokens", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--pairs", type=int, nargs="+", default=[1, 4])
+    parser.add_argument("--lookbacks", type=int, nargs="+", default=[10, 30])
+    parser.add_argument("--kernels", nargs="+", help="Kernel backends to compare (numpy, numba), timing the kernels on their own too")
+    parser.add_argument("--compare", help="Earlier results to compare against")
+    args = parser.parse_args()
+
+    report = run_benchmarks(benchmark_cases(args.tokens, args.pairs, args.lookbacks, kernels=args.kernels), n_bars=args.bars,
+        output=args.output)
+    if args.kernels:
+        kernel_results = [row for backend in args.kernels for row in time_kernels(backend, args.tokens, args.lookbacks)]
+        print(pd.DataFrame(kernel_results).to_string(index=False))
+        report["kernels"] = kernel_results
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        print(compare_results(args.compare, args.output).to_string(index=False))
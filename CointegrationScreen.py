@@ -0,0 +1,117 @@
+import time
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from statsmodels.tsa.stattools import adfuller
+from statsmodels.tsa.adfvalues import mackinnonp
+
+SQRTEPS = np.sqrt(np.finfo(np.double).eps)
+
+
+def pairwise_regressions(values, pair_indices):
+    """
+    Engle-Granger cointegrating regressions y_i ~ c + y_j for all of the (i, j) column
+    pairs at once. The centred Gram matrix of the panel gives every hedge ratio and
+    R-squared, and the residuals are formed as one matrix expression.
+    Returns the residuals (one column per pair) and the R-squared of each regression.
+    """
+    centred = values - values.mean(axis=0)
+    gram = centred.T.dot(centred)
+    i, j = pair_indices[:, 0], pair_indices[:, 1]
+    beta = gram[i, j]/gram[j, j]
+    rsquared = gram[i, j]**2/(gram[i, i]*gram[j, j])
+    resids = centred[:, i] - beta*centred[:, j]
+    return resids, rsquared
+
+
+def adf_pvalues(resids, rsquared):
+    """
+    Engle-Granger p-values from the cointegrating regression residuals, with the same
+    ADF settings (AIC lag search, no constant) and MacKinnon p-values as statsmodels coint
+    """
+    pvalues = np.empty(resids.shape[1])
+    for k in range(resids.shape[1]):
+        if rsquared[k] < 1 - 100*SQRTEPS:
+            adf_stat = adfuller(resids[:, k], maxlag=None, autolag="aic", regression="n")[0]
+        else:
+            adf_stat = -np.inf # (Almost) perfectly colinear, as in coint
+        pvalues[k] = mackinnonp(adf_stat, regression="c", N=2)
+    return pvalues
+
+
+def _adf_chunk(start, resids, rsquared):
+    return start, adf_pvalues(resids, rsquared)
+
+
+def print_progress(done, total, elapsed):
+    print(f"Cointegration screen: {done}/{total} pairs tested, {elapsed:.1f}s elapsed")
+
+
+class CointegrationScreen(object):
+    """
+    Batched all-pairs cointegration screen, returning the same p-value matrix and
+    pairs list as StatisticalArbitragePairs.find_cointegrated_pairs.
+
+    All pairwise regressions are computed as matrix operations, and the ADF tests on the
+    residuals are split into chunks which are run across a process pool (processes=1 runs
+    them in this process). Progress is passed to the progress callback, if given (e.g.
+    print_progress), after each chunk as (pairs tested, total pairs, seconds elapsed), and
+    the wall time of the last run is kept in wall_time.
+    """
+
+    def __init__(self, significance=0.05, processes=None, chunk_size=256, progress=None):
+        self.significance = significance
+        self.processes = processes
+        self.chunk_size = chunk_size
+        self.progress = progress
+
+        self.wall_time = None
+        self.tests_run = 0
+
+    @staticmethod
+    def all_pairs(n):
+        i, j = np.triu_indices(n, k=1)
+        return np.column_stack([i, j])
+
+    def run(self, df, pair_indices=None):
+        """
+        Screen the columns of df, either all pairwise combinations or only the (i, j)
+        column index pairs given in pair_indices (with i < j)
+        """
+        start_time = time.perf_counter()
+        n = df.shape[1]
+        keys = df.columns.tolist()
+        pair_indices = self.all_pairs(n) if pair_indices is None else np.asarray(pair_indices, dtype=int).reshape(-1, 2)
+        total = len(pair_indices)
+
+        resids, rsquared = pairwise_regressions(df.values.astype(float), pair_indices)
+        pvalues = np.ones(total)
+        chunks = [(s, resids[:, s:s+self.chunk_size], rsquared[s:s+self.chunk_size]) for s in range(0, total, self.chunk_size)]
+
+        done = 0
+        if self.processes == 1 or len(chunks) <= 1:
+            for chunk in chunks:
+                s, p = _adf_chunk(*chunk)
+                pvalues[s:s+len(p)] = p
+                done += len(p)
+                self._report(done, total, start_time)
+        else:
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                futures = [pool.submit(_adf_chunk, *chunk) for chunk in chunks]
+                for future in as_completed(futures):
+                    s, p = future.result()
+                    pvalues[s:s+len(p)] = p
+                    done += len(p)
+                    self._report(done, total, start_time)
+
+        p_value_matrix = np.ones((n, n))
+        p_value_matrix[pair_indices[:, 0], pair_indices[:, 1]] = pvalues
+        # Keep the same ordering of the pairs as the serial double loop
+        pairs = [(keys[i], keys[j]) for (i, j), p in zip(pair_indices, pvalues) if p < self.significance]
+
+        self.tests_run = total
+        self.wall_time = time.perf_counter() - start_time
+        return p_value_matrix, pairs
+
+    def _report(self, done, total, start_time):
+        if self.progress is not None:
+            self.progress(done, total, time.perf_counter() - start_time)
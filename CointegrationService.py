@@ -0,0 +1,163 @@
+import numpy as np
+from statsmodels.tsa.stattools import coint
+from statsmodels.tsa.adfvalues import mackinnonp
+
+SQRTEPS = np.sqrt(np.finfo(np.double).eps)
+
+
+def fast_engle_granger(resid, rsquared, adf_lags=1):
+    """
+    Engle-Granger test statistic and p-value from the residuals of the cointegrating
+    regression, using an ADF regression (no constant, as in statsmodels coint) with a
+    fixed number of lags instead of the AIC lag search, solved directly with NumPy
+    """
+    if rsquared >= 1 - 100*SQRTEPS:
+        # (Almost) perfectly colinear series, same edge case as statsmodels coint
+        return -np.inf, mackinnonp(-np.inf, regression="c", N=2)
+
+    if len(resid) - adf_lags - 1 <= adf_lags + 1:
+        return np.nan, 1.0 # Not enough observations to test, treat as not cointegrated
+
+    d_resid = np.diff(resid)
+    # Regressors: lagged level, then the lagged differences
+    columns = [resid[adf_lags:-1]]
+    for lag in range(1, adf_lags+1):
+        columns.append(d_resid[adf_lags-lag:len(d_resid)-lag])
+    X = np.column_stack(columns)
+    y = d_resid[adf_lags:]
+
+    XtX_inv = np.linalg.inv(X.T.dot(X))
+    params = XtX_inv.dot(X.T.dot(y))
+    eps = y - X.dot(params)
+    sigma2 = eps.dot(eps)/(len(y) - X.shape[1])
+    adf_stat = params[0]/np.sqrt(sigma2*XtX_inv[0, 0])
+    return adf_stat, mackinnonp(adf_stat, regression="c", N=2)
+
+
+class _PairState(object):
+    """Cached OLS sufficient statistics and the last test result for one pair"""
+
+    def __init__(self):
+        self.index = None
+        self.y0 = None
+        self.y1 = None
+        self.sums = None # [n, sum(x), sum(y), sum(x*x), sum(x*y), sum(y*y)], x = y1 and y = y0
+        self.pvalue = None
+        self.tested_beta = None
+        self.bars_since_test = 0
+        self.updates_since_resync = 0
+
+
+class CointegrationService(object):
+    """
+    Cointegration checks for the pairs strategy that avoid rerunning a full statsmodels
+    coint() on every pair at every bar.
+
+    For each pair the OLS sufficient statistics of the cointegrating regression y0 ~ c + y1
+    are cached, and updated when one bar enters the lookback window and one leaves (together
+    with any values in the window that were revised, e.g. APYs whose lookback is clipped to
+    the start of the window). From these the hedge ratio is available at every bar, and
+    the p-value is only recomputed every retest_every bars, or earlier when the hedge ratio
+    has drifted by more than drift_threshold (relative) since the last test. In between the
+    cached p-value is returned.
+
+    With fast_adf the re-test uses a fixed-lag ADF on the residuals computed from the
+    sufficient statistics rather than statsmodels coint (with its AIC lag search).
+    The defaults (re-test every bar, full coint) reproduce plain coint() exactly.
+    """
+
+    def __init__(self, retest_every=1, drift_threshold=None, fast_adf=False, adf_lags=1):
+        self.retest_every = retest_every
+        self.drift_threshold = drift_threshold
+        self.fast_adf = fast_adf
+        self.adf_lags = adf_lags
+        self._states = {}
+
+        # Counters
+        self.tests_run = 0
+        self.cache_hits = 0
+
+    def reset(self, key=None):
+        if key is None:
+            self._states.clear()
+        else:
+            self._states.pop(key, None)
+
+    @staticmethod
+    def _sums(y0, y1):
+        return np.array([len(y0), y1.sum(), y0.sum(), y1.dot(y1), y1.dot(y0), y0.dot(y0)])
+
+    def _update_sums(self, state, y0, y1, index):
+        n = len(index)
+        state.updates_since_resync += 1
+        if state.updates_since_resync >= n:
+            # Recompute once per window length to stop rounding errors from accumulating
+            state.updates_since_resync = 0
+        elif state.sums is not None:
+            n_prev = len(state.index)
+            if n == n_prev and n > 1 and index[0] == state.index[1] and index[-2] == state.index[-1]:
+                # One bar in, one bar out, plus corrections for any revised values
+                removed = self._sums(state.y0[:1], state.y1[:1])
+                added = self._sums(y0[-1:], y1[-1:])
+                prev_y0, prev_y1 = state.y0[1:], state.y1[1:]
+                revised = (prev_y0 != y0[:-1]) | (prev_y1 != y1[:-1])
+                correction = self._sums(y0[:-1][revised], y1[:-1][revised]) - self._sums(prev_y0[revised], prev_y1[revised])
+                correction[0] = 0
+                return state.sums - removed + added + correction
+            if n == n_prev+1 and index[0] == state.index[0] and index[-2] == state.index[-1]:
+                # Growing window during the warm-up
+                revised = (state.y0 != y0[:-1]) | (state.y1 != y1[:-1])
+                correction = self._sums(y0[:-1][revised], y1[:-1][revised]) - self._sums(state.y0[revised], state.y1[revised])
+                correction[0] = 0
+                return state.sums + self._sums(y0[-1:], y1[-1:]) + correction
+            if n == n_prev and index[0] == state.index[0] and index[-1] == state.index[-1]:
+                revised = (state.y0 != y0) | (state.y1 != y1)
+                if not revised.any():
+                    return state.sums
+        return self._sums(y0, y1)
+
+    @staticmethod
+    def hedge_regression(sums):
+        """Intercept, hedge ratio and R-squared of y0 ~ c + y1 from the sufficient statistics"""
+        n, sx, sy, sxx, sxy, syy = sums
+        sxx_c = sxx - sx*sx/n
+        sxy_c = sxy - sx*sy/n
+        syy_c = syy - sy*sy/n
+        beta = sxy_c/sxx_c
+        alpha = (sy - beta*sx)/n
+        rsquared = sxy_c*sxy_c/(sxx_c*syy_c)
+        return alpha, beta, rsquared
+
+    def pvalue(self, key, y0, y1, index):
+        """
+        Cointegration p-value of y0 against y1 over the current lookback window, where index
+        holds the timestamps of the window and key identifies the pair
+        """
+        y0 = np.asarray(y0, dtype=float)
+        y1 = np.asarray(y1, dtype=float)
+        index = np.asarray(index)
+
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _PairState()
+        state.sums = self._update_sums(state, y0, y1, index)
+        state.index, state.y0, state.y1 = index, y0, y1
+        state.bars_since_test += 1
+
+        alpha, beta, rsquared = self.hedge_regression(state.sums)
+        retest = state.pvalue is None or state.bars_since_test >= self.retest_every
+        if not retest and self.drift_threshold is not None:
+            retest = abs(beta - state.tested_beta) > self.drift_threshold*abs(state.tested_beta)
+
+        if retest:
+            if self.fast_adf:
+                resid = y0 - alpha - beta*y1
+                state.pvalue = fast_engle_granger(resid, rsquared, adf_lags=self.adf_lags)[1]
+            else:
+                state.pvalue = coint(y0, y1)[1]
+            state.tested_beta = beta
+            state.bars_since_test = 0
+            self.tests_run += 1
+        else:
+            self.cache_hits += 1
+        return state.pvalue
@@ -0,0 +1,125 @@
+import numpy as np
+import pandas as pd
+
+
+class ColumnarRatesStore(object):
+    """
+    Bounded, columnar store of the liquidity indices of all tokens, for strategies that
+    would otherwise unpack lists of (token, timestamp, liquidity_index) tuples into new
+    arrays for every token on every bar.
+
+    Bars share one clock: each bar has an int64 nanosecond timestamp and one liquidity
+    index per token (NaN for a token without a value at that bar), held in preallocated
+    arrays. The arrays are mirrored ring buffers of twice the capacity, with every bar
+    written at positions i and i+capacity, so that the latest N bars (N <= capacity) are
+    always one contiguous slice. Windows of one token, or the aligned panel of several,
+    are therefore returned as zero-copy views, and memory use is fixed however long the run.
+
+    The views are only valid until the next bar is added, and must not be written to.
+    get_latest_rates gives the usual list of tuples, for code that has not moved over.
+
+    The windows keep the bars a token has no value at (NaN), where get_latest_rates leaves
+    them out. ApyEngine skips them, so that the strategies get the same APYs either way, and
+    latest, like the last of the tuples, is the latest bar with a value.
+    """
+
+    def __init__(self, token_list, capacity=4096):
+        self.token_list = list(token_list)
+        self.capacity = capacity
+        self._columns = {token: j for j, token in enumerate(self.token_list)}
+        self._timestamps = np.zeros(2*capacity, dtype=np.int64)
+        self._liq_idx = np.full((2*capacity, len(self.token_list)), np.nan)
+        self._head = 0 # Position of the next bar in [0, capacity)
+        self.count = 0 # Number of bars held, at most the capacity
+        self.tz = None # Timezone of the incoming timestamps, restored on the way out
+
+    def __len__(self):
+        return self.count
+
+    def _to_ns(self, timestamp):
+        timestamp = pd.Timestamp(timestamp)
+        if timestamp.tzinfo is not None:
+            self.tz = timestamp.tzinfo
+        return timestamp.value
+
+    def to_timestamp(self, timestamp_ns):
+        if self.tz is None:
+            return pd.Timestamp(timestamp_ns)
+        return pd.Timestamp(timestamp_ns, tz="UTC").tz_convert(self.tz)
+
+    def to_datetime_index(self, timestamps_ns):
+        index = pd.DatetimeIndex(np.asarray(timestamps_ns, dtype="datetime64[ns]"))
+        if self.tz is None:
+            return index
+        return index.tz_localize("UTC").tz_convert(self.tz)
+
+    def update_bar(self, timestamp, liq_indices):
+        """
+        Add a bar, with the liquidity indices given either in token_list order or as a
+        dict of token -> liquidity index (tokens left out are NaN)
+        """
+        if isinstance(liq_indices, dict):
+            row = np.full(len(self.token_list), np.nan)
+            for token, value in liq_indices.items():
+                row[self._columns[token]] = value
+        else:
+            row = np.asarray(liq_indices, dtype=float)
+        timestamp_ns = self._to_ns(timestamp)
+
+        i = self._head
+        self._timestamps[i] = self._timestamps[i+self.capacity] = timestamp_ns
+        self._liq_idx[i] = self._liq_idx[i+self.capacity] = row
+        self._head = (i + 1) % self.capacity
+        self.count = min(self.count + 1, self.capacity)
+
+    def update(self, token, timestamp, liq_idx):
+        """
+        Add a single token's liquidity index, either to the latest bar if it has the
+        same timestamp or as a new bar
+        """
+        timestamp_ns = self._to_ns(timestamp)
+        if self.count > 0 and self._timestamps[self._head - 1 + self.capacity] == timestamp_ns:
+            i = (self._head - 1) % self.capacity
+            j = self._columns[token]
+            self._liq_idx[i, j] = self._liq_idx[i+self.capacity, j] = liq_idx
+        else:
+            self.update_bar(timestamp, {token: liq_idx})
+
+    def _window(self, N):
+        N = min(N, self.count)
+        end = self._head + self.capacity
+        return slice(end - N, end)
+
+    def get_latest_window(self, token, N=1):
+        """Zero-copy views of the timestamps (int64 ns) and liquidity indices of the latest N bars"""
+        window = self._window(N)
+        return self._timestamps[window], self._liq_idx[window, self._columns[token]]
+
+    def get_latest_panel(self, tokens=None, N=1):
+        """
+        Zero-copy view of the latest N bars for all tokens (or a view of the given tokens, when
+        they are consecutive in token_list, and a copy otherwise), with one column per token
+        """
+        window = self._window(N)
+        if tokens is None or list(tokens) == self.token_list:
+            return self._timestamps[window], self._liq_idx[window]
+        columns = [self._columns[token] for token in tokens]
+        if columns == list(range(columns[0], columns[0] + len(columns))):
+            return self._timestamps[window], self._liq_idx[window, columns[0]:columns[-1]+1]
+        return self._timestamps[window], self._liq_idx[window][:, columns]
+
+    def latest(self, token):
+        """Latest (token, timestamp, liquidity_index), of the latest bar with a value for the token if any"""
+        j = self._columns[token]
+        end = self._head + self.capacity
+        i = end - 1
+        for k in range(end - 1, end - 1 - self.count, -1):
+            if not np.isnan(self._liq_idx[k, j]):
+                i = k
+                break
+        return (token, self.to_timestamp(self._timestamps[i]), self._liq_idx[i, j])
+
+    def get_latest_rates(self, token, N=1):
+        """The latest N (token, timestamp, liquidity_index) tuples, skipping bars without a value"""
+        timestamps, liq_idx = self.get_latest_window(token, N)
+        return [(token, self.to_timestamp(t), v) for t, v in zip(timestamps, liq_idx) if not np.isnan(v)]
@@ -0,0 +1,200 @@
+"""
+Rendering of the pair diagnostics figures of StatisticalArbitragePairs. matplotlib,
+seaborn and statsmodels are only imported when a figure is rendered, so that importing
+the strategies for live signal generation does not load them.
+"""
+import os
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+
+def _use_headless_backend():
+    import matplotlib
+    matplotlib.use("Agg") # Non-interactive, for the worker processes only
+
+
+def _figure(figsize):
+    """
+    Figure drawn on its own Agg canvas rather than through pyplot, so that rendering in the
+    caller's process neither needs a display nor touches the caller's pyplot backend and figures
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    return fig
+
+
+def _window(df, term_start, term_end):
+    """Rows of df between term_start and term_end (exclusive), on its Date column"""
+    return df.loc[lambda df: (df["Date"] > term_start) & (df["Date"] < term_end)]
+
+
+def _numeric(df):
+    return df.select_dtypes(include="number")
+
+
+def render_coint_p_values(pvalues, columns, path, dpi=300):
+    import seaborn as sns
+
+    fig = _figure((10, 7))
+    ax = fig.subplots()
+    sns.heatmap(pvalues, ax=ax, xticklabels=columns, yticklabels=columns, \
+        cmap='RdYlGn_r', annot=True, fmt=".2f", mask=(pvalues >= 0.99))
+
+    ax.set_title('Rates Cointregration Matrix p-values Between Pairs')
+    fig.tight_layout()
+    fig.savefig(path, dpi=dpi)
+    return path
+
+
+def render_correlation_matrix(df, path, dpi=300):
+    import seaborn as sns
+
+    fig = _figure((10, 7))
+    ax = fig.subplots()
+    sns.heatmap(df.corr(method="pearson"), ax=ax, cmap="coolwarm", annot=True, fmt=".2f")
+
+    ax.set_title('Rates Correlation Matrix')
+    fig.tight_layout()
+    fig.savefig(path, dpi=dpi)
+    return path
+
+
+def render_pair(pair, train, output_dir, term_start, term_end, dpi=300, verbose=True):
+    """
+    Stationarity diagnostics of one pair, from a DataFrame of its two rate series (columns
+    token_1 and token_2): figures of the rates, of the OLS regression of the first token on
+    the second and of the spread, and an ADF test of the spread. Returns the hedge ratio,
+    ADF statistic, p-value and critical values of the pair.
+    """
+    import statsmodels.api as sm
+    from statsmodels.tsa.stattools import adfuller
+
+    suffix = f"{term_start}_{term_end}_{pair[0]}_{pair[1]}"
+
+    # Visualize rates
+    fig = _figure((12, 6))
+    ax = train[["token_1", "token_2"]].plot(ax=fig.subplots(), title = f"Rates for {pair[0]} and {pair[1]}")
+    ax.set_ylabel("Rate")
+    ax.grid(True)
+    fig.savefig(os.path.join(output_dir, f"rates_{suffix}.png"), dpi=dpi)
+
+    # Run OLS
+    model = sm.OLS(train["token_1"], train["token_2"]).fit()
+    hedge_ratio = model.params.iloc[0]
+
+    # Regression summary results
+    fig = _figure((12, 7))
+    ax = fig.subplots()
+    ax.text(0.01, 0.05, str(model.summary()), {'fontsize': 16}, fontproperties='monospace')
+    ax.axis('off')
+    fig.tight_layout()
+    fig.subplots_adjust(left=0.2, right=0.8, top=0.7, bottom=0.1)
+    fig.savefig(os.path.join(output_dir, f"OLS_results_{suffix}.png"), dpi=dpi)
+
+    # Calculate spread
+    spread = train['token_1'] - hedge_ratio * train['token_2']
+
+    # Plot spread
+    fig = _figure((12, 6))
+    ax = spread.plot(ax=fig.subplots(), title="Rates Spread")
+    ax.set_ylabel("Spread")
+    ax.grid(True)
+    fig.savefig(os.path.join(output_dir, f"spread_{suffix}.png"), dpi=dpi)
+
+    # Conduct Augmented Dickey-Fuller test
+    adf = adfuller(spread, maxlag=1)
+    if verbose:
+        print("Hedge Ratio = ", hedge_ratio)
+        print("Critical Value = ", adf[0])
+        print("ADF critical values: ", adf[4])
+
+    return {"token_1": pair[0], "token_2": pair[1], "hedge_ratio": hedge_ratio, "adf_statistic": adf[0],
+        "adf_pvalue": adf[1], **{f"critical_{level}": value for level, value in adf[4].items()}}
+
+
+def _render_task(kind, args):
+    if kind == "coint_p_values":
+        from StatisticalArbitragePairs import StatisticalArbitragePairs
+        df, path, dpi = args
+        pvalues = StatisticalArbitragePairs.find_cointegrated_pairs(df=df)[0]
+        return kind, render_coint_p_values(pvalues, df.columns, path, dpi)
+    if kind == "correlation":
+        return kind, render_correlation_matrix(*args)
+    return kind, render_pair(*args, verbose=False)
+
+
+class DiagnosticsReport(object):
+    """
+    Headless diagnostics report of a set of pairs over one term: the cointegration p-value
+    and correlation heatmaps of all rate columns, and the rates, OLS and spread figures and
+    ADF test of every pair, as produced by plot_coint_p_values, plot_correlation_matrix and
+    perform_stationarity_test of StatisticalArbitragePairs.
+
+    The figures are rendered across a process pool (processes=1 renders them in this
+    process), each on its own Agg canvas, so that the pyplot backend of the caller is left
+    as it is, and the per-pair results are returned as a DataFrame (also written to
+    summary_<term_start>_<term_end>.csv).
+    """
+
+    def __init__(self, pairs, output_dir="stat_arb_tests", processes=None, dpi=300, label=" APY"):
+        self.pairs = pairs
+        self.output_dir = output_dir
+        self.processes = processes
+        self.dpi = dpi
+        self.label = label
+
+        self.figures = []
+        self.failures = {}
+
+    def tasks(self, df, term_start, term_end):
+        df = _window(df, term_start, term_end)
+        rates = _numeric(df)
+        tasks = [
+            ("coint_p_values", (rates, os.path.join(self.output_dir, f"cointegrated_pairs_{term_start}_{term_end}.png"), self.dpi)),
+            ("correlation", (rates, os.path.join(self.output_dir, f"correlation_{term_start}_{term_end}.png"), self.dpi)),
+        ]
+        for pair in self.pairs:
+            # Only the pair's two series are sent to the worker
+            train = pd.DataFrame({"token_1": df[pair[0]+self.label].values, "token_2": df[pair[1]+self.label].values},
+                index=df.index)
+            tasks.append((f"pair {pair[0]}/{pair[1]}", (tuple(pair), train, self.output_dir, term_start, term_end, self.dpi)))
+        return tasks
+
+    def run(self, df, term_start="2020-02-29", term_end="2020-03-29"):
+        """Render the report of the APY DataFrame df (with a Date column) between term_start and term_end"""
+        os.makedirs(self.output_dir, exist_ok=True)
+        tasks = self.tasks(df, term_start, term_end)
+        self.figures = []
+        self.failures = {}
+        rows = []
+
+        def collect(kind, result):
+            if kind.startswith("pair"):
+                rows.append(result)
+            else:
+                self.figures.append(result)
+
+        if self.processes == 1 or len(tasks) <= 1:
+            for kind, args in tasks:
+                try:
+                    collect(*_render_task(kind, args))
+                except Exception as e:
+                    self.failures[kind] = repr(e)
+        else:
+            with ProcessPoolExecutor(max_workers=self.processes, initializer=_use_headless_backend) as pool:
+                futures = {pool.submit(_render_task, kind, args): kind for kind, args in tasks}
+                for future in as_completed(futures):
+                    try:
+                        collect(*future.result())
+                    except Exception as e:
+                        self.failures[futures[future]] = repr(e)
+
+        # Keep the order of the pairs
+        order = {tuple(pair): k for k, pair in enumerate(self.pairs)}
+        rows.sort(key=lambda row: order[(row["token_1"], row["token_2"])])
+        summary = pd.DataFrame(rows)
+        summary.to_csv(os.path.join(self.output_dir, f"summary_{term_start}_{term_end}.csv"), index=False)
+        return summary
@@ -0,0 +1,174 @@
+import csv
+import time
+import numpy as np
+import pandas as pd
+
+
+class NullInstrumentation(object):
+    """Instrumentation that does nothing, used by the strategies when none is given"""
+
+    enabled = False
+
+    def begin_bar(self):
+        pass
+
+    def lap(self, stage):
+        pass
+
+    def count(self, name, n=1):
+        pass
+
+    def end_bar(self):
+        pass
+
+    def wrap_events(self, events):
+        return events
+
+
+NULL_INSTRUMENTATION = NullInstrumentation()
+
+
+class _CountingEvents(object):
+    """Events queue proxy counting the events put on the queue during each bar"""
+
+    def __init__(self, events, instrumentation):
+        self.events = events
+        self.instrumentation = instrumentation
+
+    def put(self, event, *args, **kwargs):
+        self.instrumentation.count("events")
+        return self.events.put(event, *args, **kwargs)
+
+    def put_many(self, events):
+        self.instrumentation.count("events", len(events))
+        put_many = getattr(self.events, "put_many", None)
+        if put_many is not None:
+            return put_many(events)
+        for event in events:
+            self.events.put(event)
+
+    def __getattr__(self, name):
+        return getattr(self.events, name)
+
+
+class Instrumentation(object):
+    """
+    Per-bar timing and counters for the strategies' calculate_signals.
+
+    Each bar is split into stages with lap(stage), which books the time since the previous
+    lap (or the start of the bar) to the stage, so the stages of a bar add up to its total.
+    Counters (events emitted, cointegration tests run, ...) are added with count(name, n).
+    At the end of each bar one record, {"bar", "name", "total", "stages", "counts"}, is
+    passed to every sink, which can be any callable (e.g. a HistogramSink, a CsvSink or a
+    plain callback).
+
+    Strategies without instrumentation use NULL_INSTRUMENTATION, whose methods do nothing.
+    """
+
+    enabled = True
+
+    def __init__(self, sinks=None, name=None):
+        self.sinks = list(sinks) if sinks is not None else [HistogramSink()]
+        self.name = name
+        self.bars = 0
+        self._start = self._mark = None
+        self._stages = {}
+        self._counts = {}
+
+    def begin_bar(self):
+        self._start = self._mark = time.perf_counter()
+        self._stages = {}
+        self._counts = {}
+
+    def lap(self, stage):
+        now = time.perf_counter()
+        self._stages[stage] = self._stages.get(stage, 0.0) + now - self._mark
+        self._mark = now
+
+    def count(self, name, n=1):
+        self._counts[name] = self._counts.get(name, 0) + n
+
+    def end_bar(self):
+        record = {"bar": self.bars, "name": self.name, "total": time.perf_counter() - self._start,
+            "stages": self._stages, "counts": self._counts}
+        self.bars += 1
+        for sink in self.sinks:
+            sink(record)
+
+    def wrap_events(self, events):
+        """Events queue that counts the events emitted in each bar"""
+        return _CountingEvents(events, self)
+
+
+class HistogramSink(object):
+    """
+    In-memory sink keeping a log-spaced histogram of the durations of every stage (and of
+    the bar totals), with 10 bins per decade from 1us to 100s, and the totals of the counters
+    """
+
+    EDGES = np.logspace(-6, 2, 81)
+
+    def __init__(self):
+        self.histograms = {}
+        self.sums = {}
+        self.maxima = {}
+        self.counts = {}
+        self.bars = 0
+
+    def _add(self, stage, seconds):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = np.zeros(len(self.EDGES) + 1, dtype=np.int64)
+            self.sums[stage] = 0.0
+            self.maxima[stage] = 0.0
+        histogram[np.searchsorted(self.EDGES, seconds)] += 1
+        self.sums[stage] += seconds
+        self.maxima[stage] = max(self.maxima[stage], seconds)
+
+    def __call__(self, record):
+        self.bars += 1
+        self._add("total", record["total"])
+        for stage, seconds in record["stages"].items():
+            self._add(stage, seconds)
+        for name, n in record["counts"].items():
+            self.counts[name] = self.counts.get(name, 0) + n
+
+    def percentile(self, stage, q):
+        """
+        Upper edge of the histogram bin holding the q-th percentile of the stage durations
+        (at most the longest duration), in seconds
+        """
+        histogram = self.histograms[stage]
+        cumulative = np.cumsum(histogram)
+        i = np.searchsorted(cumulative, q/100*cumulative[-1])
+        return min(self.EDGES[min(i, len(self.EDGES)-1)], self.maxima[stage])
+
+    def summary(self):
+        """Per stage number of bars, mean, p50, p95 and max durations in microseconds"""
+        rows = []
+        for stage, histogram in self.histograms.items():
+            n = int(histogram.sum())
+            rows.append({"stage": stage, "bars": n, "mean_us": 1e6*self.sums[stage]/n,
+                "p50_us": 1e6*self.percentile(stage, 50), "p95_us": 1e6*self.percentile(stage, 95),
+                "max_us": 1e6*self.maxima[stage]})
+        return pd.DataFrame(rows, columns=["stage", "bars", "mean_us", "p50_us", "p95_us", "max_us"])
+
+
+class CsvSink(object):
+    """Sink appending one CSV row per stage and counter of every bar (bar, name, kind, key, value)"""
+
+    def __init__(self, path):
+        self.file = open(path, "a", newline="")
+        self.writer = csv.writer(self.file)
+        if self.file.tell() == 0:
+            self.writer.writerow(["bar", "name", "kind", "key", "value"])
+
+    def __call__(self, record):
+        bar, name = record["bar"], record["name"]
+        rows = [(bar, name, "stage", "total", record["total"])]
+        rows += [(bar, name, "stage", stage, seconds) for stage, seconds in record["stages"].items()]
+        rows += [(bar, name, "count", key, n) for key, n in record["counts"].items()]
+        self.writer.writerows(rows)
+
+    def close(self):
+        self.file.close()
@@ -0,0 +1,140 @@
+import numpy as np
+from statsmodels.tsa.vector_ar.vecm import coint_johansen
+
+
+def _regression_rows(endog):
+    """
+    Rows [dx_t, dx_t-1, x_t] of the Johansen regressions with det_order=0 and k_ar_diff=1,
+    for every t where all three are available
+    """
+    dx = np.diff(endog, axis=0)
+    return np.concatenate([dx[1:], dx[:-1], endog[1:-1]], axis=1)
+
+
+class _BasketState(object):
+    """Cached moments of the regression rows and the last full Johansen result for one basket"""
+
+    def __init__(self):
+        self.endog = None
+        self.sums = None # Sum of the regression rows
+        self.cross = None # Sum of the outer products of the regression rows
+        self.result = None
+        self.tested_trace = None
+        self.bars_since_test = 0
+        self.updates_since_resync = 0
+
+
+class JohansenService(object):
+    """
+    Johansen tests for StatArbMultiTrade (det_order=0, k_ar_diff=1) that avoid rerunning
+    coint_johansen on every bar.
+
+    The full decomposition is refreshed every refresh_every bars, or earlier when the
+    trace statistic (for rank 0) has drifted by more than drift_threshold (relative) since
+    the last refresh. In between the cached result, and so its leading eigenvector evec,
+    is returned as it is.
+
+    To check the drift, the sums and cross products of the regression rows (differences,
+    lagged differences and lagged levels) are kept per basket, and updated when one bar
+    enters the window and one leaves, or recomputed when the earlier values in the window
+    have been revised. The moment matrices, and the trace statistic from two determinants,
+    follow from these without an eigen-decomposition. The defaults (refresh every bar)
+    reproduce plain coint_johansen exactly.
+
+    The incremental update only applies to windows whose earlier values are not revised
+    from bar to bar (e.g. windows of a whole-history APY series). StatArbMultiTrade's APY
+    lookback equals its window, so all of its APYs are measured against the start of the
+    window and change whenever it rolls forward: for that caller the moments are recomputed
+    on every bar (see moments_recomputed), which is cheap next to coint_johansen, and the
+    saving comes from the decompositions skipped, not from the incremental update.
+    """
+
+    def __init__(self, refresh_every=1, drift_threshold=None):
+        self.refresh_every = refresh_every
+        self.drift_threshold = drift_threshold
+        self._states = {}
+
+        # Counters
+        self.decompositions_run = 0
+        self.cache_hits = 0
+        self.moments_recomputed = 0
+
+    def reset(self, key=None):
+        if key is None:
+            self._states.clear()
+        else:
+            self._states.pop(key, None)
+
+    def _update_moments(self, state, endog):
+        n = len(endog)
+        state.updates_since_resync += 1
+        if state.updates_since_resync >= n:
+            # Recompute once per window length to stop rounding errors from accumulating
+            state.updates_since_resync = 0
+        elif state.sums is not None and state.endog.shape[1] == endog.shape[1]:
+            prev = state.endog
+            if n == len(prev) and n > 3 and np.array_equal(endog[:-1], prev[1:]):
+                # One bar in, one bar out
+                removed = _regression_rows(prev[:3])[0]
+                added = _regression_rows(endog[-3:])[0]
+                return state.sums - removed + added, state.cross - np.outer(removed, removed) + np.outer(added, added)
+            if n == len(prev)+1 and n > 3 and np.array_equal(endog[:-1], prev):
+                # Growing window during the warm-up
+                added = _regression_rows(endog[-3:])[0]
+                return state.sums + added, state.cross + np.outer(added, added)
+            if n == len(prev) and np.array_equal(endog, prev):
+                return state.sums, state.cross
+
+        self.moments_recomputed += 1
+        rows = _regression_rows(endog)
+        return rows.sum(axis=0), rows.T.dot(rows)
+
+    @staticmethod
+    def trace_statistic(sums, cross, n_obs, neqs):
+        """
+        Trace statistic for cointegration rank 0 from the sums and cross products of the
+        regression rows, as -T log det(I - skk^-1 sk0 s00^-1 sk0')
+        """
+        centred = cross - np.outer(sums, sums)/n_obs
+        a, b, c = slice(0, neqs), slice(neqs, 2*neqs), slice(2*neqs, 3*neqs)
+
+        # Residual moments of the differences (0) and lagged levels (k) on the lagged differences
+        bb_inv = np.linalg.pinv(centred[b, b])
+        s00 = (centred[a, a] - centred[a, b].dot(bb_inv).dot(centred[b, a]))/n_obs
+        sk0 = (centred[c, a] - centred[c, b].dot(bb_inv).dot(centred[b, a]))/n_obs
+        skk = (centred[c, c] - centred[c, b].dot(bb_inv).dot(centred[b, c]))/n_obs
+
+        sig = sk0.dot(np.linalg.pinv(s00)).dot(sk0.T)
+        return -n_obs*(np.linalg.slogdet(skk - sig)[1] - np.linalg.slogdet(skk)[1])
+
+    def test(self, endog, key=None):
+        """
+        Johansen test result (det_order=0, k_ar_diff=1) for the current window of endog, a
+        (bars, tokens) array, where key identifies the basket
+        """
+        endog = np.asarray(endog, dtype=float)
+
+        state = self._states.get(key)
+        if state is None:
+            state = self._states[key] = _BasketState()
+        state.bars_since_test += 1
+
+        refresh = state.result is None or state.bars_since_test >= self.refresh_every
+        trace = None
+        if self.drift_threshold is not None:
+            state.sums, state.cross = self._update_moments(state, endog)
+            state.endog = endog
+            with np.errstate(all="ignore"):
+                trace = self.trace_statistic(state.sums, state.cross, len(endog)-2, endog.shape[1])
+            if not refresh:
+                refresh = not np.isfinite(trace) or not np.isfinite(state.tested_trace) \
+                    or abs(trace - state.tested_trace) > self.drift_threshold*abs(state.tested_trace)
+
+        if refresh:
+            state.result = coint_johansen(endog, det_order=0, k_ar_diff=1)
+            state.tested_trace = trace
+            state.bars_since_test = 0
+            self.decompositions_run += 1
+        else:
+            self.cache_hits += 1
+        return state.result
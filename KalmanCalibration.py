@@ -0,0 +1,106 @@
+import time
+import numpy as np
+import pandas as pd
+from BatchedKalmanFilter import BatchedKalmanFilter, strategy_observations
+
+
+def log_likelihoods(apys, deltas, vts, burn_in=10):
+    """
+    Prediction-error log-likelihood of the KalmanFilterStatArb filter over an APY panel
+    (bars, tokens), for every (delta, vt) pair given, from the forecast errors et and their
+    variances Qt: -0.5*sum(log(2*pi*Qt) + et**2/Qt), leaving out the first burn_in bars
+    while the filter moves away from its zero starting state.
+
+    All of the parameter pairs are run as the baskets of one BatchedKalmanFilter, so the
+    whole grid takes a single vectorised pass over the bars. Returns the log-likelihoods
+    and the filter, holding the final state of every parameter pair.
+    """
+    apys = np.asarray(apys, dtype=float)
+    apys = apys[~np.isnan(apys).any(axis=1)]
+    deltas = np.asarray(deltas, dtype=float)
+    vts = np.asarray(vts, dtype=float)
+    n_points, n_tokens = len(deltas), apys.shape[1]
+
+    kf = BatchedKalmanFilter(n_points, n_tokens, delta=deltas, vt=vts)
+    loglik = np.zeros(n_points)
+    with np.errstate(divide="ignore", invalid="ignore"): # Flat z-scores and hedge ratios of the first bars
+        for t in range(len(apys)):
+            F, y = strategy_observations(apys[t])
+            et = kf.update(np.broadcast_to(F, (n_points, n_tokens)), np.broadcast_to(y, (n_points,)))[0]
+            if t >= burn_in:
+                loglik -= 0.5*(np.log(2*np.pi*kf.Qt) + et**2/kf.Qt)
+    return loglik, kf
+
+
+class KalmanCalibration(object):
+    """
+    Calibration of the noise parameters (delta, vt) of KalmanFilterStatArb on a historical
+    APY panel (one column per token, in the strategy's token order), by maximising the
+    prediction-error log-likelihood of the filter.
+
+    The likelihood is evaluated over the grid of deltas x vts in one vectorised pass (see
+    log_likelihoods), and, with refine=True, the best grid point is refined with a
+    Nelder-Mead search over log(delta) and log(vt). After fit, the best parameters, their
+    log-likelihood, the grid of log-likelihoods and the filter state at the end of the
+    history (theta, C and R, to start the strategy from) are kept.
+    """
+
+    def __init__(self, deltas=np.logspace(-7, -1, 13), vts=np.logspace(-6, 0, 13), burn_in=10, refine=False):
+        self.deltas = np.asarray(deltas, dtype=float)
+        self.vts = np.asarray(vts, dtype=float)
+        self.burn_in = burn_in
+        self.refine = refine
+
+        self.delta = None
+        self.vt = None
+        self.loglik = None
+        self.grid = None
+        self.state = None
+        self.wall_time = None
+
+    def fit(self, apys):
+        start_time = time.perf_counter()
+        values = apys.values if isinstance(apys, pd.DataFrame) else apys
+        delta_grid, vt_grid = np.meshgrid(self.deltas, self.vts, indexing="ij")
+        loglik, kf = log_likelihoods(values, delta_grid.ravel(), vt_grid.ravel(), burn_in=self.burn_in)
+        self.grid = pd.DataFrame(loglik.reshape(delta_grid.shape), index=pd.Index(self.deltas, name="delta"),
+            columns=pd.Index(self.vts, name="vt"))
+
+        best = int(np.nanargmax(loglik))
+        self.delta, self.vt, self.loglik = delta_grid.ravel()[best], vt_grid.ravel()[best], loglik[best]
+        if self.refine:
+            self._refine(values)
+            loglik, kf = log_likelihoods(values, [self.delta], [self.vt], burn_in=self.burn_in)
+            best = 0
+        self.state = {"theta": kf.theta[best].copy(), "C": kf.C[best].copy(), "R": kf.R[best].copy()}
+        self.wall_time = time.perf_counter() - start_time
+        return self.result()
+
+    def _refine(self, values):
+        from scipy.optimize import minimize
+
+        def negative_loglik(x):
+            delta, vt = np.exp(x)
+            if delta >= 1:
+                return np.inf
+            loglik = log_likelihoods(values, [delta], [vt], burn_in=self.burn_in)[0][0]
+            return -loglik if np.isfinite(loglik) else np.inf
+
+        solution = minimize(negative_loglik, np.log([self.delta, self.vt]), method="Nelder-Mead",
+            options={"xatol": 1e-3, "fatol": 1e-6})
+        if -solution.fun > self.loglik:
+            self.delta, self.vt = np.exp(solution.x)
+            self.loglik = -solution.fun
+
+    def result(self):
+        return {"delta": self.delta, "vt": self.vt, "loglik": self.loglik, "state": self.state}
+
+    def apply(self, strategy):
+        """Set the calibrated parameters, and the state at the end of the history, on a KalmanFilterStatArb"""
+        strategy.delta = self.delta
+        strategy.vt = self.vt
+        strategy.wt = strategy.delta/(1-strategy.delta) * np.eye(len(strategy.token_list))
+        strategy.theta = self.state["theta"].copy()
+        strategy.C = self.state["C"].copy()
+        strategy.R = self.state["R"].copy()
+        return strategy
@@ -1,10 +1,14 @@
 from strategy import Strategy
-from event import SignalEvent
+from ApyEngine import ApyEngine, SECONDS_IN_YEAR # SECONDS_IN_YEAR is only re-exported, for code that imported it from here
+from RollingStats import RollingWindowStats
+from SizedSignal import put_signals
 import numpy as np
-from math import floor, ceil
+from math import floor
 import pandas as pd
+from Instrumentation import NULL_INSTRUMENTATION
+from StrategyState import StateStore, encode_position, decode_position
+from Kernels import get_kernels
 
-SECONDS_IN_YEAR = 31536000
 class KalmanFilterStatArb(Strategy):
     """
     This is a generalised pairs trading strategy, where a Kalman Filter (state-space model with
@@ -15,11 +19,17 @@ class KalmanFilterStatArb(Strategy):
     TODO: make the trading compatible with positions on Voltz
     """
 
-    def __init__(self, events, rates, use_dynamic_hedge=False, lookback_window=10):
+    def __init__(self, events, rates, use_dynamic_hedge=False, lookback_window=10, sized_signals=False, delta=1e-4, vt=1e-3,
+        instrumentation=None, kernels="numpy"):
         self.rates = rates
-        self.events = events
+        # Optional per-stage timings and counters of calculate_signals, a no-op by default
+        self.instrumentation = NULL_INSTRUMENTATION if instrumentation is None else instrumentation
+        self.events = self.instrumentation.wrap_events(events)
         self.token_list = self.rates.token_list
         self.lookback_window = lookback_window
+        # Hot-loop kernels, NumPy by default or compiled with numba (see Kernels.get_kernels)
+        self.kernels = get_kernels(kernels)
+        self.apy_engine = ApyEngine(lookback=self.lookback_window, kernels=self.kernels) # Streaming APY calculation per token
         
         # Keep a record of the rates data and the state of the market
         self.latest_rates = -1.0*np.ones(len(self.token_list)) 
@@ -27,9 +37,9 @@ class KalmanFilterStatArb(Strategy):
         self.days = 0
 
         # Kalman filter-specific parameters
-        self.delta = 1e-4
+        self.delta = delta
         self.wt = self.delta/(1-self.delta) * np.eye(len(self.token_list)) # Starting system error
-        self.vt = 1e-3 # Starting measurement error
+        self.vt = vt # Starting measurement error
         self.theta = np.zeros(len(self.token_list)) # Starting hidden state
         self.C = np.zeros((len(self.token_list),len(self.token_list)))
         self.R = None
@@ -40,40 +50,124 @@ class KalmanFilterStatArb(Strategy):
         self.deviations = 1 # Default is 1 standard deviation away from the mean spread
         
         # Need to keep track of the Kalman filter moving averages and moving stds
-        self.days_to_lookback = -self.lookback_window
-        self.et_recent_L_values = {l: 0 for l in range(self.days_to_lookback,0)}
+        self.et_stats = RollingWindowStats(self.lookback_window)
         self.et_MA = 0 
         self.et_MStd = 0
         
         self.use_dynamic_hedge = use_dynamic_hedge
         self.pos = np.zeros(len(self.token_list))
+        self.sized_signals = sized_signals # One SizedSignalEvent per leg, instead of one SignalEvent per unit
 
     def liquidity_index_to_apy(self, rates):
-        liq_idx = np.array([r[2] for r in rates])
-        timestamps = np.array([r[1] for r in rates])
-        apys = []
-        for i in range(1, len(liq_idx)):
-            window = i-self.lookback_window if self.lookback_window<=i else 0
-            variable_rate = liq_idx[i]/liq_idx[window] - 1.0 
-            # Annualise the rate
-            compounding_periods = SECONDS_IN_YEAR / (timestamps[i] - timestamps[window]).total_seconds()
-            apys.append(((1 + variable_rate)**compounding_periods) - 1)
-        return apys
+        if len(rates) == 0:
+            return []
+        return self.apy_engine.rates_to_apys(rates[-1][0], rates)[1]
+
+    def window_apys(self):
+        """
+        APYs over the lookback window, one column per token, together with the latest
+        (token, timestamp, liquidity index) of each token. A columnar rates store hands
+        over zero-copy views of the aligned window, otherwise the rate tuples are unpacked.
+        """
+        if hasattr(self.rates, "get_latest_panel"):
+            timestamps_ns, liq_panel = self.rates.get_latest_panel(self.token_list, N=self.lookback_window)
+            latest = [self.rates.latest(token) for token in self.token_list]
+            self.instrumentation.lap("fetch_rates")
+            apys = self.apy_engine.panel_apys(self.token_list, timestamps_ns, liq_panel)
+            self.instrumentation.lap("apy")
+            return apys, latest
+
+        liq_idxs ={
+            token: self.rates.get_latest_rates(token, N=self.lookback_window) for token in self.token_list
+        }
+        self.instrumentation.lap("fetch_rates")
+        # Put all relevant rates in the lookback window here
+        df_rates = pd.DataFrame.from_dict({
+                k: self.liquidity_index_to_apy(rates=v) for k, v in liq_idxs.items()
+            }
+        )
+        self.instrumentation.lap("apy")
+        return df_rates.values, [v[-1] for v in liq_idxs.values() if len(v) > 0]
         
+    def get_state(self):
+        """
+        State of the filter for warm restarts, as a one-row StateStore (see save_state and
+        load_state): the noise parameters, hidden state and covariances, the forecast error
+        window and the positions. The APY cache is rebuilt from the rates on the next bar.
+        """
+        n, lookback = len(self.token_list), self.lookback_window
+        store = StateStore([tuple(self.token_list)], {
+            "delta": ((), float), "vt": ((), float), "theta": ((n,), float), "C": ((n, n), float),
+            "R": ((n, n), float), "has_R": ((), bool), "latest_rates": ((n,), float), "invested": ((), np.int8),
+            "days": ((), np.int64), "et_values": ((lookback,), float), "et_stats": ((5,), float),
+            "et_MA": ((), float), "et_MStd": ((), float), "pos": ((n,), float), "hedge_qty": ((n,), float),
+        }, meta={"strategy": type(self).__name__})
+        store["delta"], store["vt"] = self.delta, self.vt
+        store["theta"], store["C"] = self.theta, self.C
+        store["has_R"] = self.R is not None
+        if self.R is not None:
+            store["R"] = self.R
+        store["latest_rates"] = self.latest_rates
+        store["invested"] = encode_position(self.invested)
+        store["days"] = self.days
+        store["et_values"], store["et_stats"] = self.et_stats.get_state()
+        store["et_MA"], store["et_MStd"] = self.et_MA, self.et_MStd
+        store["pos"], store["hedge_qty"] = self.pos, self.hedge_qty
+        return store
+
+    def save_state(self, path):
+        self.get_state().save(path)
+
+    def load_state(self, path):
+        store = StateStore.load(path)
+        store.check_keys([tuple(self.token_list)], what="baskets")
+        self.delta, self.vt = float(store["delta"][0]), float(store["vt"][0])
+        self.wt = self.delta/(1-self.delta) * np.eye(len(self.token_list))
+        self.theta, self.C = store["theta"][0].copy(), store["C"][0].copy()
+        self.R = store["R"][0].copy() if store["has_R"][0] else None
+        self.latest_rates = store["latest_rates"][0].copy()
+        self.invested = decode_position(store["invested"][0])
+        self.days = int(store["days"][0])
+        self.et_stats.set_state(store["et_values"][0], store["et_stats"][0])
+        self.et_MA, self.et_MStd = store["et_MA"][0], store["et_MStd"][0]
+        self.pos = store["pos"][0].copy()
+        self.hedge_qty = store["hedge_qty"][0].copy()
+        self.apy_engine.reset()
+
+    def spread_legs(self, latest, quantities, direction, directions=None):
+        """
+        (token, direction, quantity, timestamp) legs to go long or short the spread: the last
+        rate, used in the observation, takes the spread direction and the hidden rates the
+        opposite one (or, with the dynamic hedge, the direction given by the sign of the hedge ratio)
+        """
+        opposite = "SHORT" if direction == "LONG" else "LONG"
+        legs = [(latest[-1][0], direction, quantities[-1], latest[-1][1])]
+        for i in range(len(quantities)-1):
+            POS = opposite if directions is None or directions[i]<0 else direction
+            legs.append((latest[i][0], POS, quantities[i], latest[i][1]))
+        return legs
+
+    def kalman_update(self, F, y):
+        """
+        One Kalman filter step for the observation vector F and the observed rate y,
+        updating the hidden state and its covariance. Returns the forecast error et
+        """
+        # Assume the prior value of the hidden states, theta_t, is distributed
+        # as a multivariate Gaussian with mean a_t and covariance R_t, and
+        # 1) predict the new observation and the forecast error of that prediction,
+        # 2) take Q_t, the variance of the prediction on the observations, and
+        # 3) update the hidden states to their posterior, a multivariate Gaussian with
+        # mean m_t and covariance C_t, with the Kalman gain (see Kernels.kalman_step)
+        self.theta, self.C, self.R, et = self.kernels.kalman_step(self.theta, self.C, self.wt, self.vt, F, y, self.R is None)
+        return et
+
     def calculate_signals(self, event):
         # Pick up the latest rates here
         if event.type == "MARKET":
-            
-            liq_idxs ={
-                token: self.rates.get_latest_rates(token, N=self.lookback_window) for token in self.token_list
-            }
-
-            # Put all relevant rates in the lookback window here
-            df_rates = pd.DataFrame.from_dict({
-                    k: self.liquidity_index_to_apy(rates=v) for k, v in liq_idxs.items()
-                }
-            )   
-            self.latest_rates = df_rates.iloc[-1].values
+            instrumentation = self.instrumentation
+            instrumentation.begin_bar()
+            window_apys, latest = self.window_apys()
+            self.latest_rates = window_apys[-1]
             self.days += 1
           
             if all(self.latest_rates > -1.0):
@@ -85,40 +179,16 @@ class KalmanFilterStatArb(Strategy):
                 F = np.append(self.latest_rates[:-1], 1.0)#.reshape((1,len(self.token_list)))
                 y = self.latest_rates[1] # --> this comes from the last token, which we treat as the observation
 
-                # Assume the prior value of the hidden states, theta_t, is distributed
-                # as a multivariate Gaussian with mean a_t and covariance R_t
-                if self.R is not None:
-                    self.R = self.C + self.wt
-                else:
-                    self.R = np.zeros((len(self.token_list),len(self.token_list)))
-                
-                # Kalman filter update 
-                # 1) Prediction of new observation as well as forecast error of that prediction
-                yhat = F.dot(self.theta)
-                #print("yhat: ", yhat) 
-                et = y - yhat
-                    
-                # 2) Q_t calculation: the variance of the prediction on the observations
-                Qt = F.dot(self.R).dot(F.T) + self.vt
-                sqrt_Qt = np.sqrt(Qt)
-
-                # 3) Posterior value of the hidden states, assuming that the hidden state prior is 
-                # distributed as a multivariate Gaussian with mean m_t and and covariance C_t
-                At = self.R.dot(F.T)/Qt # Kalman gain
-                self.theta = self.theta + At.flatten() * et # State update
-                self.C = self.R - At * F.dot(self.R) # State covariance update
+                # Kalman filter update of the hidden states, returning the forecast error
+                et = self.kalman_update(F, y)
+                instrumentation.lap("kalman")
               
                 # 4) Save the relevant historical et values, according to the lookback window
-                historical_et = self.et_recent_L_values[self.days_to_lookback] if self.days > self.lookback_window else None
-                self.et_recent_L_values[self.days_to_lookback] = et
-                non_zero_et_cached = np.array([v for k,v in self.et_recent_L_values.items() if v!=0])
-                self.days_to_lookback += 1
-                if self.days_to_lookback==0: # Reset in order to cache historical values within the lookback only
-                    self.days_to_lookback = -self.lookback_window
+                self.et_stats.push(et)
             
                 # 5) Update the moving average and moving std according to the latest values cached
-                self.et_MA = non_zero_et_cached.mean()
-                self.et_MStd = non_zero_et_cached.std()
+                self.et_MA = self.et_stats.mean
+                self.et_MStd = self.et_stats.std
                 #if self.days < 20:
                 #    print("MA: ", self.et_MA, ", MVar: ", self.et_MStd)
                 
@@ -129,6 +199,7 @@ class KalmanFilterStatArb(Strategy):
                 normed_hedge = self.theta/self.theta[-1]
                 
                 if self.days > self.lookback_window:
+                    unit_events = not self.sized_signals
                     if self.use_dynamic_hedge:
                         if self.invested is None:
                             self.pos = normed_hedge # Position directions and sizes
@@ -136,27 +207,13 @@ class KalmanFilterStatArb(Strategy):
                             if et_z < -self.deviations:
                                 # Long entry => long the rate we use in the observation, short the hidden rate according 
                                 # to the Kalman Filter hedge ratio
-                                for i in range(self.hedge_qty[-1]): # Always long the last term, by construction
-                                    signal = SignalEvent(list(liq_idxs.values())[-1][-1][0], "LONG", list(liq_idxs.values())[-1][-1][1])
-                                    self.events.put(signal)
-                                for i in range(len(self.hedge_qty)-1):
-                                    POS = "SHORT" if self.pos[i]<0 else "LONG"
-                                    for j in range(self.hedge_qty[i]):
-                                        signal = SignalEvent(list(liq_idxs.values())[i][-1][0], POS, list(liq_idxs.values())[i][-1][1])
-                                        self.events.put(signal)   
+                                put_signals(self.events, self.spread_legs(latest, self.hedge_qty, "LONG", self.pos), unit_events=unit_events)
                                 self.invested = "LONG"
                             
                             elif et_z > self.deviations:
                                 # Short entry => short the rate we use in the observation, long the hidden rate according 
                                 # to the Kalman Filter hedge ratio
-                                for i in range(self.hedge_qty[-1]): 
-                                    signal = SignalEvent(list(liq_idxs.values())[-1][-1][0], "SHORT", list(liq_idxs.values())[-1][-1][1])
-                                    self.events.put(signal)
-                                for i in range(len(self.hedge_qty)-1):
-                                    POS = "LONG" if self.pos[i]<0 else "SHORT"
-                                    for j in range(self.hedge_qty[i]):
-                                        signal = SignalEvent(list(liq_idxs.values())[i][-1][0], POS, list(liq_idxs.values())[i][-1][1])
-                                        self.events.put(signal)
+                                put_signals(self.events, self.spread_legs(latest, self.hedge_qty, "SHORT", self.pos), unit_events=unit_events)
                                 self.invested = "SHORT"
 
                         # If instead we have already entered a position in the market
@@ -164,56 +221,29 @@ class KalmanFilterStatArb(Strategy):
                             self.pos = normed_hedge 
                             self.hedge_qty = [int(floor(np.abs(i))) for i in self.pos]
                             if self.invested=="LONG" and et_z > 0: # Unwind the long spread position
-                                for i in range(self.hedge_qty[-1]): 
-                                    signal = SignalEvent(list(liq_idxs.values())[-1][-1][0], "SHORT", list(liq_idxs.values())[-1][-1][1])
-                                    self.events.put(signal)
-                                for i in range(len(self.hedge_qty)-1):
-                                    POS = "LONG" if self.pos[i]<0 else "SHORT"
-                                    for j in range(self.hedge_qty[i]):
-                                        signal = SignalEvent(list(liq_idxs.values())[i][-1][0], POS, list(liq_idxs.values())[i][-1][1])
-                                        self.events.put(signal)
+                                put_signals(self.events, self.spread_legs(latest, self.hedge_qty, "SHORT", self.pos), unit_events=unit_events)
                                 self.invested = None
                             
                             elif self.invested=="SHORT" and et_z < 0: # Unwind the short spead position
-                                for i in range(self.hedge_qty[-1]): # Always long the last term, by construction
-                                    signal = SignalEvent(list(liq_idxs.values())[-1][-1][0], "LONG", list(liq_idxs.values())[-1][-1][1])
-                                    self.events.put(signal)
-                                for i in range(len(self.hedge_qty)-1):
-                                    POS = "SHORT" if self.pos[i]<0 else "LONG"
-                                    for j in range(self.hedge_qty[i]):
-                                        signal = SignalEvent(list(liq_idxs.values())[i][-1][0], POS, list(liq_idxs.values())[i][-1][1])
-                                        self.events.put(signal)   
+                                put_signals(self.events, self.spread_legs(latest, self.hedge_qty, "LONG", self.pos), unit_events=unit_events)
                                 self.invested = None          
                     else:
+                        unit_qty = [1]*len(self.token_list)
                         # If there is not curently a position in the market
                         if self.invested is None:
                             if et_z < -self.deviations:
-                                signal = SignalEvent(list(liq_idxs.values())[-1][-1][0], "LONG", list(liq_idxs.values())[-1][-1][1])
-                                self.events.put(signal)  
-                                for i in range(len(self.token_list)-1):
-                                    signal = SignalEvent(list(liq_idxs.values())[i][-1][0], "SHORT", list(liq_idxs.values())[i][-1][1])
-                                    self.events.put(signal)    
+                                put_signals(self.events, self.spread_legs(latest, unit_qty, "LONG"), unit_events=unit_events)
                                 self.invested = "LONG"
                             elif et_z > self.deviations:
-                                signal = SignalEvent(list(liq_idxs.values())[-1][-1][0], "SHORT", list(liq_idxs.values())[-1][-1][1])
-                                self.events.put(signal)  
-                                for i in range(len(self.token_list)-1):
-                                    signal = SignalEvent(list(liq_idxs.values())[i][-1][0], "LONG", list(liq_idxs.values())[i][-1][1])
-                                    self.events.put(signal)    
+                                put_signals(self.events, self.spread_legs(latest, unit_qty, "SHORT"), unit_events=unit_events)
                                 self.invested = "SHORT"
                         # If instead we have already entered a position in the market
                         if self.invested is not None:
                             if self.invested=="LONG" and et_z > 0: # Unwind the long spread position  
-                                signal = SignalEvent(list(liq_idxs.values())[-1][-1][0], "SHORT", list(liq_idxs.values())[-1][-1][1])
-                                self.events.put(signal)  
-                                for i in range(len(self.token_list)-1):
-                                    signal = SignalEvent(list(liq_idxs.values())[i][-1][0], "LONG", list(liq_idxs.values())[i][-1][1])
-                                    self.events.put(signal)  
+                                put_signals(self.events, self.spread_legs(latest, unit_qty, "SHORT"), unit_events=unit_events)
                                 self.invested = None
                             elif self.invested=="SHORT" and et_z < 0: # Unwind the short spead position
-                                signal = SignalEvent(list(liq_idxs.values())[-1][-1][0], "LONG", list(liq_idxs.values())[-1][-1][1])
-                                self.events.put(signal)  
-                                for i in range(len(self.token_list)-1):
-                                    signal = SignalEvent(list(liq_idxs.values())[i][-1][0], "SHORT", list(liq_idxs.values())[i][-1][1])
-                                    self.events.put(signal) 
-                                self.invested = None
\ No newline at end of file
+                                put_signals(self.events, self.spread_legs(latest, unit_qty, "LONG"), unit_events=unit_events)
+                                self.invested = None
+                instrumentation.lap("emit")
+            instrumentation.end_bar()
@@ -0,0 +1,146 @@
+import numpy as np
+from ApyEngine import apys_at, SECONDS_IN_YEAR, NANOSECONDS_IN_SECOND
+
+BACKENDS = ("numpy", "numba", "auto")
+
+
+"""
+    NumPy kernels, the operations the strategies have always used
+"""
+def kalman_step(theta, C, wt, vt, F, y, first):
+    """
+    One KalmanFilterStatArb filter step for the observation vector F and the observed rate y,
+    from the hidden state theta and its covariance C (first is True on the first step, when the
+    prior covariance starts at zero). Returns the new theta, C, the prior covariance R and the
+    forecast error et
+    """
+    R = np.zeros((len(theta), len(theta))) if first else C + wt
+    yhat = F.dot(theta)
+    et = y - yhat
+    Qt = F.dot(R).dot(F.T) + vt
+    At = R.dot(F.T)/Qt # Kalman gain
+    theta = theta + At.flatten() * et
+    C = R - At * F.dot(R)
+    return theta, C, R, et
+
+
+def spread(latest_rates, evecs):
+    """Spread of the latest rates weighted by the eigenvector, summed in order as the original loop"""
+    return np.cumsum(latest_rates*evecs)[-1]
+
+
+"""
+    Loop kernels, compiled with numba.njit. They follow the NumPy kernels operation for
+    operation, but a scalar pow can differ from the vectorised np.power by 1 ulp and the BLAS
+    may sum the dot products in another order, so they agree with the NumPy kernels to RTOL
+    and ATOL rather than bit for bit (the spread sums in the same order as the cumsum). The
+    event streams are the same unless a z-score falls within that rounding of a threshold, or
+    StatArbMultiTrade's Johansen step magnifies it, which an ill-conditioned decomposition
+    (e.g. on a basket that is not cointegrated) can do
+"""
+RTOL = 1e-9 # Relative and absolute tolerances of the loop kernels against the NumPy kernels
+ATOL = 1e-12
+
+
+def _apys_at_loop(timestamps_ns, liq_idx, lookback, idx):
+    apys = np.empty(len(idx))
+    for k in range(len(idx)):
+        i = idx[k]
+        base = max(i - lookback, 0)
+        variable_rate = liq_idx[i]/liq_idx[base] - 1.0
+        compounding_periods = SECONDS_IN_YEAR / ((timestamps_ns[i] - timestamps_ns[base]) / NANOSECONDS_IN_SECOND)
+        apys[k] = ((1 + variable_rate)**compounding_periods) - 1
+    return apys
+
+
+def _kalman_step_loop(theta, C, wt, vt, F, y, first):
+    n = len(theta)
+    R = np.zeros((n, n))
+    if not first:
+        for i in range(n):
+            for j in range(n):
+                R[i, j] = C[i, j] + wt[i, j]
+    yhat = 0.0
+    for i in range(n):
+        yhat += F[i]*theta[i]
+    et = y - yhat
+
+    RF = np.zeros(n) # R.F
+    FR = np.zeros(n) # F.R
+    for i in range(n):
+        for j in range(n):
+            RF[i] += R[i, j]*F[j]
+            FR[j] += F[i]*R[i, j]
+    FRF = 0.0
+    for j in range(n):
+        FRF += FR[j]*F[j]
+    Qt = FRF + vt
+
+    new_theta = np.empty(n)
+    new_C = np.empty((n, n))
+    for i in range(n):
+        new_theta[i] = theta[i] + RF[i]/Qt*et
+        for j in range(n):
+            new_C[i, j] = R[i, j] - RF[j]/Qt*FR[j]
+    return new_theta, new_C, R, et
+
+
+def _spread_loop(latest_rates, evecs):
+    total = 0.0
+    for i in range(len(evecs)):
+        total += latest_rates[i]*evecs[i]
+    return total
+
+
+class KernelSet(object):
+    """The hot-loop kernels of one backend: the APYs of a liquidity index window, the Kalman step and the spread"""
+
+    def __init__(self, name, apys_at, kalman_step, spread):
+        self.name = name
+        self.apys_at = apys_at
+        self.kalman_step = kalman_step
+        self.spread = spread
+
+    def __repr__(self):
+        return f"KernelSet({self.name})"
+
+
+NUMPY_KERNELS = KernelSet("numpy", apys_at, kalman_step, spread)
+_NUMBA_KERNELS = {} # Compiled once per process
+
+
+def numba_kernels():
+    """The loop kernels compiled with numba (raises ImportError without numba)"""
+    if "kernels" not in _NUMBA_KERNELS:
+        from numba import njit
+        _NUMBA_KERNELS["kernels"] = KernelSet("numba", njit(cache=True)(_apys_at_loop), njit(cache=True)(_kalman_step_loop),
+            njit(cache=True)(_spread_loop))
+    return _NUMBA_KERNELS["kernels"]
+
+
+def get_kernels(backend="numpy"):
+    """
+    Kernels of a backend: "numpy", "numba" (compiled, which needs numba installed) or "auto"
+    (numba when it is installed, numpy otherwise). A KernelSet is returned as it is.
+    """
+    if isinstance(backend, KernelSet):
+        return backend
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown kernel backend {backend}, expected one of {BACKENDS}")
+    if backend == "numpy":
+        return NUMPY_KERNELS
+    try:
+        return numba_kernels()
+    except ImportError:
+        if backend == "numba":
+            raise
+        return NUMPY_KERNELS
+
+
+def available_backends():
+    """The backends that can be used here"""
+    try:
+        numba_kernels()
+    except ImportError:
+        return ["numpy"]
+    return ["numpy", "numba"]
@@ -0,0 +1,88 @@
+import numpy as np
+
+
+def _mean_std(x):
+    """Mean and sample std skipping NaNs, matching pandas Series.mean() and .std()"""
+    x = x[~np.isnan(x)]
+    mean = x.mean() if len(x) > 0 else np.nan
+    std = x.std(ddof=1) if len(x) > 1 else np.nan
+    return mean, std
+
+
+class MonthlyZScore(object):
+    """
+    Monthly z-score regime for the pairs strategy. The ratios are z-scored within each
+    calendar month, and the entry thresholds for a month come from the previous month's
+    z-scores (their mean +/- deviations * std), or are NaN if the previous month is not in
+    the window.
+
+    Months are found from the datetime index directly, and the statistics of every month
+    are broadcast back to the rows in one assignment. Statistics for completed months are
+    cached per key (usually the pair), so as new bars arrive only the current month, and
+    the partial month at the start of the window, are recomputed.
+    """
+
+    def __init__(self):
+        self._cache = {} # key -> {(month, first timestamp, last timestamp, rows): month statistics}
+
+        # Counters
+        self.months_computed = 0
+        self.months_cached = 0
+
+    def reset(self, key=None):
+        if key is None:
+            self._cache.clear()
+        else:
+            self._cache.pop(key, None)
+
+    def apply(self, key, signals, deviations=1.0, column="Ratios", stable_from=0):
+        """
+        Add the "Z", "Z upper limit" and "Z lower limit" columns to the signals DataFrame,
+        which must have a sorted DatetimeIndex. Rows before stable_from may have been revised
+        since the last bar (e.g. APYs with a clipped lookback), so a month starting there is
+        never served from the cache.
+        """
+        ratios = signals[column].values.astype(float)
+        index = signals.index
+        month_id = np.asarray(index.year)*12 + np.asarray(index.month) - 1
+        timestamps = index.asi8
+
+        bounds = np.flatnonzero(np.diff(month_id)) + 1
+        starts = np.r_[0, bounds]
+        ends = np.r_[bounds, len(ratios)]
+        n_months = len(starts)
+
+        cache = self._cache.get(key, {})
+        new_cache = {}
+        stats = np.empty((n_months, 4)) # Ratio mean, ratio std, z mean, z std per month
+        for k in range(n_months):
+            s, e = starts[k], ends[k]
+            month_key = (month_id[s], timestamps[s], timestamps[e-1], e-s)
+            cacheable = s >= stable_from and k < n_months-1 # Completed month, no revised rows
+            if cacheable and month_key in cache:
+                stats[k] = cache[month_key]
+                self.months_cached += 1
+            else:
+                r = ratios[s:e]
+                r_mean, r_std = _mean_std(r)
+                z_mean, z_std = _mean_std((r - r_mean)/r_std)
+                stats[k] = (r_mean, r_std, z_mean, z_std)
+                self.months_computed += 1
+            if cacheable:
+                new_cache[month_key] = stats[k]
+        self._cache[key] = new_cache
+
+        # Previous month's z-score statistics, if the previous calendar month is in the window
+        has_prev = np.r_[False, month_id[starts[1:]] - month_id[starts[:-1]] == 1]
+        prev_z_mean = np.where(has_prev, np.r_[np.nan, stats[:-1, 2]], np.nan)
+        prev_z_std = np.where(has_prev, np.r_[np.nan, stats[:-1, 3]], np.nan)
+
+        lengths = ends - starts
+        z = (ratios - np.repeat(stats[:, 0], lengths))/np.repeat(stats[:, 1], lengths)
+        upper = np.repeat(prev_z_mean + prev_z_std*deviations, lengths)
+        lower = np.repeat(prev_z_mean - prev_z_std*deviations, lengths)
+
+        signals["Z"] = z
+        signals["Z upper limit"] = upper
+        signals["Z lower limit"] = lower
+        return signals
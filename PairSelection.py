@@ -0,0 +1,123 @@
+import time
+import numpy as np
+import pandas as pd
+from CointegrationScreen import CointegrationScreen
+
+
+def correlation_matrix(values):
+    """Pearson correlation matrix of the columns of values, from the z-normalised series"""
+    centred = values - values.mean(axis=0)
+    std = centred.std(axis=0)
+    std[std == 0] = np.inf # Constant series are uncorrelated with everything
+    normalised = centred/std
+    return normalised.T.dot(normalised)/len(values)
+
+
+def cluster_labels(corr, n_clusters):
+    """Average-linkage hierarchical clusters of the columns, on the distance 1 - correlation"""
+    from scipy.cluster.hierarchy import linkage, fcluster
+    from scipy.spatial.distance import squareform
+
+    distance = np.clip(1 - corr, 0, 2)
+    np.fill_diagonal(distance, 0)
+    tree = linkage(squareform(distance, checks=False), method="average")
+    return fcluster(tree, t=n_clusters, criterion="maxclust")
+
+
+class PairSelector(object):
+    """
+    Pair-universe selection for StatisticalArbitragePairs: rather than testing every pair
+    of a large APY panel for cointegration (find_cointegrated_pairs), candidate pairs are
+    shortlisted cheaply first, and only those are tested (with CointegrationScreen).
+
+    Candidates are the pairs whose (Pearson) correlation is at least min_correlation,
+    optionally restricted to pairs in the same cluster (n_clusters, hierarchical clustering
+    on 1 - correlation) and to each token's neighbours most correlated with it
+    (max_neighbours). The selected pairs are the candidates cointegrated at the significance
+    level, most significant first.
+
+    The number of pairs in the panel, of candidates tested and of tests avoided are kept
+    after each select, together with the correlation and p-value of every candidate in
+    candidates_. progress is passed on to the CointegrationScreen.
+    """
+
+    def __init__(self, min_correlation=0.7, n_clusters=None, max_neighbours=None, significance=0.05, processes=None,
+            progress=None):
+        self.min_correlation = min_correlation
+        self.n_clusters = n_clusters
+        self.max_neighbours = max_neighbours
+        self.significance = significance
+        self.processes = processes
+        self.progress = progress
+
+        self.candidates_ = None
+        self.total_pairs = 0
+        self.tests_run = 0
+        self.tests_avoided = 0
+        self.wall_time = None
+
+    @staticmethod
+    def _rates(df):
+        return df.select_dtypes(include="number").dropna()
+
+    def candidate_indices(self, values):
+        """(i, j) column index pairs (i < j) shortlisted for the cointegration tests, and the correlations"""
+        n = values.shape[1]
+        corr = correlation_matrix(values)
+        keep = np.triu(corr >= self.min_correlation, k=1)
+
+        if self.n_clusters is not None and n > 1:
+            labels = cluster_labels(corr, self.n_clusters)
+            keep &= labels[:, None] == labels[None, :]
+
+        if self.max_neighbours is not None:
+            # Pairs where either token is among the other's max_neighbours most correlated tokens
+            ranked = corr.copy()
+            np.fill_diagonal(ranked, -np.inf)
+            nearest = np.argsort(-ranked, axis=1)[:, :self.max_neighbours]
+            neighbours = np.zeros((n, n), dtype=bool)
+            neighbours[np.repeat(np.arange(n), nearest.shape[1]), nearest.ravel()] = True
+            keep &= neighbours | neighbours.T
+
+        i, j = np.nonzero(keep)
+        return np.column_stack([i, j]), corr
+
+    def select(self, df, max_pairs=None):
+        """
+        Cointegrated pairs of columns of the APY DataFrame df (non-numeric columns, such as
+        Date, are ignored), most significant first and at most max_pairs of them
+        """
+        start_time = time.perf_counter()
+        rates = self._rates(df)
+        keys = rates.columns.tolist()
+        n = len(keys)
+        pair_indices, corr = self.candidate_indices(rates.values.astype(float))
+
+        self.total_pairs = n*(n-1)//2
+        self.tests_run = len(pair_indices)
+        self.tests_avoided = self.total_pairs - self.tests_run
+
+        candidates = pd.DataFrame({
+            "token_1": [keys[i] for i in pair_indices[:, 0]],
+            "token_2": [keys[j] for j in pair_indices[:, 1]],
+            "correlation": corr[pair_indices[:, 0], pair_indices[:, 1]],
+        }, columns=["token_1", "token_2", "correlation"])
+        if len(pair_indices) > 0:
+            screen = CointegrationScreen(significance=self.significance, processes=self.processes, progress=self.progress)
+            p_value_matrix = screen.run(rates, pair_indices)[0]
+            candidates["pvalue"] = p_value_matrix[pair_indices[:, 0], pair_indices[:, 1]]
+        else:
+            candidates["pvalue"] = np.array([], dtype=float)
+        self.candidates_ = candidates.sort_values("pvalue", kind="stable").reset_index(drop=True)
+
+        selected = self.candidates_[self.candidates_["pvalue"] < self.significance]
+        if max_pairs is not None:
+            selected = selected.iloc[:max_pairs]
+        self.wall_time = time.perf_counter() - start_time
+        return list(zip(selected["token_1"], selected["token_2"]))
+
+    def report(self):
+        """Summary of the last selection"""
+        n_selected = 0 if self.candidates_ is None else int((self.candidates_["pvalue"] < self.significance).sum())
+        return {"total_pairs": self.total_pairs, "tests_run": self.tests_run, "tests_avoided": self.tests_avoided,
+            "selected": n_selected, "wall_time": self.wall_time}
@@ -0,0 +1,169 @@
+import warnings
+import numpy as np
+import pandas as pd
+from event import SignalEvent
+from ApyEngine import timestamps_to_ns, liquidity_index_to_apy, sliding_window_apys
+from CointegrationService import CointegrationService
+from MonthlyZScore import MonthlyZScore
+
+POSITION_MAP = {1: "LONG", -1: "SHORT", 0: "EXIT"}
+
+
+def _z_score(x):
+    """Row-wise z-score, skipping NaNs like pandas"""
+    return (x - np.nanmean(x, axis=1, keepdims=True))/np.nanstd(x, axis=1, ddof=1, keepdims=True)
+
+
+def _last_positions(z, upper, lower):
+    """
+    Execution signal at the last row of each window, from the last two rows of the z-scores
+    and thresholds, following StatisticalArbitragePairs.signal_update_logic
+    """
+    signals = np.select([z > upper, z < lower], [-1, 1], default=0)
+    return signals[:, -1] - signals[:, -2], (-signals[:, -1]) - (-signals[:, -2])
+
+
+def _to_position(diff):
+    # Anything other than -1, 0, 1 (a jump from short to long, or a single row) maps to NaN
+    return POSITION_MAP.get(diff, np.nan)
+
+
+class PairsBacktest(object):
+    """
+    Offline, whole-history version of StatisticalArbitragePairs. Instead of rebuilding the
+    lookback window on every MARKET event, the APYs of every window along the history are
+    computed as one matrix, followed by the ratios, z-scores, thresholds and the entry/exit
+    positions at the end of each window. The resulting SignalEvent stream is identical to
+    running the strategy bar by bar over the same data.
+
+    Only the cointegration checks (non-monthly mode), the monthly regime and the position
+    tracker, which carries over from bar to bar, are stepped through in time, using the
+    same CointegrationService and MonthlyZScore as the strategy.
+
+    The liquidity index panel must be indexed by timestamp with one column per token,
+    and all of the tokens must have a value at every timestamp, so that each pair's APYs
+    share their timestamps as they do after the strategy's inner join.
+    """
+
+    def __init__(self, pairs, lookback_window=30, apy_lookback=5, deviations=1.0, strategy_start="2022-04-01 00:00:00",
+        monthly=False, coint_retest_every=1, coint_drift_threshold=None, coint_fast_adf=False, apy_cache=None,
+        per_pair_positions=False):
+        self.pairs = pairs
+        self.lookback_window = 90 if monthly else lookback_window # As in the strategy
+        self.apy_lookback = apy_lookback
+        self.deviations = deviations
+        self.strategy_start = pd.to_datetime(strategy_start)
+        self.monthly = monthly
+        self.coint_params = dict(retest_every=coint_retest_every, drift_threshold=coint_drift_threshold, fast_adf=coint_fast_adf)
+        self.apy_cache = apy_cache # Optional ApyCache of the APYs over the whole history
+        self.per_pair_positions = per_pair_positions # One position tracker per pair, as in the strategy
+
+        self.positions = None # Per bar and pair positions of the last run, for research
+
+    @classmethod
+    def from_strategy(cls, strategy):
+        backtest = cls(strategy.pairs, apy_lookback=strategy.apy_lookback, deviations=strategy.deviations,
+            strategy_start=strategy.strategy_start, monthly=strategy.monthly, per_pair_positions=strategy.per_pair_positions)
+        backtest.lookback_window = strategy.lookback_window
+        backtest.apy_cache = strategy.apy_engine.cache
+        service = strategy.coint_service
+        backtest.coint_params = dict(retest_every=service.retest_every, drift_threshold=service.drift_threshold,
+            fast_adf=service.fast_adf)
+        return backtest
+
+    def _window_apys(self, timestamps_ns, liq_idx, window, token=None):
+        """APYs of the windows ending at every bar, the leading short windows padded with NaN"""
+        n_bars = len(liq_idx)
+        apys = np.full((n_bars, window-1), np.nan)
+        if n_bars >= window:
+            history_apys = None if self.apy_cache is None else self.apy_cache.apys(token, self.apy_lookback, timestamps_ns, liq_idx)
+            apys[window-1:] = sliding_window_apys(timestamps_ns, liq_idx, self.apy_lookback, window, history_apys)
+        for t in range(min(window-1, n_bars)):
+            apys[t, window-1-t:] = liquidity_index_to_apy(timestamps_ns[:t+1], liq_idx[:t+1], self.apy_lookback)
+        return apys
+
+    def _vectorised_positions(self, ratios):
+        if self.monthly:
+            return None # Stepped through in time, as the thresholds depend on the months in each window
+        z = _z_score(ratios)
+        z_mean = np.nanmean(z, axis=1, keepdims=True)
+        z_std = np.nanstd(z, axis=1, ddof=1, keepdims=True)
+        return _last_positions(z[:, -2:], z_mean + z_std*self.deviations, z_mean - z_std*self.deviations)
+
+    def run(self, liq_panel, events=None):
+        """
+        Run the strategy over the whole liquidity index panel, returning the SignalEvents
+        in the order the strategy would emit them (and also putting them on the events
+        queue, if given)
+        """
+        if liq_panel.isna().values.any():
+            raise ValueError("The liquidity index panel must have a value for every token at every timestamp")
+
+        timestamps = liq_panel.index
+        timestamps_ns = timestamps_to_ns(timestamps)
+        window = self.lookback_window + 1
+        n_bars = len(timestamps)
+        active = np.flatnonzero(timestamps >= self.strategy_start)
+        if len(active) > 0 and active[0] == 0:
+            raise ValueError("The strategy needs at least two bars of history before strategy_start")
+
+        tokens = sorted({token for pair in self.pairs for token in pair})
+        apys = {token: self._window_apys(timestamps_ns, liq_panel[token].values.astype(float), window, token) for token in tokens}
+
+        # Per pair ratios, z-scores, thresholds and positions for all windows at once
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning) # Windows with too few APYs give NaN, as in pandas
+            pair_positions = [self._vectorised_positions(apys[pair[0]]/apys[pair[1]]) for pair in self.pairs]
+
+        coint_service = CointegrationService(**self.coint_params)
+        monthly_z_score = MonthlyZScore()
+        index_values = timestamps.values
+        prior_positions = ["EXIT"]*(len(self.pairs) if self.per_pair_positions else 1)
+        emitted = []
+        records = []
+        for t in active:
+            lo = max(0, t+1-window) # First rate in the window
+            time = timestamps[t]
+            position_tracker = prior_positions[0]
+            for k, pair in enumerate(self.pairs):
+                slot = k if self.per_pair_positions else 0
+                if self.per_pair_positions:
+                    position_tracker = prior_positions[slot]
+                a1 = apys[pair[0]][t, window-1-(t-lo):]
+                a2 = apys[pair[1]][t, window-1-(t-lo):]
+
+                if self.monthly and t-lo < 2:
+                    position1 = position2 = np.nan # A single APY, so no previous row to take the difference with
+                elif self.monthly:
+                    signals = pd.DataFrame({"Ratios": a1/a2}, index=timestamps[lo+1:t+1])
+                    signals = monthly_z_score.apply(pair, signals, deviations=self.deviations, stable_from=self.apy_lookback)
+                    diff1, diff2 = _last_positions(signals["Z"].values[None, -2:], signals["Z upper limit"].values[None, -2:],
+                        signals["Z lower limit"].values[None, -2:])
+                    position1, position2 = _to_position(diff1[0]), _to_position(diff2[0])
+                else:
+                    pvalue = coint_service.pvalue(pair, a1, a2, index=index_values[lo+1:t+1])
+                    if pvalue >= 0.05:
+                        # Not cointegrated, unwind existing trades and reset with EXIT
+                        if position_tracker == "LONG":
+                            emitted += [SignalEvent(pair[0], "SHORT", time), SignalEvent(pair[1], "LONG", time)]
+                        if position_tracker == "SHORT":
+                            emitted += [SignalEvent(pair[0], "LONG", time), SignalEvent(pair[1], "SHORT", time)]
+                        emitted += [SignalEvent(pair[0], "EXIT", time), SignalEvent(pair[1], "EXIT", time)]
+                        prior_positions[slot] = "EXIT"
+                        records.append((time, pair, "EXIT"))
+                        continue
+                    if t-lo < 2:
+                        position1 = position2 = np.nan
+                    else:
+                        position1, position2 = _to_position(pair_positions[k][0][t]), _to_position(pair_positions[k][1][t])
+
+                if position1 != prior_positions[slot]:
+                    emitted += [SignalEvent(pair[0], position1, time), SignalEvent(pair[1], position2, time)]
+                    prior_positions[slot] = position1
+                records.append((time, pair, position1))
+
+        self.positions = pd.DataFrame(records, columns=["Date", "Pair", "Position"])
+        if events is not None:
+            for signal in emitted:
+                events.put(signal)
+        return emitted
@@ -0,0 +1,208 @@
+import os
+import json
+import time
+import hashlib
+import numpy as np
+import pandas as pd
+from itertools import product
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from ColumnarRates import ColumnarRatesStore
+from ApyCache import fingerprint
+
+_PANEL = {} # Rates panel of the worker processes, attached from shared memory
+
+
+def parameter_grid(grid):
+    """All combinations of the parameter values in grid (name -> list of values), as dicts"""
+    keys = list(grid)
+    return [dict(zip(keys, values)) for values in product(*(grid[k] for k in keys))]
+
+
+def config_id(config):
+    """Stable identifier of a run configuration, used to resume a sweep"""
+    return hashlib.sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+
+def panel_fingerprint(timestamps_ns, liq_idx, tokens, tz):
+    """Fingerprint of a rates panel, to tell whether saved results were run on it"""
+    return hashlib.sha1(json.dumps([fingerprint(timestamps_ns, liq_idx), tokens, tz], default=str).encode()).hexdigest()[:16]
+
+
+class _EventList(list):
+    """Events queue for the sweep runs, which just collects the signals"""
+
+    def put(self, event):
+        self.append(event)
+
+    def put_many(self, events):
+        self.extend(events)
+
+
+def _attach_panel(shm_names, shape, tokens, tz):
+    timestamps_shm = shared_memory.SharedMemory(name=shm_names[0])
+    liq_shm = shared_memory.SharedMemory(name=shm_names[1])
+    _PANEL.update(
+        shm=(timestamps_shm, liq_shm), # Keep the blocks open for the lifetime of the worker
+        timestamps_ns=np.ndarray((shape[0],), dtype=np.int64, buffer=timestamps_shm.buf),
+        liq_idx=np.ndarray(shape, dtype=np.float64, buffer=liq_shm.buf),
+        tokens=tokens, tz=tz,
+    )
+
+
+def _panel_index(timestamps_ns, tz):
+    index = pd.DatetimeIndex(timestamps_ns.astype("datetime64[ns]"))
+    return index if tz is None else index.tz_localize("UTC").tz_convert(tz)
+
+
+def _run_pairs(config, timestamps_ns, liq_idx, tokens, tz):
+    from PairsBacktest import PairsBacktest
+
+    panel = pd.DataFrame(liq_idx, index=_panel_index(timestamps_ns, tz), columns=tokens)
+    params = dict(config["fixed"], **config["params"])
+    params["pairs"] = [tuple(pair) for pair in params["pairs"]]
+    backtest = PairsBacktest(**params)
+    return [(str(s.timestamp), s.token, str(s.signal_type), 1) for s in backtest.run(panel)]
+
+
+def _run_kalman(config, timestamps_ns, liq_idx, tokens, tz):
+    from event import MarketEvent
+    from KalmanFilterStatArb import KalmanFilterStatArb
+
+    params = dict(config["fixed"], **config["params"])
+    basket = params.pop("tokens", tokens)
+    columns = [tokens.index(token) for token in basket]
+    rates = ColumnarRatesStore(basket, capacity=max(params.get("lookback_window", 10), 2))
+    events = _EventList()
+    strategy = KalmanFilterStatArb(events, rates, sized_signals=True, **params)
+    index = _panel_index(timestamps_ns, tz)
+    for t in range(len(timestamps_ns)):
+        rates.update_bar(index[t], liq_idx[t, columns])
+        if t > 0: # The strategy needs two rates for an APY
+            strategy.calculate_signals(MarketEvent())
+    return [(str(s.timestamp), s.token, s.signal_type, s.quantity) for s in events]
+
+
+RUNNERS = {"pairs": _run_pairs, "kalman": _run_kalman}
+
+
+def summarise_signals(signals):
+    """Summary metrics of a signal stream of (timestamp, token, signal_type, quantity)"""
+    types = [s[2] for s in signals]
+    return {
+        "n_signals": len(signals),
+        "n_long": types.count("LONG"),
+        "n_short": types.count("SHORT"),
+        "n_exit": types.count("EXIT"),
+        "units_traded": int(sum(s[3] for s in signals if s[2] in ("LONG", "SHORT"))),
+        "first_signal": signals[0][0] if signals else None,
+        "last_signal": signals[-1][0] if signals else None,
+    }
+
+
+def run_config(config):
+    """Run one configuration on the shared rates panel, returning its result record"""
+    start = time.perf_counter()
+    signals = RUNNERS[config["strategy"]](config, _PANEL["timestamps_ns"], _PANEL["liq_idx"], _PANEL["tokens"], _PANEL["tz"])
+    metrics = summarise_signals(signals)
+    metrics["seconds"] = time.perf_counter() - start
+    return {"id": config_id(config), "config": config, "metrics": metrics, "signals": signals}
+
+
+class ParameterSweep(object):
+    """
+    Parameter sweep over StatisticalArbitragePairs (strategy="pairs", run with the
+    vectorised PairsBacktest) or KalmanFilterStatArb (strategy="kalman", replayed bar by
+    bar through a ColumnarRatesStore).
+
+    The liquidity index panel (timestamps by tokens) is copied once into shared memory,
+    and every combination of the grid, together with the fixed parameters (e.g. the pairs
+    and strategy_start, or the tokens of the Kalman basket), is run across a process pool
+    (processes=1 runs them in this process). Each finished run is appended to results_path
+    as one JSON line with its configuration, summary metrics, signal stream and the
+    fingerprint of the panel, and when the sweep is rerun on the same panel, configurations
+    already in the file are skipped, so an interrupted sweep resumes where it stopped. The
+    results of a different (e.g. extended) panel are ignored, and the configurations rerun.
+    """
+
+    def __init__(self, strategy, grid, fixed=None, processes=None, results_path=None):
+        if strategy not in RUNNERS:
+            raise ValueError(f"Unknown strategy {strategy}, expected one of {list(RUNNERS)}")
+        self.strategy = strategy
+        self.grid = grid
+        self.fixed = fixed or {}
+        self.processes = processes
+        self.results_path = results_path
+
+        self.results = None # Summary table of the last run, one row per configuration
+        self.signals = {} # Signal stream per configuration id
+
+    def configs(self):
+        return [{"strategy": self.strategy, "fixed": self.fixed, "params": params} for params in parameter_grid(self.grid)]
+
+    def _load_results(self, panel):
+        """The saved results of the configurations run on the panel with that fingerprint"""
+        records = {}
+        if self.results_path is not None and os.path.exists(self.results_path):
+            with open(self.results_path) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue # Partially written line from an interrupted run
+                    if record.get("panel") == panel:
+                        records[record["id"]] = record
+        return records
+
+    def _save_result(self, record, panel):
+        record["panel"] = panel
+        if self.results_path is not None:
+            with open(self.results_path, "a") as f:
+                f.write(json.dumps(record, default=str) + "\n")
+
+    def run(self, liq_panel):
+        """
+        Run all configurations of the grid not already in the results file on the liquidity
+        index panel, returning the summary table of all of them
+        """
+        timestamps_ns = liq_panel.index.as_unit("ns").asi8
+        liq_idx = np.ascontiguousarray(liq_panel.values, dtype=np.float64)
+        tokens = liq_panel.columns.tolist()
+        tz = None if liq_panel.index.tz is None else str(liq_panel.index.tz)
+
+        configs = self.configs()
+        panel = panel_fingerprint(timestamps_ns, liq_idx, tokens, tz)
+        records = self._load_results(panel)
+        todo = [config for config in configs if config_id(config) not in records]
+
+        if self.processes == 1 or len(todo) <= 1:
+            _PANEL.update(timestamps_ns=timestamps_ns, liq_idx=liq_idx, tokens=tokens, tz=tz)
+            for config in todo:
+                record = run_config(config)
+                records[record["id"]] = record
+                self._save_result(record, panel)
+        elif todo:
+            blocks = [shared_memory.SharedMemory(create=True, size=a.nbytes) for a in (timestamps_ns, liq_idx)]
+            try:
+                np.ndarray(timestamps_ns.shape, dtype=np.int64, buffer=blocks[0].buf)[:] = timestamps_ns
+                np.ndarray(liq_idx.shape, dtype=np.float64, buffer=blocks[1].buf)[:] = liq_idx
+                with ProcessPoolExecutor(max_workers=self.processes, initializer=_attach_panel,
+                        initargs=([b.name for b in blocks], liq_idx.shape, tokens, tz)) as pool:
+                    futures = [pool.submit(run_config, config) for config in todo]
+                    for future in as_completed(futures):
+                        record = future.result()
+                        records[record["id"]] = record
+                        self._save_result(record, panel)
+            finally:
+                for block in blocks:
+                    block.close()
+                    block.unlink()
+
+        rows = []
+        self.signals = {}
+        for config in configs:
+            record = records[config_id(config)]
+            rows.append(dict(id=record["id"], **config["params"], **record["metrics"]))
+            self.signals[record["id"]] = pd.DataFrame(record["signals"], columns=["Date", "Token", "Signal", "Quantity"])
+        self.results = pd.DataFrame(rows).set_index("id")
+        return self.results
@@ -0,0 +1,265 @@
+import asyncio
+import time
+from collections import deque
+import numpy as np
+import pandas as pd
+from event import MarketEvent
+
+
+def parse_rate_line(line):
+    """
+    (timestamp, liquidity index) of a "timestamp,liquidity_index" feed line, with the
+    timestamp either as a date string or in epoch seconds, or None for blank, header or
+    malformed lines
+    """
+    parts = line.strip().split(",")
+    if len(parts) != 2:
+        return None
+    try:
+        liq_idx = float(parts[1])
+        timestamp = parts[0].strip()
+        try:
+            timestamp = pd.Timestamp(float(timestamp), unit="s", tz="UTC")
+        except ValueError:
+            timestamp = pd.Timestamp(timestamp)
+    except ValueError:
+        return None
+    return timestamp, liq_idx
+
+
+class FileFeed(object):
+    """
+    Liquidity index feed of one pool read from a local file of "timestamp,liquidity_index"
+    lines, as a stand-in for a live feed. With follow=True the file is polled for new lines
+    every poll_interval seconds (as with tail -f) until the task is cancelled.
+    """
+
+    def __init__(self, token, path, follow=False, poll_interval=1.0):
+        self.token = token
+        self.path = path
+        self.follow = follow
+        self.poll_interval = poll_interval
+        self.malformed = 0
+
+    async def __aiter__(self):
+        with open(self.path) as f:
+            while True:
+                line = f.readline()
+                if not line:
+                    if not self.follow:
+                        return
+                    await asyncio.sleep(self.poll_interval)
+                    continue
+                rate = parse_rate_line(line)
+                if rate is None:
+                    self.malformed += 1
+                    continue
+                yield rate
+                await asyncio.sleep(0) # Let the other feeds run
+
+
+class SocketFeed(object):
+    """
+    Liquidity index feed of one pool over a TCP socket: the token is sent on connection,
+    followed by a newline, and "timestamp,liquidity_index" lines are read until the server
+    closes the connection (see serve_feeds for a local stand-in server)
+    """
+
+    def __init__(self, token, host="127.0.0.1", port=8765):
+        self.token = token
+        self.host = host
+        self.port = port
+        self.malformed = 0
+
+    async def __aiter__(self):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(f"{self.token}\n".encode())
+            await writer.drain()
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                rate = parse_rate_line(line.decode())
+                if rate is None:
+                    self.malformed += 1
+                    continue
+                yield rate
+        finally:
+            writer.close()
+
+
+async def serve_feeds(rates, host="127.0.0.1", port=0, interval=0.0):
+    """
+    Local stand-in for the pools' feed server: each connection names a token, and is sent
+    that token's (timestamp, liquidity index) rows from the rates dict, one line every
+    interval seconds, before the connection is closed. Returns the asyncio server (port=0
+    picks a free port, see server.sockets[0].getsockname()).
+    """
+    async def handle(reader, writer):
+        token = (await reader.readline()).decode().strip()
+        try:
+            for timestamp, liq_idx in rates.get(token, []):
+                writer.write(f"{pd.Timestamp(timestamp).isoformat()},{float(liq_idx)!r}\n".encode())
+                await writer.drain()
+                if interval:
+                    await asyncio.sleep(interval)
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+class RateIngestor(object):
+    """
+    Concurrent ingestion of the liquidity index feeds of many pools into a ColumnarRatesStore,
+    aligned on a common timestamp grid, with one MARKET event per published bar.
+
+    Every feed is read in its own asyncio task. The grid has a bar every freq, from origin (by
+    default the first grid time at which every feed has an observation), and the bar at grid
+    time g holds each token's latest liquidity index observed at or before g. A bar is published
+    once every running feed has reached g, so that a slow feed holds the others back, unless
+    max_delay seconds have passed since the first feed reached it. Feeds that have finished do
+    not hold bars back, and the remaining bars are published when all feeds have finished.
+
+    A token's value is stale when it was observed more than max_staleness before the bar (None
+    never treats values as stale, forward-filling the latest one). on_stale sets what is done
+    with bars with stale (or missing) tokens: "nan" publishes them with NaN for those tokens,
+    "hold" with the stale values, and "skip" does not publish the bar.
+
+    Observations older than the token's previous one are dropped (counted in out_of_order).
+    """
+
+    def __init__(self, store, feeds, events=None, freq="1D", origin=None, max_staleness=None, on_stale="nan", max_delay=None):
+        if on_stale not in ("nan", "hold", "skip"):
+            raise ValueError(f"Unknown on_stale policy: {on_stale}")
+        self.store = store
+        self.feeds = list(feeds)
+        self.events = events
+        self.freq_ns = pd.Timedelta(freq).value
+        self.origin = origin
+        self.max_staleness_ns = None if max_staleness is None else pd.Timedelta(max_staleness).value
+        self.on_stale = on_stale
+        self.max_delay = max_delay
+
+        tokens = [feed.token for feed in self.feeds]
+        self._columns = {token: store.token_list.index(token) for token in tokens}
+        self._pending = {token: deque() for token in tokens} # Observations after the last published bar
+        self._current = {token: None for token in tokens} # Latest (timestamp_ns, liq_idx) at or before the last bar
+        self._last_ns = {token: None for token in tokens}
+        self._running = set(tokens)
+        self._next_bar = None if origin is None else pd.Timestamp(origin).value
+        self._tz = None
+        self._due_since = None
+
+        # Counters
+        self.observations = 0
+        self.out_of_order = 0
+        self.bars_published = 0
+        self.bars_skipped = 0
+        self.stale_values = 0
+        self.forced_bars = 0
+
+    def on_rate(self, token, timestamp, liq_idx):
+        """Add one observation of a token, publishing the bars it completes"""
+        timestamp = pd.Timestamp(timestamp)
+        if timestamp.tzinfo is not None:
+            self._tz = timestamp.tzinfo
+        timestamp_ns = timestamp.value
+        last_ns = self._last_ns[token]
+        if last_ns is not None and timestamp_ns < last_ns:
+            self.out_of_order += 1
+            return
+        self.observations += 1
+        self._pending[token].append((timestamp_ns, liq_idx))
+        self._last_ns[token] = timestamp_ns
+        self._publish_ready()
+
+    def _start_grid(self):
+        """First grid time, once every running feed has a first observation"""
+        if self._next_bar is not None:
+            return True
+        firsts = [self._pending[token][0][0] for token in self._pending if self._pending[token]]
+        if any(self._last_ns[token] is None for token in self._running) or not firsts:
+            return False
+        first = max(firsts) # The first grid time with a value for every token
+        self._next_bar = -(-first//self.freq_ns)*self.freq_ns # Ceiling to the grid
+        return True
+
+    def _watermark(self):
+        """Latest grid time all running feeds have reached (all feeds, once they have finished)"""
+        if self._running:
+            return min(self._last_ns[token] for token in self._running)
+        reached = [ns for ns in self._last_ns.values() if ns is not None]
+        return max(reached) if reached else None
+
+    def _publish_ready(self):
+        if not self._start_grid():
+            return
+        watermark = self._watermark()
+        while watermark is not None and self._next_bar <= watermark:
+            self._publish(self._next_bar)
+        self._due_since = None
+
+    def _publish(self, bar_ns):
+        row = np.full(len(self.store.token_list), np.nan)
+        stale = False
+        for token, pending in self._pending.items():
+            while pending and pending[0][0] <= bar_ns:
+                self._current[token] = pending.popleft()
+            current = self._current[token]
+            if current is None or (self.max_staleness_ns is not None and bar_ns - current[0] > self.max_staleness_ns):
+                stale = True
+                self.stale_values += 1
+                if current is None or self.on_stale != "hold":
+                    continue
+            row[self._columns[token]] = current[1]
+        self._next_bar = bar_ns + self.freq_ns
+
+        if stale and self.on_stale == "skip":
+            self.bars_skipped += 1
+            return
+        timestamp = pd.Timestamp(bar_ns) if self._tz is None else pd.Timestamp(bar_ns, tz="UTC").tz_convert(self._tz)
+        self.store.update_bar(timestamp, row)
+        self.bars_published += 1
+        if self.events is not None:
+            self.events.put(MarketEvent())
+
+    def _force_due_bar(self):
+        """Publish the next bar if some feed has reached it more than max_delay seconds ago"""
+        if self._next_bar is None:
+            return
+        reached = [ns for ns in self._last_ns.values() if ns is not None and ns >= self._next_bar]
+        if not reached:
+            self._due_since = None
+            return
+        now = time.monotonic()
+        if self._due_since is None:
+            self._due_since = now
+        elif now - self._due_since >= self.max_delay:
+            self._publish(self._next_bar)
+            self.forced_bars += 1
+            self._due_since = None
+
+    async def _consume(self, feed):
+        try:
+            async for timestamp, liq_idx in feed:
+                self.on_rate(feed.token, timestamp, liq_idx)
+        finally:
+            self._running.discard(feed.token)
+            self._publish_ready()
+
+    async def _watch_delays(self):
+        while True:
+            await asyncio.sleep(self.max_delay/4)
+            self._force_due_bar()
+
+    async def run(self):
+        """Read all feeds until they finish, publishing the aligned bars as they complete"""
+        watcher = asyncio.create_task(self._watch_delays()) if self.max_delay is not None else None
+        try:
+            await asyncio.gather(*[self._consume(feed) for feed in self.feeds])
+        finally:
+            if watcher is not None:
+                watcher.cancel()
+        return self.bars_published
@@ -0,0 +1,132 @@
+import numpy as np
+import pandas as pd
+from statsmodels.tsa.adfvalues import mackinnonp
+
+
+def window_sums(values, window):
+    """Sums over every window of window consecutive rows (along the first axis), from cumulative sums"""
+    cumulative = np.cumsum(values, axis=0)
+    sums = cumulative[window-1:].copy()
+    sums[1:] -= cumulative[:-window]
+    return sums
+
+
+def rolling_hedge_ratios(y, x, window, intercept=False):
+    """
+    Hedge ratios of the OLS regressions of y on x (y ~ x, as in perform_stationarity_test,
+    or y ~ c + x with intercept=True) over every window of window bars, from cumulative
+    sums of x, y, x*x and x*y. Returns the hedge ratios and intercepts (zero without
+    intercept) of the windows ending at bars window-1, ..., len(y)-1.
+    """
+    sums = window_sums(np.column_stack([x, y, x*x, x*y]), window)
+    sx, sy, sxx, sxy = sums.T
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if not intercept:
+            return sxy/sxx, np.zeros(len(sums))
+        beta = (sxy - sx*sy/window)/(sxx - sx*sx/window)
+    return beta, (sy - beta*sx)/window
+
+
+def rolling_adf(y, x, betas, window, adf_lags=1):
+    """
+    ADF statistics (with a constant and a fixed number of lags, as adfuller with
+    autolag=None) of the spreads y - beta*x over every window of window bars, each window
+    with its own hedge ratio.
+
+    The spread is linear in the hedge ratio, so the moments of every window's ADF regression
+    (constant, lagged spread and lagged spread differences, against the spread difference)
+    are quadratic forms in beta of the moments of the lagged levels and differences of x
+    and y. These are taken over all windows at once from cumulative sums, and all of the
+    regressions are solved as one batch.
+    """
+    n_bars = len(y)
+    n_rows = window - 1 - adf_lags # ADF regression rows per window
+    k = 2 + adf_lags # Constant, lagged spread and lagged differences
+    if n_rows <= k:
+        raise ValueError(f"A window of {window} bars is too short for an ADF regression with {adf_lags} lags")
+
+    # Base series for the regression rows t = adf_lags+1, ..., n_bars-1: constant, lagged
+    # levels, lagged differences and differences, each for y and x
+    dy, dx = np.diff(y), np.diff(x)
+    t = np.arange(adf_lags+1, n_bars)
+    base = [np.ones(len(t)), y[t-1], x[t-1]]
+    for lag in range(1, adf_lags+1):
+        base += [dy[t-1-lag], dx[t-1-lag]]
+    base += [dy[t-1], dx[t-1]]
+    base = np.column_stack(base)
+    moments = window_sums(np.einsum("ti,tj->tij", base, base), n_rows) # (windows, base, base)
+
+    # Regressors and target as combinations of the base series: A0 + beta*A1
+    n_base = base.shape[1]
+    A0 = np.zeros((n_base, k+1))
+    A1 = np.zeros((n_base, k+1))
+    A0[0, 0] = 1.0
+    for c in range(1, k+1):
+        A0[2*c-1, c] = 1.0 # y part (lagged level, lagged differences, then the difference)
+        A1[2*c, c] = -1.0 # x part
+    A = A0[None] + betas[:, None, None]*A1[None]
+    G = np.einsum("wbi,wbc,wcj->wij", A, moments, A)
+
+    XtX, Xty, yy = G[:, :k, :k], G[:, :k, k], G[:, k, k]
+    XtX_inv = np.linalg.pinv(XtX)
+    params = np.einsum("wij,wj->wi", XtX_inv, Xty)
+    ssr = yy - np.einsum("wi,wi->w", params, Xty)
+    sigma2 = np.maximum(ssr, 0)/(n_rows - k)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return params[:, 1]/np.sqrt(sigma2*XtX_inv[:, 1, 1])
+
+
+class RollingDiagnostics(object):
+    """
+    Rolling version of perform_stationarity_test: rather than one OLS and one ADF test per
+    pair over a fixed term, the hedge ratio, spread and ADF statistic (and p-value) of every
+    pair over a sliding window of window bars, at every bar of the history.
+
+    The hedge ratios come from cumulative sums (rolling_hedge_ratios) and the ADF tests of
+    all of the windows of a pair are solved as one batch (rolling_adf), always with exactly
+    adf_lags lags, as adfuller(spread, maxlag=adf_lags, autolag=None). perform_stationarity_test
+    instead calls adfuller(spread, maxlag=1) with the default autolag="AIC", which picks 0 or
+    1 lags, so on a window where AIC picks 0 lags its statistic differs from the one here.
+    """
+
+    def __init__(self, window=90, adf_lags=1, intercept=False):
+        self.window = window
+        self.adf_lags = adf_lags
+        self.intercept = intercept
+
+    def pair(self, y, x, index=None):
+        """
+        Rolling diagnostics of y against x, one row per window, indexed by the window's last bar:
+        hedge ratio, intercept, latest spread value and ADF statistic and p-value of the spread
+        """
+        y = np.asarray(y, dtype=float)
+        x = np.asarray(x, dtype=float)
+        index = pd.RangeIndex(len(y)) if index is None else index
+        columns = ["hedge_ratio", "intercept", "spread", "adf_statistic", "adf_pvalue"]
+        if len(y) < self.window:
+            return pd.DataFrame(columns=columns, index=index[:0])
+
+        betas, alphas = rolling_hedge_ratios(y, x, self.window, intercept=self.intercept)
+        adf = rolling_adf(y, x, betas, self.window, adf_lags=self.adf_lags)
+        end = slice(self.window-1, len(y))
+        pvalues = np.array([mackinnonp(stat, regression="c", N=1) if np.isfinite(stat) else np.nan for stat in adf])
+        return pd.DataFrame({
+            "hedge_ratio": betas,
+            "intercept": alphas,
+            "spread": y[end] - alphas - betas*x[end],
+            "adf_statistic": adf,
+            "adf_pvalue": pvalues,
+        }, index=index[end], columns=columns)
+
+    def run(self, df, pairs, label=" APY"):
+        """
+        Rolling diagnostics of every pair of an APY DataFrame (with a Date column, as for
+        perform_stationarity_test), indexed by (token_1, token_2, Date), so that one pair is
+        df.loc[(token_1, token_2)]
+        """
+        frames = {}
+        for pair in pairs:
+            train = df[["Date", pair[0]+label, pair[1]+label]].dropna()
+            frames[tuple(pair)] = self.pair(train[pair[0]+label].values, train[pair[1]+label].values,
+                index=pd.DatetimeIndex(train["Date"], name="Date"))
+        return pd.concat(frames, names=["token_1", "token_2"])
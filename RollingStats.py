@@ -0,0 +1,152 @@
+import numpy as np
+
+
+class RollingWindowStats(object):
+    """
+    Fixed-capacity ring buffer holding the most recent values of a series (e.g. the
+    Kalman filter forecast errors or the Johansen spread), with the moving mean and
+    moving (population) std maintained by Welford updates, so that both are available
+    in constant time after each new value.
+
+    Unfilled slots during the warm-up are tracked with an explicit count, rather than
+    by treating values of exactly 0 as empty, so genuine zeros count towards the statistics.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("RollingWindowStats capacity must be at least 1")
+        self.capacity = capacity
+        self.values = np.zeros(capacity)
+        self.count = 0 # Number of filled slots, at most the capacity
+        self.head = 0 # Next slot to write to, i.e. the oldest value once the buffer is full
+        self._mean = 0.0
+        self._m2 = 0.0 # Sum of squared deviations from the mean
+        self._updates_since_resync = 0
+
+    # When the value leaving the window dominated the spread of the window (e.g. a warm-up
+    # outlier) the Welford downdate cancels catastrophically, so recompute from the buffer
+    _RESYNC_RATIO = 1e4
+
+    @property
+    def ready(self):
+        """The warm-up is over once every slot in the lookback has been filled"""
+        return self.count == self.capacity
+
+    @property
+    def mean(self):
+        return np.float64(self._mean) if self.count > 0 else np.float64(np.nan)
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return np.float64(np.nan)
+        return np.sqrt(max(self._m2, 0.0)/self.count)
+
+    def window(self):
+        """Values currently in the window, oldest first"""
+        if self.count < self.capacity:
+            return self.values[:self.count].copy()
+        return np.roll(self.values, -self.head)
+
+    def push(self, value):
+        value = float(value)
+        resync = False
+        if self.count < self.capacity:
+            # Warm-up: standard Welford update with a growing count
+            self.count += 1
+            delta = value - self._mean
+            self._mean += delta/self.count
+            self._m2 += delta*(value - self._mean)
+        else:
+            # Full buffer: replace the oldest value, keeping the count fixed
+            old = self.values[self.head]
+            old_mean = self._mean
+            self._mean += (value - old)/self.count
+            self._m2 += (value - old)*(value - self._mean + old - old_mean)
+            resync = (old - old_mean)**2 > self._RESYNC_RATIO*max(self._m2, 0.0)
+        self.values[self.head] = value
+        self.head = (self.head + 1) % self.capacity
+
+        # Also recompute from the buffer once per full cycle to stop rounding errors from
+        # accumulating over long runs (amortised constant time)
+        self._updates_since_resync += 1
+        if resync or self._updates_since_resync >= self.capacity:
+            self._resync()
+
+    def reset(self):
+        self.values[:] = 0.0
+        self.count = 0
+        self.head = 0
+        self._mean = 0.0
+        self._m2 = 0.0
+        self._updates_since_resync = 0
+
+    def get_state(self):
+        """The buffer and the [count, head, mean, m2, updates since resync] of the window, for checkpoints"""
+        return self.values.copy(), np.array([self.count, self.head, self._mean, self._m2, self._updates_since_resync], dtype=float)
+
+    def set_state(self, values, stats):
+        self.values[:] = values
+        count, head, self._mean, self._m2, updates = stats
+        self.count, self.head, self._updates_since_resync = int(count), int(head), int(updates)
+
+    def _resync(self):
+        filled = self.values[:self.count]
+        self._mean = filled.mean()
+        self._m2 = ((filled - self._mean)**2).sum()
+        self._updates_since_resync = 0
+
+
+class BatchedRollingWindowStats(object):
+    """
+    RollingWindowStats for many series that all advance together (e.g. one per basket),
+    stored as a (series, capacity) array so that each bar is a single vectorised update.
+    The statistics are recomputed from the buffer once per full cycle.
+    """
+
+    def __init__(self, n_series, capacity):
+        if capacity < 1:
+            raise ValueError("BatchedRollingWindowStats capacity must be at least 1")
+        self.capacity = capacity
+        self.values = np.zeros((n_series, capacity))
+        self.count = 0
+        self.head = 0
+        self.mean = np.full(n_series, np.nan)
+        self._m2 = np.zeros(n_series)
+        self._updates_since_resync = 0
+
+    @property
+    def ready(self):
+        return self.count == self.capacity
+
+    @property
+    def std(self):
+        if self.count == 0:
+            return np.full(len(self.mean), np.nan)
+        return np.sqrt(np.maximum(self._m2, 0.0)/self.count)
+
+    def push(self, values):
+        values = np.asarray(values, dtype=float)
+        if self.count < self.capacity:
+            self.count += 1
+            if self.count == 1:
+                self.mean = np.zeros(len(values))
+            delta = values - self.mean
+            self.mean = self.mean + delta/self.count
+            self._m2 = self._m2 + delta*(values - self.mean)
+            resync = False
+        else:
+            old = self.values[:, self.head]
+            old_mean = self.mean
+            self.mean = old_mean + (values - old)/self.count
+            self._m2 = self._m2 + (values - old)*(values - self.mean + old - old_mean)
+            resync = np.any((old - old_mean)**2 > RollingWindowStats._RESYNC_RATIO*np.maximum(self._m2, 0.0))
+        self.values[:, self.head] = values
+        self.head = (self.head + 1) % self.capacity
+
+        self._updates_since_resync += 1
+        if resync or self._updates_since_resync >= self.capacity:
+            filled = self.values[:, :self.count]
+            self.mean = filled.mean(axis=1)
+            self._m2 = ((filled - self.mean[:, None])**2).sum(axis=1)
+            self._updates_since_resync = 0
@@ -0,0 +1,224 @@
+import os
+import traceback
+import multiprocessing
+import numpy as np
+import pandas as pd
+from strategy import Strategy
+from event import MarketEvent
+from ColumnarRates import ColumnarRatesStore
+
+
+def pair_strategy(rates, events, pair, **kwargs):
+    """StatisticalArbitragePairs on one pair, with its own position tracker"""
+    from StatisticalArbitragePairs import StatisticalArbitragePairs
+
+    if not kwargs.pop("per_pair_positions", True):
+        raise ValueError("The shared position tracker couples all of the pairs, so they cannot be sharded")
+    return StatisticalArbitragePairs(rates, events, [tuple(pair)], per_pair_positions=True, **kwargs)
+
+
+def multi_strategy(rates, events, basket, **kwargs):
+    """StatArbMultiTrade on one basket (the tokens of its rates)"""
+    from StatArbMultiTrade import StatArbMultiTrade
+    return StatArbMultiTrade(events, rates, **kwargs)
+
+
+def kalman_strategy(rates, events, basket, **kwargs):
+    """KalmanFilterStatArb on one basket (the tokens of its rates)"""
+    from KalmanFilterStatArb import KalmanFilterStatArb
+    return KalmanFilterStatArb(events, rates, **kwargs)
+
+
+BUILDERS = {"pairs": pair_strategy, "multi": multi_strategy, "kalman": kalman_strategy}
+
+
+class _UnitEvents(list):
+    """Events queue of one unit, which collects its signals until they are merged"""
+
+    def put(self, event):
+        self.append(event)
+
+    def put_many(self, events):
+        self.extend(events)
+
+
+class _Shard(object):
+    """
+    The units (pairs or baskets) run by one worker, each with its own strategy and its own
+    copy of the columns of the rates it trades
+    """
+
+    def __init__(self, build, units, unit_indices, columns, capacity, kwargs):
+        self.unit_indices = list(unit_indices)
+        self.stores, self.queues, self.strategies, self.columns = [], [], [], []
+        for unit in units:
+            tokens = list(unit)
+            store = ColumnarRatesStore(tokens, capacity=capacity)
+            queue = _UnitEvents()
+            self.stores.append(store)
+            self.queues.append(queue)
+            self.strategies.append(build(store, queue, unit, **kwargs))
+            self.columns.append([columns[token] for token in tokens])
+        self._latest_ns = None
+
+    def step(self, timestamps_ns, rows, tz):
+        """
+        Add the new bars (the latest one again if it was revised in place) and run every unit
+        on the MARKET event, returning the (unit index, seq, signal) of the signals
+        """
+        for timestamp_ns, row in zip(timestamps_ns, rows):
+            timestamp = pd.Timestamp(timestamp_ns) # Naive, so that the stores keep the timezone set here
+            for store, columns in zip(self.stores, self.columns):
+                store.tz = tz
+                if timestamp_ns == self._latest_ns:
+                    for token, value in zip(store.token_list, row[columns]):
+                        store.update(token, timestamp, value)
+                else:
+                    store.update_bar(timestamp, row[columns])
+            self._latest_ns = timestamp_ns
+
+        signals = []
+        event = MarketEvent()
+        for unit_index, strategy, queue in zip(self.unit_indices, self.strategies, self.queues):
+            strategy.calculate_signals(event)
+            signals.extend((unit_index, seq, signal) for seq, signal in enumerate(queue))
+            queue.clear()
+        return signals
+
+
+def _run_shard(conn, build, units, unit_indices, columns, capacity, kwargs):
+    """Worker loop: one (timestamps, rows, tz) message per MARKET event, answered with the shard's signals"""
+    try:
+        shard = _Shard(build, units, unit_indices, columns, capacity, kwargs)
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+        return
+    conn.send(("ready", None))
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        try:
+            conn.send(("signals", shard.step(*message)))
+        except Exception:
+            conn.send(("error", traceback.format_exc()))
+    conn.close()
+
+
+class ShardedRunner(Strategy):
+    """
+    Runs a strategy over many pairs (strategy="pairs") or baskets (strategy="multi" or
+    "kalman") across worker processes, as a drop-in for the strategy in the event loop.
+
+    Every unit (pair or basket) has its own strategy, built by BUILDERS[strategy] (or by the
+    given function, build(rates, events, unit, **kwargs), which must be importable by the
+    workers) on its own ColumnarRatesStore of the unit's tokens, and the units are dealt out
+    round-robin to processes worker processes (processes=1 runs them all in this process).
+    On every MARKET event the bars added to the rates store since the previous one are sent
+    to all of the workers, which run their units on the same event, and the signals of all
+    of the workers are merged onto the events queue ordered by (timestamp, unit index, seq),
+    seq being the order in which the unit put them, so that the event stream does not depend
+    on the number of processes.
+
+    The units share no state, so the pairs strategy is run with a position tracker per pair
+    (per_pair_positions=True). rates must be a ColumnarRatesStore holding the tokens of all
+    of the units, and the workers keep windows of the same capacity.
+    """
+
+    def __init__(self, strategy, units, rates, events, processes=None, **kwargs):
+        self.build = BUILDERS[strategy] if isinstance(strategy, str) else strategy
+        self.units = [tuple(unit) for unit in units]
+        self.rates = rates
+        self.events = events
+        self.kwargs = kwargs
+        processes = os.cpu_count() if processes is None else processes
+        self.processes = max(1, min(processes, len(self.units)))
+
+        self._columns = {token: j for j, token in enumerate(rates.token_list)}
+        self._shards = [list(range(w, len(self.units), self.processes)) for w in range(self.processes)]
+        self._local = None # The single shard, when running in this process
+        self._workers = []
+        self._closed = False
+        self._latest_ns = None
+
+        # Counters
+        self.bars_dispatched = 0
+        self.signals_merged = 0
+
+    def start(self):
+        """Start the workers (done on the first MARKET event otherwise)"""
+        if self._closed:
+            raise RuntimeError("The runner has been closed, and its workers' state is lost")
+        if self._local is not None or self._workers:
+            return
+        if self.processes == 1:
+            self._local = _Shard(self.build, self.units, range(len(self.units)), self._columns, self.rates.capacity, self.kwargs)
+            return
+        for shard in self._shards:
+            conn, child_conn = multiprocessing.Pipe()
+            process = multiprocessing.Process(target=_run_shard, args=(child_conn, self.build, [self.units[i] for i in shard],
+                shard, self._columns, self.rates.capacity, self.kwargs), daemon=True)
+            process.start()
+            child_conn.close()
+            self._workers.append((process, conn))
+        for process, conn in self._workers:
+            self._receive(conn)
+
+    def close(self):
+        """Stop the workers (their strategies' state is lost, so the runner cannot be used after)"""
+        for process, conn in self._workers:
+            try:
+                conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+            conn.close()
+        for process, conn in self._workers:
+            process.join()
+        self._workers = []
+        self._closed = self._closed or self.processes > 1
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _receive(self, conn):
+        status, payload = conn.recv()
+        if status == "error":
+            self.close()
+            raise RuntimeError(f"Shard worker failed:\n{payload}")
+        return payload
+
+    def _new_bars(self):
+        """The bars of the rates store after the last one sent (from the last one, which may have been revised)"""
+        timestamps_ns, liq_panel = self.rates.get_latest_panel(N=self.rates.capacity)
+        start = 0 if self._latest_ns is None else np.searchsorted(timestamps_ns, self._latest_ns)
+        timestamps_ns, rows = timestamps_ns[start:].copy(), liq_panel[start:].copy()
+        if len(timestamps_ns):
+            self._latest_ns = timestamps_ns[-1]
+        return timestamps_ns, rows
+
+    def calculate_signals(self, event):
+        if event.type != "MARKET":
+            return
+        self.start()
+        message = self._new_bars() + (self.rates.tz,)
+        if self._local is not None:
+            signals = self._local.step(*message)
+        else:
+            for process, conn in self._workers:
+                conn.send(message)
+            signals = [signal for process, conn in self._workers for signal in self._receive(conn)]
+        signals.sort(key=lambda s: (s[2].timestamp, s[0], s[1]))
+        merged = [signal for unit_index, seq, signal in signals]
+
+        put_many = getattr(self.events, "put_many", None)
+        if put_many is not None:
+            put_many(merged)
+        else:
+            for signal in merged:
+                self.events.put(signal)
+        self.bars_dispatched += 1
+        self.signals_merged += len(merged)
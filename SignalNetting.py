@@ -0,0 +1,125 @@
+import time
+from event import SignalEvent
+from SizedSignal import SizedSignalEvent
+
+DIRECTIONS = {"LONG": 1, "SHORT": -1}
+
+
+class _Token(object):
+    """Place of a token's net orders among the signals forwarded as they are"""
+
+    def __init__(self, token):
+        self.token = token
+
+
+class NettingStage(object):
+    """
+    Netting of the signals of several strategies before they reach the execution handler's
+    events queue. The strategies are given the stage as their events queue, and flush is
+    called once all of them have run on a bar.
+
+    The signals of the bar are aggregated by token. An EXIT closes the token's position
+    whatever came before it, so it acts as a barrier: the LONG and SHORT legs before the
+    token's last EXIT are dropped, and a single EXIT is forwarded, followed by the net of the
+    legs after it, for a strategy that exited and reopened the token within the bar. The
+    LONG and SHORT units of those legs (the quantity of a SizedSignalEvent, one per unit
+    SignalEvent) cancel out and only the net order is forwarded, with the timestamp of the
+    token's last leg: as one SizedSignalEvent with unit_events=False, as unit SignalEvents
+    with unit_events=True, or, by default (unit_events=None), as one SizedSignalEvent only if
+    all of the token's legs were SizedSignalEvents, so that strategies sending unit events
+    (sized_signals=False) reach a handler that ignores quantity as unit events. The position
+    the netted stream leaves each token in is therefore the one of the signals as they were
+    sent. Any other signal (e.g. a position the signal logic could not map, NaN) is forwarded
+    as it is. The tokens keep the order in which they were first signalled.
+
+    For backpressure, events should be a bounded queue.Queue(maxsize): flush then blocks while
+    the queue is full, holding the strategies back until the execution handler catches up
+    (raising queue.Full after timeout seconds, if given).
+    """
+
+    def __init__(self, events, unit_events=None, timeout=None):
+        self.events = events
+        self.unit_events = unit_events
+        self.timeout = timeout
+        self._pending = []
+
+        # Counters
+        self.signals_in = 0
+        self.signals_out = 0
+        self.units_cancelled = 0 # LONG/SHORT units netted away, or closed by a later EXIT
+        self.exits_coalesced = 0 # Duplicate EXITs dropped
+        self.full_waits = 0 # Puts that found the events queue full
+        self.wait_time = 0.0 # Seconds spent putting on the events queue
+
+    def put(self, event):
+        self._pending.append(event)
+
+    def put_many(self, events):
+        self._pending.extend(events)
+
+    def __len__(self):
+        return len(self._pending)
+
+    def net(self, signals):
+        """The net orders of a list of signals"""
+        legs = {} # token -> [net units, gross units, timestamp of the last leg, exits, timestamp of the last EXIT, all legs sized]
+        order = [] # Tokens of the netted legs, or the other signals as they are
+        for signal in signals:
+            direction = DIRECTIONS.get(signal.signal_type) if isinstance(signal.signal_type, str) else None
+            if direction is None and signal.signal_type != "EXIT":
+                order.append(signal)
+                continue
+            leg = legs.get(signal.token)
+            if leg is None:
+                leg = legs[signal.token] = [0, 0, None, 0, None, True]
+                order.append(_Token(signal.token))
+            if direction is None:
+                # The legs so far are closed by the EXIT
+                self.units_cancelled += leg[1]
+                leg[0], leg[1], leg[2] = 0, 0, None
+                leg[3] += 1
+                leg[4] = signal.timestamp
+            else:
+                quantity = getattr(signal, "quantity", 1)
+                leg[5] = leg[5] and isinstance(signal, SizedSignalEvent)
+                leg[0] += direction*quantity
+                leg[1] += quantity
+                leg[2] = signal.timestamp
+
+        netted = []
+        for item in order:
+            if not isinstance(item, _Token):
+                netted.append(item)
+                continue
+            token = item.token
+            units, gross, timestamp, exits, exit_timestamp, sized = legs[token]
+            if exits:
+                self.exits_coalesced += exits - 1
+                netted.append(SignalEvent(token, "EXIT", exit_timestamp))
+            self.units_cancelled += gross - abs(units)
+            if units != 0:
+                direction = "LONG" if units > 0 else "SHORT"
+                if self.unit_events or (self.unit_events is None and not sized):
+                    netted.extend(SignalEvent(token, direction, timestamp) for _ in range(abs(units)))
+                else:
+                    netted.append(SizedSignalEvent(token, direction, timestamp, abs(units)))
+        return netted
+
+    def flush(self):
+        """Net the signals of the bar and forward the net orders to the events queue"""
+        signals, self._pending = self._pending, []
+        self.signals_in += len(signals)
+        netted = self.net(signals)
+
+        start = time.perf_counter()
+        full = getattr(self.events, "full", None)
+        for signal in netted:
+            if full is not None and full():
+                self.full_waits += 1
+            if self.timeout is None:
+                self.events.put(signal)
+            else:
+                self.events.put(signal, timeout=self.timeout)
+        self.wait_time += time.perf_counter() - start
+        self.signals_out += len(netted)
+        return len(netted)
@@ -0,0 +1,48 @@
+from event import SignalEvent
+
+
+class SizedSignalEvent(SignalEvent):
+    """
+    SignalEvent carrying a quantity, so that a leg of N units is sent to the execution
+    handler as one event rather than N identical unit events
+    """
+
+    def __init__(self, token, signal_type, timestamp, quantity=1):
+        SignalEvent.__init__(self, token, signal_type, timestamp)
+        self.quantity = quantity
+        self.unit_args = (token, signal_type, timestamp) # Arguments of the equivalent unit SignalEvent
+
+
+def put_signals(events, legs, unit_events=False):
+    """
+    Put the (token, direction, quantity, timestamp) legs on the events queue, one
+    SizedSignalEvent per leg, or, for execution handlers that still expect them,
+    quantity unit SignalEvents per leg. Legs with zero quantity are skipped, and queues
+    that support it (put_many) receive all of the events in one call.
+    """
+    signals = []
+    for token, direction, quantity, timestamp in legs:
+        if quantity <= 0:
+            continue
+        if unit_events:
+            signals.extend(SignalEvent(token, direction, timestamp) for _ in range(quantity))
+        else:
+            signals.append(SizedSignalEvent(token, direction, timestamp, quantity))
+
+    put_many = getattr(events, "put_many", None)
+    if put_many is not None:
+        put_many(signals)
+    else:
+        for signal in signals:
+            events.put(signal)
+    return len(signals)
+
+
+def to_unit_signals(signal):
+    """
+    Compatibility shim for handlers that expect unit events: expand a SizedSignalEvent
+    into quantity unit SignalEvents (other events are returned as they are)
+    """
+    if not isinstance(signal, SizedSignalEvent):
+        return [signal]
+    return [SignalEvent(*signal.unit_args) for _ in range(signal.quantity)]
@@ -1,18 +1,31 @@
 from strategy import Strategy
-from event import SignalEvent
+from ApyEngine import ApyEngine, SECONDS_IN_YEAR # SECONDS_IN_YEAR is only re-exported, for code that imported it from here
+from RollingStats import RollingWindowStats
+from SizedSignal import put_signals
 import numpy as np
-from math import floor, ceil
-from statsmodels.tsa.vector_ar.vecm import coint_johansen
+from math import ceil
+from JohansenService import JohansenService
+from Kernels import get_kernels
+from Instrumentation import NULL_INSTRUMENTATION
+from StrategyState import StateStore, encode_position, decode_position
 import pandas as pd 
 
-SECONDS_IN_YEAR = 31536000
 class StatArbMultiTrade(Strategy):
  
-    def __init__(self, events, rates, lookback_window=10):
+    def __init__(self, events, rates, lookback_window=10, sized_signals=False, johansen_refresh_every=1, johansen_drift_threshold=None,
+        instrumentation=None, kernels="numpy"):
         self.rates = rates
-        self.events = events
+        # Optional per-stage timings and counters of calculate_signals, a no-op by default
+        self.instrumentation = NULL_INSTRUMENTATION if instrumentation is None else instrumentation
+        self.events = self.instrumentation.wrap_events(events)
         self.token_list = self.rates.token_list
         self.lookback_window = lookback_window
+        # Hot-loop kernels, NumPy by default or compiled with numba (see Kernels.get_kernels)
+        self.kernels = get_kernels(kernels)
+        self.apy_engine = ApyEngine(lookback=self.lookback_window, kernels=self.kernels) # Streaming APY calculation per token
+        # Cached Johansen decomposition, by default refreshed with the full coint_johansen on every bar. The APYs
+        # of the window are all revised as it rolls, so the drift check recomputes its moments on every bar
+        self.johansen_service = JohansenService(refresh_every=johansen_refresh_every, drift_threshold=johansen_drift_threshold)
         
         # Keep a record of the rates data and the state of the market
         self.latest_rates = -1.0*np.ones(len(self.token_list)) 
@@ -22,58 +35,115 @@ class StatArbMultiTrade(Strategy):
         self.deviations = 1 # Default is 1 standard deviation away from the mean spread
         
         # Need to keep track of the Kalman filter moving averages and moving stds
-        self.days_to_lookback = -self.lookback_window
-        self.spread_recent_L_values = {l: 0 for l in range(self.days_to_lookback,0)}
+        self.spread_stats = RollingWindowStats(self.lookback_window)
         self.spread_MA = 0 
         self.spread_MStd = 0
         
         self.pos = np.zeros(len(self.token_list))
+        self.sized_signals = sized_signals # One SizedSignalEvent per leg, instead of one SignalEvent per unit
 
     def liquidity_index_to_apy(self, rates):
-        liq_idx = np.array([r[2] for r in rates])
-        timestamps = np.array([r[1] for r in rates])
-        apys = []
-        for i in range(1, len(liq_idx)):
-            window = i-self.lookback_window if self.lookback_window<=i else 0
-            variable_rate = liq_idx[i]/liq_idx[window] - 1.0 
-            # Annualise the rate
-            compounding_periods = SECONDS_IN_YEAR / (timestamps[i] - timestamps[window]).total_seconds()
-            apys.append(((1 + variable_rate)**compounding_periods) - 1)
-        return apys
+        if len(rates) == 0:
+            return []
+        return self.apy_engine.rates_to_apys(rates[-1][0], rates)[1]
+
+    def window_apys(self):
+        """
+        APYs over the lookback window, one column per token, together with the latest
+        (token, timestamp, liquidity index) of each token. A columnar rates store hands
+        over zero-copy views of the aligned window, otherwise the rate tuples are unpacked.
+        """
+        if hasattr(self.rates, "get_latest_panel"):
+            timestamps_ns, liq_panel = self.rates.get_latest_panel(self.token_list, N=self.lookback_window)
+            latest = [self.rates.latest(token) for token in self.token_list]
+            self.instrumentation.lap("fetch_rates")
+            apys = self.apy_engine.panel_apys(self.token_list, timestamps_ns, liq_panel)
+            self.instrumentation.lap("apy")
+            return apys, latest
+
+        liq_idxs ={
+            token: self.rates.get_latest_rates(token, N=self.lookback_window) for token in self.token_list
+        }
+        self.instrumentation.lap("fetch_rates")
+        # Put all relevant rates in the lookback window here
+        df_rates = pd.DataFrame.from_dict({
+                k: self.liquidity_index_to_apy(rates=v) for k, v in liq_idxs.items()
+            }
+        )
+        self.instrumentation.lap("apy")
+        return df_rates.values, [v[-1] for v in liq_idxs.values() if len(v) > 0]
+
+    def get_state(self):
+        """
+        State of the basket for warm restarts, as a one-row StateStore (see save_state and
+        load_state). The APY and Johansen caches are rebuilt from the rates on the next bar.
+        """
+        n, lookback = len(self.token_list), self.lookback_window
+        store = StateStore([tuple(self.token_list)], {
+            "latest_rates": ((n,), float), "invested": ((), np.int8), "days": ((), np.int64),
+            "spread_values": ((lookback,), float), "spread_stats": ((5,), float),
+            "spread_MA": ((), float), "spread_MStd": ((), float), "pos": ((n,), float),
+        }, meta={"strategy": type(self).__name__})
+        store["latest_rates"] = self.latest_rates
+        store["invested"] = encode_position(self.invested)
+        store["days"] = self.days
+        store["spread_values"], store["spread_stats"] = self.spread_stats.get_state()
+        store["spread_MA"], store["spread_MStd"] = self.spread_MA, self.spread_MStd
+        store["pos"] = self.pos
+        return store
+
+    def save_state(self, path):
+        self.get_state().save(path)
+
+    def load_state(self, path):
+        store = StateStore.load(path)
+        store.check_keys([tuple(self.token_list)], what="baskets")
+        self.latest_rates = store["latest_rates"][0].copy()
+        self.invested = decode_position(store["invested"][0])
+        self.days = int(store["days"][0])
+        self.spread_stats.set_state(store["spread_values"][0], store["spread_stats"][0])
+        self.spread_MA, self.spread_MStd = store["spread_MA"][0], store["spread_MStd"][0]
+        self.pos = store["pos"][0].copy()
+        self.apy_engine.reset()
+        self.johansen_service.reset()
+
+    def spread_legs(self, latest, idx_pos, direction):
+        """
+        (token, direction, quantity, timestamp) legs to go long or short the spread, where
+        the first token always takes the spread direction, by construction
+        """
+        opposite = "SHORT" if direction == "LONG" else "LONG"
+        legs = [(latest[0][0], direction, idx_pos[0], latest[0][1])]
+        for i in range(1, len(idx_pos)):
+            POS = opposite if self.pos[i]<0 else direction
+            legs.append((latest[i][0], POS, idx_pos[i], latest[i][1]))
+        return legs
         
     def calculate_signals(self, event):
         # Pick up the latest rates here
         if event.type == "MARKET":
-            liq_idxs ={
-                token: self.rates.get_latest_rates(token, N=self.lookback_window) for token in self.token_list
-            }
-            # Put all relevant rates in the lookback window here
-            df_rates = pd.DataFrame.from_dict({
-                    k: self.liquidity_index_to_apy(rates=v) for k, v in liq_idxs.items()
-                }
-            )   
-            self.latest_rates = df_rates.iloc[-1].values
+            instrumentation = self.instrumentation
+            instrumentation.begin_bar()
+            window_apys, latest = self.window_apys()
+            self.latest_rates = window_apys[-1]
             self.days += 1
             if all(self.latest_rates > -1.0):
                 # 1) Johansen test to extract eigenvalues for positions
-                jres = coint_johansen(df_rates, det_order=0, k_ar_diff=1) 
+                decompositions_run = self.johansen_service.decompositions_run
+                jres = self.johansen_service.test(window_apys)
+                instrumentation.lap("johansen")
+                instrumentation.count("coint_tests", self.johansen_service.decompositions_run - decompositions_run)
      
                 # 2) Form spread from the critical values of the Johansen test
                 leading_evecs = jres.evec[:,0] # Leading eigenvectors to form the stationary series
-                spread = 0
-                for i in range(len(leading_evecs)):
-                    spread += self.latest_rates[i]*leading_evecs[i]
+                spread = self.kernels.spread(self.latest_rates, leading_evecs)
                 
                 # 3) Save the relevant historical spread values, according to the lookback window
-                self.spread_recent_L_values[self.days_to_lookback] = spread
-                non_zero_spread_cached = np.array([v for k,v in self.spread_recent_L_values.items() if v!=0])
-                self.days_to_lookback += 1
-                if self.days_to_lookback==0: # Reset in order to cache historical values within the lookback only
-                    self.days_to_lookback = -self.lookback_window
+                self.spread_stats.push(spread)
             
                 # 4) Update the moving average and moving std according to the latest values cached
-                self.spread_MA = non_zero_spread_cached.mean()
-                self.spread_MStd = non_zero_spread_cached.std()
+                self.spread_MA = self.spread_stats.mean
+                self.spread_MStd = self.spread_stats.std
                 
                 # Updated Z-score on the spread 
                 spread_z = (spread - self.spread_MA)/self.spread_MStd
@@ -81,31 +151,18 @@ class StatArbMultiTrade(Strategy):
                 # If there is not curenctly a position in the market
                 # Compute the relevant posiyions to take, based on the leading eigenvector
                 normed_evecs = leading_evecs/jres.evec[0][0] # Normalise the leading eigenvectors for positions
+                instrumentation.lap("spread")
       
                 if self.invested is None:
                     # Get position sizes (directions are considered separately)
                     self.pos = normed_evecs
                     idx_pos = [int(ceil(np.abs(i))) for i in self.pos]
                     if spread_z < -self.deviations: # Long the spread
-                        for i in range(idx_pos[0]): # Always long the first term, by construction
-                            signal = SignalEvent(list(liq_idxs.values())[0][-1][0], "LONG", list(liq_idxs.values())[0][-1][1])
-                            self.events.put(signal)
-                        for i in range(1, len(idx_pos)):
-                            POS = "SHORT" if self.pos[i]<0 else "LONG"
-                            for j in range(idx_pos[i]):
-                                signal = SignalEvent(list(liq_idxs.values())[i][-1][0], POS, list(liq_idxs.values())[i][-1][1])
-                                self.events.put(signal)                       
+                        put_signals(self.events, self.spread_legs(latest, idx_pos, "LONG"), unit_events=not self.sized_signals)
                         self.invested = "LONG"
 
                     elif spread_z > self.deviations: # Short the spread
-                        for i in range(idx_pos[0]): 
-                            signal = SignalEvent(list(liq_idxs.values())[0][-1][0], "SHORT", list(liq_idxs.values())[0][-1][1])
-                            self.events.put(signal)
-                        for i in range(1, len(idx_pos)):
-                            POS = "LONG" if self.pos[i]<0 else "SHORT"
-                            for j in range(idx_pos[i]):
-                                signal = SignalEvent(list(liq_idxs.values())[i][-1][0], POS, list(liq_idxs.values())[i][-1][1])
-                                self.events.put(signal)
+                        put_signals(self.events, self.spread_legs(latest, idx_pos, "SHORT"), unit_events=not self.sized_signals)
                         self.invested = "SHORT"
 
                 # If instead we have already entered a position in the market
@@ -113,23 +170,11 @@ class StatArbMultiTrade(Strategy):
                     self.pos = normed_evecs
                     idx_pos = [int(ceil(np.abs(i))) for i in self.pos]
                     if self.invested=="LONG" and spread_z > 0: # Unwind the long spread position
-                        for i in range(idx_pos[0]):
-                            signal = SignalEvent(list(liq_idxs.values())[0][-1][0], "SHORT", list(liq_idxs.values())[0][-1][1])
-                            self.events.put(signal)
-                        for i in range(1, len(idx_pos)):
-                            POS = "LONG" if self.pos[i]<0 else "SHORT"
-                            for j in range(idx_pos[i]):
-                                signal = SignalEvent(list(liq_idxs.values())[i][-1][0], POS, list(liq_idxs.values())[i][-1][1])
-                                self.events.put(signal)
+                        put_signals(self.events, self.spread_legs(latest, idx_pos, "SHORT"), unit_events=not self.sized_signals)
                         self.invested = None
                     
                     elif self.invested=="SHORT" and spread_z < 0: # Unwind the short spread position
-                        for i in range(idx_pos[0]):
-                            signal = SignalEvent(list(liq_idxs.values())[0][-1][0], "LONG", list(liq_idxs.values())[0][-1][1])
-                            self.events.put(signal)
-                        for i in range(1, len(idx_pos)):
-                            POS = "SHORT" if self.pos[i]<0 else "LONG"
-                            for j in range(idx_pos[i]):
-                                signal = SignalEvent(list(liq_idxs.values())[i][-1][0], POS, list(liq_idxs.values())[i][-1][1])
-                                self.events.put(signal)
-                        self.invested = None
\ No newline at end of file
+                        put_signals(self.events, self.spread_legs(latest, idx_pos, "LONG"), unit_events=not self.sized_signals)
+                        self.invested = None
+                instrumentation.lap("emit")
+            instrumentation.end_bar()
@@ -1,33 +1,82 @@
 from strategy import Strategy
 from event import SignalEvent
+from ApyEngine import ApyEngine, SECONDS_IN_YEAR # SECONDS_IN_YEAR is only re-exported, for code that imported it from here
+from CointegrationService import CointegrationService
+from CointegrationScreen import CointegrationScreen
+from MonthlyZScore import MonthlyZScore
+from Kernels import get_kernels
+from Instrumentation import NULL_INSTRUMENTATION
+from StrategyState import StateStore, POSITION_CODES, encode_position, decode_position
 import pandas as pd
 import numpy as np
 import os
-import statsmodels.api as sm
-from statsmodels.tsa.stattools import adfuller
-from statsmodels.tsa.stattools import coint
-import seaborn as sns
-import matplotlib.pyplot as plt
+# matplotlib, seaborn and statsmodels.api are only imported by the diagnostics (see DiagnosticsReport)
 
-SECONDS_IN_YEAR = 31536000
 class StatisticalArbitragePairs(Strategy):
 
-    def __init__(self, rates, events, pairs, lookback_window=30, apy_lookback=5, deviations=1.0, strategy_start="2022-04-01 00:00:00", monthly=False):
+    def __init__(self, rates, events, pairs, lookback_window=30, apy_lookback=5, deviations=1.0, strategy_start="2022-04-01 00:00:00", monthly=False,
+        coint_retest_every=1, coint_drift_threshold=None, coint_fast_adf=False, apy_cache=None,
+        instrumentation=None, per_pair_positions=False, kernels="numpy"):
         
         self.rates = rates
         self.token_list = self.rates.token_list
-        self.events = events
+        # Optional per-stage timings and counters of calculate_signals, a no-op by default
+        self.instrumentation = NULL_INSTRUMENTATION if instrumentation is None else instrumentation
+        self.events = self.instrumentation.wrap_events(events)
         self.lookback_window = lookback_window # Statistical arbitrage lookback window
         self.apy_lookback = apy_lookback
         self.deviations = deviations # How much to scale the standard deviation of the pairs ratio by
         self.pairs = pairs # The token pairs to arbitrage --> [(token1, token2), (token2, token4), (token1, token4), ...]
-        self.prior_position = "EXIT" # Tracker for the first stat arb position
+        # Tracker for the first stat arb position, shared by all pairs or one per pair, as int8 codes
+        self.per_pair_positions = per_pair_positions
+        self.positions = np.full(len(self.pairs) if per_pair_positions else 1, POSITION_CODES["EXIT"], dtype=np.int8)
         self.strategy_start = pd.to_datetime(strategy_start)
         self.monthly = monthly
+        # Streaming APY calculation, shared by all pairs, reading from and filling the on-disk ApyCache if given
+        self.apy_engine = ApyEngine(lookback=self.apy_lookback, cache=apy_cache, kernels=get_kernels(kernels))
+        # Cached cointegration checks, by default re-tested with the full coint() on every bar
+        self.coint_service = CointegrationService(retest_every=coint_retest_every, drift_threshold=coint_drift_threshold, 
+            fast_adf=coint_fast_adf)
+        self.monthly_z_score = MonthlyZScore() # Per-pair cache of the completed months' statistics
 
         if self.monthly:
             self.lookback_window = 90 # Make sure we look far back enough in the past
 
+    @property
+    def prior_position(self):
+        """Position of the shared tracker (of the first pair, with per-pair positions)"""
+        return decode_position(self.positions[0])
+
+    @prior_position.setter
+    def prior_position(self, position):
+        self.positions[0] = encode_position(position)
+
+    """
+        Strategy state for warm restarts: the position tracker of each pair (or the shared
+        one), as a StateStore which save_state writes to disk and load_state restores. The
+        APY, cointegration and monthly z-score caches are rebuilt from the rates on the next
+        bar, so only the positions need saving (the bars held back by an ApyCache are flushed
+        to it).
+    """
+    def get_state(self):
+        keys = [tuple(pair) for pair in self.pairs] if self.per_pair_positions else ["shared"]
+        store = StateStore(keys, {"position": ((), np.int8)}, meta={"strategy": type(self).__name__})
+        store["position"] = self.positions
+        return store
+
+    def save_state(self, path):
+        self.get_state().save(path)
+        if self.apy_engine.cache is not None:
+            self.apy_engine.cache.flush()
+
+    def load_state(self, path):
+        store = StateStore.load(path)
+        store.check_keys([tuple(pair) for pair in self.pairs] if self.per_pair_positions else ["shared"], what="pairs")
+        self.positions[:] = store["position"]
+        self.apy_engine.reset()
+        self.coint_service.reset()
+        self.monthly_z_score.reset()
+
     """
         Compute z-score for downstream stat. arb. signal
         construction.
@@ -41,24 +90,32 @@ class StatisticalArbitragePairs(Strategy):
         indices
     """
     def liquidity_index_to_apy_df(self, rates, token):
-        liq_idx = np.array([r[2] for r in rates])
-        timestamps = np.array([r[1] for r in rates])
-        apys = []
-        for i in range(1, len(liq_idx)):
-            window = i-self.apy_lookback if self.apy_lookback<=i else 0
-            variable_rate = liq_idx[i]/liq_idx[window] - 1.0 
-            # Annualise the rate
-            compounding_periods = SECONDS_IN_YEAR / (timestamps[i] - timestamps[window]).total_seconds()
-            apys.append(((1 + variable_rate)**compounding_periods) - 1)
-        df = pd.DataFrame(data={"Date": timestamps[1:], f"{token} APY": np.array(apys)})
+        timestamps, apys = self.apy_engine.rates_to_apys(token, rates)
+        df = pd.DataFrame(data={"Date": timestamps, f"{token} APY": apys})
         df.set_index("Date", inplace=True)
         return df
 
+    """
+        Generate the APY DataFrame of both tokens of a pair from the
+        columnar rates store, where they share timestamps by construction.
+        The APYs are NaN at the bars a token has no value at, and those
+        rows are dropped as with the rate tuples
+    """
+    def window_apy_df(self, pair):
+        timestamps_ns, liq_idx_1 = self.rates.get_latest_window(pair[0], N=self.lookback_window+1)
+        liq_idx_2 = self.rates.get_latest_window(pair[1], N=self.lookback_window+1)[1]
+        df = pd.DataFrame(data={
+                f"{pair[0]} APY": self.apy_engine.window_apys(pair[0], timestamps_ns, liq_idx_1),
+                f"{pair[1]} APY": self.apy_engine.window_apys(pair[1], timestamps_ns, liq_idx_2),
+            }, index=self.rates.to_datetime_index(timestamps_ns[1:])
+        )
+        df.index.name = "Date"
+        return df
     
     """
         Summarise the signal update logic here
     """
-    def signal_update_logic(self, signals, token1, token2, time1, time2):
+    def signal_update_logic(self, signals, token1, token2, time1, time2, slot=0):
         # Create signal - short if Z-score is greater than upper limit else long
         signals["Signals 1"] = 0
         signals["Signals 1"] = np.select([signals["Z"] > \
@@ -79,13 +136,13 @@ class StatisticalArbitragePairs(Strategy):
         signals["Positions 2"] = signals["Positions 2"].map({1: "LONG", -1: "SHORT", 0: "EXIT"})
                         
         position_tracker = signals["Positions 1"].iloc[-1]
-        if position_tracker != self.prior_position: # To ensure we only go LONG/SHORT once, until the signal changes 
+        if position_tracker != decode_position(self.positions[slot]): # To ensure we only go LONG/SHORT once, until the signal changes 
             # Now we need to set up the positions 
             signal1 = SignalEvent(token1, signals["Positions 1"].iloc[-1], time1)
             signal2 = SignalEvent(token2, signals["Positions 2"].iloc[-1], time2)
             self.events.put(signal1)
             self.events.put(signal2)
-            self.prior_position = position_tracker # Reset the prior position to LONG/SHORT
+            self.positions[slot] = encode_position(position_tracker) # Reset the prior position to LONG/SHORT
     
     """
         Take in the z-score and compute the bounds necessary to exit and
@@ -95,63 +152,70 @@ class StatisticalArbitragePairs(Strategy):
     def calculate_signals(self, event):
         position_tracker = self.prior_position # Keep track of the first position to prevent double counting 
         if event.type == "MARKET":
-            for pair in self.pairs:
-                liq_idx_1 = self.rates.get_latest_rates(pair[0], N=self.lookback_window+1) 
-                liq_idx_2 = self.rates.get_latest_rates(pair[1], N=self.lookback_window+1) 
-                if liq_idx_1[-1][1] >= self.strategy_start: # Enter strategy
+            instrumentation = self.instrumentation
+            instrumentation.begin_bar()
+            tests_run = self.coint_service.tests_run
+            columnar = hasattr(self.rates, "get_latest_window") # Zero-copy windows of a columnar rates store
+            for k, pair in enumerate(self.pairs):
+                slot = k if self.per_pair_positions else 0
+                if self.per_pair_positions:
+                    position_tracker = decode_position(self.positions[slot])
+                if columnar:
+                    latest_1, latest_2 = self.rates.latest(pair[0]), self.rates.latest(pair[1])
+                else:
+                    liq_idx_1 = self.rates.get_latest_rates(pair[0], N=self.lookback_window+1) 
+                    liq_idx_2 = self.rates.get_latest_rates(pair[1], N=self.lookback_window+1) 
+                    latest_1, latest_2 = liq_idx_1[-1], liq_idx_2[-1]
+                instrumentation.lap("fetch_rates")
+                if latest_1[1] >= self.strategy_start: # Enter strategy
                     
-                    df_1, df_2 = self.liquidity_index_to_apy_df(rates=liq_idx_1, token=pair[0]), \
-                        self.liquidity_index_to_apy_df(rates=liq_idx_2, token=pair[1])
+                    if columnar:
+                        signals = self.window_apy_df(pair) # Zero-copy windows, so fetching is part of the APY stage
+                        instrumentation.lap("apy")
+                    else:
+                        df_1, df_2 = self.liquidity_index_to_apy_df(rates=liq_idx_1, token=pair[0]), \
+                            self.liquidity_index_to_apy_df(rates=liq_idx_2, token=pair[1])
+                        instrumentation.lap("apy")
                     
-                    # Make sure the pairs share common timestamps, by concatenating
-                    signals = pd.concat([df_1, df_2], join="inner", axis=1)
+                        # Make sure the pairs share common timestamps, by concatenating
+                        signals = pd.concat([df_1, df_2], join="inner", axis=1)
                     signals.dropna(inplace=True)
                     
                     # Signal construction and analysis
                     signals["Ratios"] = signals[f"{pair[0]} APY"]/signals[f"{pair[1]} APY"]
+                    instrumentation.lap("align")
 
                     if self.monthly:
                         # Currently using previous month's information, but this might be updated to a more "rolling"
                         # arbitrage strategy
-                        signals["Year"] = np.array([int("-".join(i.strftime("%Y-%m-%d").split(" ")[0].split("-")[:1])) for i in signals.index])
-                        signals["Month"] = np.array([int("-".join(i.strftime("%Y-%m-%d").split(" ")[0].split("-")[1:2])) for i in signals.index])
-
                         # Calculate z-score and define upper and lower thresholds (e.g. 1 standard deviation)
-                        # Using previous month's means and spreads 
-                        signals_collected = []
-                        for y in signals["Year"].unique(): 
-                            for m in signals["Month"].unique():
-                                # Monthly change to signal values
-                                (y_prev, m_prev) = (y-1, 12) if m==1 else (y, m-1)
-                                signals_prev = signals.loc[lambda signals: (signals["Year"]== y_prev) & (signals["Month"]==m_prev)]
-                                signals_temp = signals.loc[lambda signals: (signals["Year"]== y) & (signals["Month"]==m)]
-                                z_prev = self.z_score(signals_prev["Ratios"])
-                                signals_temp["Z"] = self.z_score(signals_temp["Ratios"])
-                                signals_temp["Z upper limit"] = z_prev.mean() + z_prev.std()*self.deviations
-                                signals_temp["Z lower limit"] = z_prev.mean() - z_prev.std()*self.deviations
-                                signals_collected.append(signals_temp)
-                        
-                        signals = pd.concat(signals_collected) # Re-define signals DataFrame
-                        self.signal_update_logic(signals=signals, token1=liq_idx_1[-1][0], token2=liq_idx_2[-1][0], time1=liq_idx_1[-1][1], time2=liq_idx_2[-1][1])                       
+                        # Using previous month's means and spreads, grouped on the datetime index
+                        # The first APYs of the window have a clipped lookback, and may be revised from bar to bar
+                        signals = self.monthly_z_score.apply(pair, signals, deviations=self.deviations, stable_from=self.apy_lookback)
+                        instrumentation.lap("zscore")
+                        self.signal_update_logic(signals=signals, token1=latest_1[0], token2=latest_2[0], time1=latest_1[1], time2=latest_2[1], slot=slot)                       
+                        instrumentation.lap("emit")
                     else:
                         # Use lookback_window
                         # We need to confirm the signals are still cointegrating over the lookback window
-                        coint_check = coint(signals[f"{pair[0]} APY"], signals[f"{pair[1]} APY"])
-                        if coint_check[1] >= 0.05: # Need to think more about this approac. Might be too conservative.
+                        coint_pvalue = self.coint_service.pvalue(pair, signals[f"{pair[0]} APY"].values, 
+                            signals[f"{pair[1]} APY"].values, index=signals.index.values)
+                        instrumentation.lap("coint")
+                        if coint_pvalue >= 0.05: # Need to think more about this approac. Might be too conservative.
                             # Pairs are not cointegrated, and we need to exit existing trades and reset with EXIT
                             if position_tracker=="LONG":
-                                signal1_exit = SignalEvent(liq_idx_1[-1][0], "SHORT", liq_idx_1[-1][1])
-                                signal2_exit = SignalEvent(liq_idx_2[-1][0], "LONG", liq_idx_2[-1][1])
+                                signal1_exit = SignalEvent(latest_1[0], "SHORT", latest_1[1])
+                                signal2_exit = SignalEvent(latest_2[0], "LONG", latest_2[1])
                                 self.events.put(signal1_exit)
                                 self.events.put(signal2_exit)
                             if position_tracker=="SHORT":
-                                signal1_exit = SignalEvent(liq_idx_1[-1][0], "LONG", liq_idx_1[-1][1])
-                                signal2_exit = SignalEvent(liq_idx_2[-1][0], "SHORT", liq_idx_2[-1][1])
+                                signal1_exit = SignalEvent(latest_1[0], "LONG", latest_1[1])
+                                signal2_exit = SignalEvent(latest_2[0], "SHORT", latest_2[1])
                                 self.events.put(signal1_exit)
                                 self.events.put(signal2_exit)                      
                         
-                            signal1 = SignalEvent(liq_idx_1[-1][0], "EXIT", liq_idx_1[-1][1])
-                            signal2 = SignalEvent(liq_idx_2[-1][0], "EXIT", liq_idx_2[-1][1])
+                            signal1 = SignalEvent(latest_1[0], "EXIT", latest_1[1])
+                            signal2 = SignalEvent(latest_2[0], "EXIT", latest_2[1])
                     
                             # Exit first pair trade
                             self.events.put(signal1)
@@ -160,13 +224,18 @@ class StatisticalArbitragePairs(Strategy):
                             self.events.put(signal2)
 
                             # Reset 
-                            self.prior_position = "EXIT"
+                            self.positions[slot] = POSITION_CODES["EXIT"]
+                            instrumentation.lap("emit")
                         else: # The pairs are actually cointegrated
                             print("COINTEGRATED")     
                             signals["Z"] = self.z_score(signals["Ratios"])
                             signals["Z upper limit"] = signals["Z"].mean() + signals["Z"].std()*self.deviations
                             signals["Z lower limit"] = signals["Z"].mean() - signals["Z"].std()*self.deviations
-                            self.signal_update_logic(signals=signals, token1=liq_idx_1[-1][0], token2=liq_idx_2[-1][0], time1=liq_idx_1[-1][1], time2=liq_idx_2[-1][1])
+                            instrumentation.lap("zscore")
+                            self.signal_update_logic(signals=signals, token1=latest_1[0], token2=latest_2[0], time1=latest_1[1], time2=latest_2[1], slot=slot)
+                            instrumentation.lap("emit")
+            instrumentation.count("coint_tests", self.coint_service.tests_run - tests_run)
+            instrumentation.end_bar()
 
     """
         Compute the fortnights for bi-monthly rebalancing
@@ -195,27 +264,27 @@ class StatisticalArbitragePairs(Strategy):
     """
 
     def plot_coint_p_values(self, df, term_start="2020-02-29", term_end="2020-03-29"):
+        from DiagnosticsReport import render_coint_p_values
 
-        df = df.loc[lambda df: (df["Date"] > term_start) & (df["Date"] < term_end)]
+        df = df.loc[lambda df: (df["Date"] > term_start) & (df["Date"] < term_end)].select_dtypes(include="number")
         pvalues, pairs = self.find_cointegrated_pairs(df=df)
 
-        fig, ax = plt.subplots(figsize=(10, 7))
-        sns.heatmap(pvalues, xticklabels=df.columns, yticklabels=df.columns, \
-            cmap='RdYlGn_r', annot=True, fmt=".2f", mask=(pvalues >= 0.99))
-
-        ax.set_title('Rates Cointregration Matrix p-values Between Pairs')
-        plt.tight_layout()
         if not os.path.exists("./stat_arb_tests"):
             os.makedirs("./stat_arb_tests")
-        plt.savefig(f'stat_arb_tests/cointegrated_pairs_{term_start}_{term_end}.png', dpi=300)
-        plt.close()
+        render_coint_p_values(pvalues, df.columns, f'stat_arb_tests/cointegrated_pairs_{term_start}_{term_end}.png')
 
     """
     Pairwise conintegration tests on an APY DataFrame. This can also be called to continuously check
-    that the pairs remain cointegrated before making the stat arb trade 
+    that the pairs remain cointegrated before making the stat arb trade. With batched=True the
+    regressions are run as matrix operations and the ADF tests across a process pool
+    (see CointegrationScreen), which is much faster for large numbers of columns
     """
     @staticmethod
-    def find_cointegrated_pairs(df):
+    def find_cointegrated_pairs(df, batched=False, processes=None):
+
+        if batched:
+            return CointegrationScreen(processes=processes).run(df)
+        from statsmodels.tsa.stattools import coint
         
         n = df.shape[1]
         p_value_matrix = np.ones((n, n))
@@ -234,69 +303,67 @@ class StatisticalArbitragePairs(Strategy):
                     pairs.append((keys[i], keys[j]))
 
         return p_value_matrix, pairs
-    
+
+    """
+    Build the strategy on the pairs selected from an APY DataFrame (with columns such as
+    "{token} APY") by a PairSelector, which shortlists candidates by correlation (and
+    clustering) before testing them for cointegration. The selector keeps the numbers of
+    tests run and avoided.
+    """
+    @classmethod
+    def from_selected_pairs(cls, rates, events, df, selector=None, max_pairs=None, label=" APY", **kwargs):
+        from PairSelection import PairSelector
+
+        selector = PairSelector() if selector is None else selector
+        columns = [c for c in df.columns if str(c).endswith(label)]
+        selected = selector.select(df[columns], max_pairs=max_pairs)
+        pairs = [(c1[:len(c1)-len(label)], c2[:len(c2)-len(label)]) for c1, c2 in selected]
+        strategy = cls(rates, events, pairs, **kwargs)
+        strategy.pair_selector = selector
+        return strategy
+
     """
     Pairwise (Pearson) correlation matrix
     """
     @staticmethod
     def plot_correlation_matrix(df, term_start="2020-02-29", term_end="2020-03-29"):
+        from DiagnosticsReport import render_correlation_matrix
 
-        df = df.loc[lambda df: (df["Date"] > term_start) & (df["Date"] < term_end)]
-        fig, ax = plt.subplots(figsize=(10, 7))
-        sns.heatmap(df.corr(method="pearson"), ax=ax, cmap="coolwarm", annot=True, fmt=".2f")  
-
-        ax.set_title('Rates Correlation Matrix')
-        plt.tight_layout()
+        df = df.loc[lambda df: (df["Date"] > term_start) & (df["Date"] < term_end)].select_dtypes(include="number")
         if not os.path.exists("./stat_arb_tests"):
             os.makedirs("./stat_arb_tests")
-        plt.savefig(f"stat_arb_tests/correlation_{term_start}_{term_end}.png", dpi=300)
-        plt.close()
+        render_correlation_matrix(df, f"stat_arb_tests/correlation_{term_start}_{term_end}.png")
 
 
     def perform_stationarity_test(self, df, term_start="2020-02-29", term_end="2020-03-29", label=" APY"):
+        from DiagnosticsReport import render_pair
         
         df = df.loc[lambda df: (df["Date"] > term_start) & (df["Date"] < term_end)]
+        if not os.path.exists("./stat_arb_tests"):
+            os.makedirs("./stat_arb_tests")
         for pair in self.pairs:
             train = pd.DataFrame()
             train['token_1'] = df.loc[:, pair[0]+label]
             train['token_2'] = df.loc[:, pair[1]+label]
+            render_pair(pair, train, "stat_arb_tests", term_start, term_end)
+
+    """
+    Rolling version of perform_stationarity_test over the whole history: the hedge ratio,
+    spread and ADF statistic and p-value of every pair over a sliding window, at every bar
+    (see RollingDiagnostics), indexed by (token_1, token_2, Date)
+    """
+    def rolling_stationarity(self, df, window=90, adf_lags=1, label=" APY"):
+        from RollingDiagnostics import RollingDiagnostics
+
+        return RollingDiagnostics(window=window, adf_lags=adf_lags).run(df, self.pairs, label=label)
+
+    """
+    All of the above diagnostics for every pair in one go, rendered headless across a
+    process pool, returning the hedge ratio and ADF test results of every pair
+    """
+    def diagnostics_report(self, df, term_start="2020-02-29", term_end="2020-03-29", label=" APY", processes=None, 
+        output_dir="stat_arb_tests"):
+        from DiagnosticsReport import DiagnosticsReport
 
-            # Visualize rates
-            ax = train[["token_1", "token_2"]].plot(figsize=(12, 6), title = f"Rates for {pair[0]} and {pair[1]}")
-            ax.set_ylabel("Rate")
-            ax.grid(True)
-            if not os.path.exists("./stat_arb_tests"):
-                os.makedirs("./stat_arb_tests")
-            plt.savefig(f"stat_arb_tests/rates_{term_start}_{term_end}_{pair[0]}_{pair[1]}.png", dpi=300)
-            plt.close()
-
-            # Run OLS
-            model = sm.OLS(train["token_1"], train["token_2"]).fit()
-
-            # Regression summary results
-            plt.rc('figure', figsize=(12, 7))
-            plt.text(0.01, 0.05, str(model.summary()), {'fontsize': 16}, fontproperties='monospace')
-            plt.axis('off')
-            plt.tight_layout()
-            plt.subplots_adjust(left=0.2, right=0.8, top=0.7, bottom=0.1)
-            plt.savefig(f"stat_arb_tests/OLS_results_{term_start}_{term_end}_{pair[0]}_{pair[1]}.png", dpi=300)
-            plt.close()
-
-            print("Hedge Ratio = ", model.params[0])
-
-            # Calculate spread
-            spread = train['coin_1'] - model.params[0] * train['coin_2']
-
-            # Plot spread
-            ax = spread.plot(figsize=(12, 6), title="Rates Spread")
-            ax.set_ylabel("Spread")
-            ax.grid(True)
-            plt.savefig(f'stat_arb_tests/spread_{term_start}_{term_end}_{pair[0]}_{pair[1]}', dpi=300)
-            plt.close()
-
-            # Conduct Augmented Dickey-Fuller test
-            adf = adfuller(spread, maxlag=1)
-            print("Critical Value = ", adf[0])
-
-            # Critical values
-            print("ADF critical values: ", adf[4])
\ No newline at end of file
+        report = DiagnosticsReport(self.pairs, output_dir=output_dir, processes=processes, label=label)
+        return report.run(df, term_start=term_start, term_end=term_end)
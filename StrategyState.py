@@ -0,0 +1,85 @@
+import os
+import json
+import numpy as np
+
+# Positions as int8 codes, with NaN (a position the signal logic could not map) and None
+# (not invested) kept apart
+POSITION_CODES = {"EXIT": 0, "LONG": 1, "SHORT": -1}
+NAN_POSITION = 2
+NO_POSITION = 3
+POSITIONS = {code: position for position, code in POSITION_CODES.items()}
+
+
+def encode_position(position):
+    if position is None:
+        return NO_POSITION
+    if isinstance(position, float) and np.isnan(position):
+        return NAN_POSITION
+    return POSITION_CODES[position]
+
+
+def decode_position(code):
+    code = int(code)
+    if code == NAN_POSITION:
+        return np.nan
+    if code == NO_POSITION:
+        return None
+    return POSITIONS[code]
+
+
+def _key_to_json(key):
+    return list(key) if isinstance(key, tuple) else key
+
+
+def _key_from_json(key):
+    return tuple(key) if isinstance(key, list) else key
+
+
+class StateStore(object):
+    """
+    Compact, array-backed state of a strategy, with one row per pair or basket: each field is
+    a NumPy array whose first axis is the row (e.g. a position code per pair, or the hidden
+    state and covariance of a filter), so that the whole state is a handful of arrays.
+
+    save writes all of the fields, the row keys and any metadata to one .npz file (replaced
+    atomically, so a crash while saving leaves the previous snapshot), and load reads them
+    back, so a strategy can be restored without replaying its history.
+    """
+
+    def __init__(self, keys, fields, meta=None):
+        self.keys = list(keys)
+        self._rows = {key: i for i, key in enumerate(self.keys)}
+        self.arrays = {name: np.zeros((len(self.keys),) + tuple(shape), dtype=dtype) for name, (shape, dtype) in fields.items()}
+        self.meta = {} if meta is None else dict(meta)
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def __setitem__(self, name, values):
+        self.arrays[name][...] = values
+
+    def __contains__(self, name):
+        return name in self.arrays
+
+    def row(self, key):
+        return self._rows[key]
+
+    def save(self, path):
+        tmp = path + ".tmp"
+        header = json.dumps({"keys": [_key_to_json(key) for key in self.keys], "meta": self.meta})
+        with open(tmp, "wb") as f:
+            np.savez(f, __header__=np.array(header), **self.arrays)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            header = json.loads(str(data["__header__"]))
+            store = cls([_key_from_json(key) for key in header["keys"]], {}, meta=header["meta"])
+            store.arrays = {name: data[name] for name in data.files if name != "__header__"}
+        return store
+
+    def check_keys(self, keys, what="rows"):
+        """Raise a ValueError if the snapshot was not taken for the given rows"""
+        if list(keys) != self.keys:
+            raise ValueError(f"The saved state is for {what} {self.keys}, not {list(keys)}")
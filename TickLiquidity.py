@@ -0,0 +1,104 @@
+import numpy as np
+import pandas as pd
+
+
+def spread_ranges(groups, lower_ticks, upper_ticks, values, tick_spacing=60):
+    """
+    Sweep line over the tick ranges: each range adds its value(s) to every tick from its
+    lower tick to its upper tick in steps of tick_spacing, within its group.
+
+    Rather than listing every tick of every range, each range adds its value at its first
+    tick and removes it after its last, and a cumulative sum over the sorted breakpoints of
+    each group gives the liquidity of every segment between breakpoints. Only the segments
+    covered by at least one range are expanded into ticks, so the memory used is in the
+    number of distinct ticks, however wide or numerous the ranges are.
+
+    groups are integer group ids (e.g. per token and day), and values is a (ranges, columns)
+    array. Returns the group, tick and summed values of every covered tick, sorted by
+    group and tick. Rounding errors are relative to the largest value in the group, rather
+    than to the values at each tick as when summing per tick.
+    """
+    groups = np.asarray(groups, dtype=np.int64)
+    lower_ticks = np.asarray(lower_ticks, dtype=np.int64)
+    upper_ticks = np.asarray(upper_ticks, dtype=np.int64)
+    values = np.asarray(values, dtype=float).reshape(len(groups), -1)
+
+    # Ranges whose lower ticks are on different offsets from the tick grid never share ticks,
+    # so they are swept separately, as sub-groups
+    offsets = lower_ticks % tick_spacing
+    sub_groups, sub_index = np.unique(np.column_stack([groups, offsets]), axis=0, return_inverse=True)
+    sub_index = sub_index.ravel()
+    n_ticks = np.maximum((upper_ticks - lower_ticks)//tick_spacing + 1, 0)
+    starts = (lower_ticks - offsets)//tick_spacing
+    ends = starts + n_ticks
+
+    # Breakpoints: values and coverage in at the first tick, out after the last
+    keys = np.concatenate([sub_index, sub_index])
+    positions = np.concatenate([starts, ends])
+    deltas = np.concatenate([values, -values])
+    coverage = np.concatenate([np.ones(len(starts), dtype=np.int64), -np.ones(len(ends), dtype=np.int64)])
+
+    order = np.lexsort((positions, keys))
+    keys, positions, deltas, coverage = keys[order], positions[order], deltas[order], coverage[order]
+
+    # Merge the breakpoints at the same position
+    new_point = np.r_[True, (keys[1:] != keys[:-1]) | (positions[1:] != positions[:-1])]
+    first = np.flatnonzero(new_point)
+    keys, positions = keys[first], positions[first]
+    deltas = np.add.reduceat(deltas, first, axis=0)
+    coverage = np.add.reduceat(coverage, first)
+
+    # Running totals, restarted for each sub-group so that rounding errors of one token or
+    # day (whose liquidity may be orders of magnitude larger) do not carry over to the next
+    bounds = np.r_[np.flatnonzero(keys[1:] != keys[:-1]) + 1, len(keys)]
+    levels = np.empty_like(deltas)
+    for start, end in zip(np.r_[0, bounds[:-1]], bounds):
+        levels[start:end] = np.cumsum(deltas[start:end], axis=0)
+    covered = np.cumsum(coverage) # Coverage counts are integers and net to zero exactly
+    segment_length = np.r_[positions[1:] - positions[:-1], 0]
+    segment_length[np.r_[keys[1:] != keys[:-1], True]] = 0 # The last breakpoint of a group closes it
+    segment_length[covered <= 0] = 0
+
+    # Expand the covered segments into ticks
+    seg = np.flatnonzero(segment_length > 0)
+    lengths = segment_length[seg]
+    seg_of_tick = np.repeat(seg, lengths)
+    tick_in_seg = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    out_sub = keys[seg_of_tick]
+    ticks = (positions[seg_of_tick] + tick_in_seg)*tick_spacing + sub_groups[out_sub, 1]
+    out_groups = sub_groups[out_sub, 0]
+    out_values = levels[seg_of_tick]
+
+    order = np.lexsort((ticks, out_groups))
+    return out_groups[order], ticks[order], out_values[order]
+
+
+def tick_liquidity(range_day, tick_spacing=60):
+    """
+    Per day and token liquidity by tick, from the cumulative liquidity of each tick range
+    (columns Token, myDate, lowerTick, upperTick, liq_day, liq_total, as in the aggregated
+    step of example_sql_query.sql). As in the query, each range's liquidity is divided by
+    abs((upperTick - lowerTick)/tick_spacing) and added to every tick of the range, and the
+    result has the columns Token, myDate, tick, liq_day and liq_total.
+    """
+    columns = ["Token", "myDate", "tick", "liq_day", "liq_total"]
+    if len(range_day) == 0:
+        return pd.DataFrame(columns=columns)
+
+    group_keys = pd.MultiIndex.from_arrays([range_day["Token"], range_day["myDate"]])
+    groups, uniques = pd.factorize(group_keys)
+    lower = range_day["lowerTick"].values.astype(np.int64)
+    upper = range_day["upperTick"].values.astype(np.int64)
+    width = np.abs((upper - lower)/tick_spacing)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        per_tick = range_day[["liq_day", "liq_total"]].values.astype(float)/width[:, None]
+    per_tick[~np.isfinite(per_tick)] = 0.0 # Zero width ranges, NULL in SQL and so left out of the sums
+
+    out_groups, ticks, values = spread_ranges(groups, lower, upper, per_tick, tick_spacing)
+    return pd.DataFrame({
+        "Token": uniques.get_level_values(0)[out_groups],
+        "myDate": uniques.get_level_values(1)[out_groups],
+        "tick": ticks,
+        "liq_day": values[:, 0],
+        "liq_total": values[:, 1],
+    }, columns=columns)
@@ -0,0 +1,265 @@
+import os
+import glob
+import duckdb
+import pandas as pd
+from TickLiquidity import tick_liquidity
+
+# Voltz pools of example_sql_query.sql: token -> prefix of the exported event tables
+VOLTZ_POOLS = {
+    "rETH": "rocket_july1_183days_vamm",
+    "stETH": "lido_july1_183days_vamm",
+    "aETH_bORrow": "aave_ETH_bORrow_august22_131days_vamm",
+    "cUSDT_bORrow": "cUSDT_bORrow_august22_221days_vamm",
+    "aUSDC_bORrow": "aUSDC_bORrow_august22_221days_vamm",
+    "aETH_bORrow_v2": "aETH_bORrow_september30_182days_vamm",
+    "aDAI_v3": "aDAI_september30_92days_vamm",
+    "aETH": "aETH_september30_92days_vamm",
+    "aUSDC_v3": "aUSDC_2_september30_92days_vamm",
+    "cDAI_v3": "cDAI_2_september30_92days_vamm",
+}
+
+# Column names of the final result of the query
+RESULT_COLUMNS = {
+    "aDAI_v3": "percentage_traded_aDAI",
+    "aETH_bORrow": "percentage_traded_aETH_borrow",
+    "aETH": "percentage_traded_aETH",
+    "aETH_bORrow_v2": "percentage_traded_aETH_borrow_v2",
+    "aUSDC_v3": "percentage_traded_aUSDC",
+    "aUSDC_bORrow": "percentage_traded_aUSDC_borrow",
+    "cDAI_v3": "percentage_traded_cDAI",
+    "cUSDT_bORrow": "percentage_traded_cUSDT_borrow",
+    "rETH": "percentage_traded_rETH",
+    "stETH": "percentage_traded_stETH",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS range_day (
+    Token VARCHAR, lowerTick BIGINT, upperTick BIGINT, myDate DATE, liq_day DOUBLE, liq_total DOUBLE
+);
+CREATE TABLE IF NOT EXISTS tick_liquidity (
+    Token VARCHAR, myDate DATE, tick BIGINT, liq_day DOUBLE, liq_total DOUBLE
+);
+CREATE TABLE IF NOT EXISTS price_range (
+    Token VARCHAR, myDate DATE, minTick BIGINT, maxTick BIGINT
+);
+CREATE TABLE IF NOT EXISTS percentage_traded (
+    Token VARCHAR, myDate DATE, percentage_traded DOUBLE
+);
+CREATE TABLE IF NOT EXISTS event_watermark (
+    Token VARCHAR, event VARCHAR, last_day DATE, PRIMARY KEY (Token, event)
+);
+"""
+
+EVENTS = ("Mint", "Burn", "VAMMPriceChange")
+
+
+def _quote(value):
+    return "'" + str(value).replace("'", "''") + "'"
+
+
+def _earliest(days):
+    """Earliest of the watermarks, or None (everything) if any is None"""
+    return None if any(day is None for day in days) else min(days)
+
+
+def _since(start):
+    return "" if start is None else f"WHERE CAST(evt_block_time AS DATE) >= DATE {_quote(start)}"
+
+
+def _day_filter(start):
+    return "" if start is None else f"AND myDate >= DATE {_quote(start)}"
+
+
+class VoltzLiquidityPipeline(object):
+    """
+    Local, incremental version of example_sql_query.sql on an embedded DuckDB database.
+
+    The Mint, Burn and VAMMPriceChange events of each pool are read from exported files
+    named <events_dir>/<pool prefix>_evt_<Mint|Burn|VAMMPriceChange>*.<parquet|csv>, with
+    the same columns as the Dune tables (evt_block_time, amount, tickLower, tickUpper, tick).
+    Several files per event type (e.g. one per export) are read together.
+
+    Each stage of the query is materialised per pool and day: the cumulative liquidity of
+    each tick range on the days it changed (range_day), the per-tick liquidity (tick_liquidity,
+    by default with the TickLiquidity sweep line rather than exploding every range into ticks),
+    the daily min and max traded ticks (price_range) and the fraction of the liquidity
+    between them (percentage_traded). A watermark records the last day exported per pool and
+    event type, and update() only processes events from that day on (the last day is redone,
+    as it may have been exported part way through), continuing the cumulative sums from the
+    stored totals instead of rescanning the history. The event types may be exported up to
+    different days: range_day and tick_liquidity are redone from the earlier of the Mint and
+    Burn watermarks, price_range from the VAMMPriceChange one, and percentage_traded from
+    the earliest of them.
+    """
+
+    def __init__(self, events_dir, db_path=":memory:", pools=None, file_format="parquet", tick_spacing=60, sweep_line=True):
+        self.events_dir = events_dir
+        self.pools = VOLTZ_POOLS if pools is None else pools
+        self.file_format = file_format
+        self.tick_spacing = tick_spacing
+        self.sweep_line = sweep_line # Spread the ranges over their ticks with TickLiquidity, rather than in SQL
+        self.con = duckdb.connect(db_path)
+        self.con.execute(SCHEMA)
+
+        # Counters
+        self.days_processed = 0
+
+    def close(self):
+        self.con.close()
+
+    def _source(self, prefix, event):
+        pattern = os.path.join(self.events_dir, f"{prefix}_evt_{event}*.{self.file_format}")
+        if not glob.glob(pattern):
+            return None
+        reader = "read_parquet" if self.file_format == "parquet" else "read_csv_auto"
+        return f"{reader}({_quote(pattern)})"
+
+    def watermarks(self, token):
+        """Last day exported per event type of the pool"""
+        rows = self.con.execute("SELECT event, last_day FROM event_watermark WHERE Token = ?", [token]).fetchall()
+        return dict(rows)
+
+    def watermark(self, token):
+        """Earliest last day exported of the pool's event types (None before its first update)"""
+        marks = self.watermarks(token)
+        return min(marks.values()) if marks else None
+
+    def update(self):
+        """Process the new days of every pool, returning the number of pool days (re)computed"""
+        processed = 0
+        for token, prefix in self.pools.items():
+            processed += self._update_pool(token, prefix)
+        self.days_processed += processed
+        return processed
+
+    def _update_pool(self, token, prefix):
+        sources = {event: self._source(prefix, event) for event in EVENTS}
+        mint, burn, price_change = (sources[event] for event in EVENTS)
+        if all(source is None for source in sources.values()):
+            return 0
+        marks = self.watermarks(token)
+        # Each table is redone from the last day of the event type exported the least far
+        range_start = _earliest([marks.get(event) for event in ("Mint", "Burn") if sources[event] is not None])
+        price_start = marks.get("VAMMPriceChange")
+        traded_start = _earliest(([range_start] if mint or burn else []) + ([price_start] if price_change else []))
+        params = [token]
+
+        # Events of the new days, minted liquidity positive and burnt negative
+        selects = []
+        if mint is not None:
+            selects.append(f"SELECT amount, tickLower AS lowerTick, tickUpper AS upperTick, CAST(evt_block_time AS DATE) AS myDate FROM {mint} {_since(range_start)}")
+        if burn is not None:
+            selects.append(f"SELECT -amount, tickLower, tickUpper, CAST(evt_block_time AS DATE) FROM {burn} {_since(range_start)}")
+
+        con = self.con
+        con.execute("BEGIN TRANSACTION")
+        try:
+            con.execute(f"DELETE FROM percentage_traded WHERE Token = ? {_day_filter(traded_start)}", params)
+
+            if selects:
+                for table in ("range_day", "tick_liquidity"):
+                    con.execute(f"DELETE FROM {table} WHERE Token = ? {_day_filter(range_start)}", params)
+
+                # Cumulative liquidity of each tick range, continued from the totals before the new days
+                con.execute(f"""
+                    INSERT INTO range_day
+                    WITH mint_burn AS ({" UNION ALL ".join(selects)}),
+                    summ_date AS (
+                        SELECT lowerTick, upperTick, myDate, SUM(amount) AS amount
+                        FROM mint_burn GROUP BY myDate, lowerTick, upperTick
+                    ),
+                    prior AS (
+                        SELECT lowerTick, upperTick, arg_max(liq_total, myDate) AS liq_total
+                        FROM range_day WHERE Token = ? GROUP BY lowerTick, upperTick
+                    )
+                    SELECT ?, s.lowerTick, s.upperTick, s.myDate, s.amount,
+                        COALESCE(p.liq_total, 0) + SUM(s.amount) OVER (PARTITION BY s.lowerTick, s.upperTick ORDER BY s.myDate ASC)
+                    FROM summ_date s LEFT JOIN prior p ON s.lowerTick = p.lowerTick AND s.upperTick = p.upperTick
+                """, [token, token])
+
+                # Spread the liquidity of each range over its ticks, and sum per tick
+                if self.sweep_line:
+                    self._insert_tick_liquidity(token, _day_filter(range_start))
+                else:
+                    con.execute(f"""
+                        INSERT INTO tick_liquidity
+                        WITH spreaded_liq_ticks AS (
+                            SELECT myDate, UNNEST(generate_series(lowerTick, upperTick, {self.tick_spacing})) AS tick,
+                                liq_day/abs((upperTick - lowerTick)/{self.tick_spacing}) AS liq_day,
+                                liq_total/abs((upperTick - lowerTick)/{self.tick_spacing}) AS liq_total
+                            FROM range_day WHERE Token = ? {_day_filter(range_start)}
+                        )
+                        SELECT ?, myDate, tick, SUM(liq_day), SUM(liq_total)
+                        FROM spreaded_liq_ticks GROUP BY myDate, tick
+                    """, [token, token])
+
+            if price_change is not None:
+                con.execute(f"DELETE FROM price_range WHERE Token = ? {_day_filter(price_start)}", params)
+                con.execute(f"""
+                    INSERT INTO price_range
+                    SELECT ?, CAST(evt_block_time AS DATE) AS myDate, MIN(tick), MAX(tick)
+                    FROM {price_change} {_since(price_start)} GROUP BY myDate
+                """, params)
+
+            # Fraction of the liquidity between the day's min and max ticks, on days with any
+            con.execute(f"""
+                INSERT INTO percentage_traded
+                WITH priced AS (
+                    SELECT a.myDate, a.tick, COALESCE(a.liq_total, 0) AS liq_total, b.minTick, b.maxTick
+                    FROM tick_liquidity a JOIN price_range b ON a.Token = b.Token AND a.myDate = b.myDate
+                    WHERE a.Token = ? {_day_filter(traded_start).replace("myDate", "a.myDate")}
+                )
+                SELECT ?, myDate,
+                    SUM(liq_total) FILTER (WHERE tick >= minTick AND tick <= maxTick) / SUM(liq_total)
+                FROM priced GROUP BY myDate
+                HAVING COUNT(*) FILTER (WHERE tick >= minTick AND tick <= maxTick) > 0
+            """, [token, token])
+
+            n_days = con.execute(f"""
+                SELECT COUNT(*) FROM (SELECT myDate FROM range_day WHERE Token = ? {_day_filter(range_start) if selects else "AND FALSE"}
+                    UNION SELECT myDate FROM price_range WHERE Token = ? {_day_filter(price_start) if price_change else "AND FALSE"})
+            """, [token, token]).fetchone()[0]
+            for event, source in sources.items():
+                if source is None:
+                    continue
+                start = range_start if event in ("Mint", "Burn") else price_start
+                last_day = con.execute(f"SELECT MAX(CAST(evt_block_time AS DATE)) FROM {source} {_since(start)}").fetchone()[0]
+                if last_day is not None:
+                    con.execute("INSERT OR REPLACE INTO event_watermark VALUES (?, ?, ?)", [token, event, last_day])
+            con.execute("COMMIT")
+        except Exception:
+            con.execute("ROLLBACK")
+            raise
+        return n_days
+
+    def _insert_tick_liquidity(self, token, day_filter):
+        range_day = self.con.execute(f"""
+            SELECT Token, myDate, lowerTick, upperTick, liq_day, liq_total FROM range_day WHERE Token = ? {day_filter}
+        """, [token]).df()
+        if len(range_day) == 0:
+            return
+        self.con.register("new_tick_liquidity", tick_liquidity(range_day, self.tick_spacing))
+        try:
+            self.con.execute("INSERT INTO tick_liquidity SELECT * FROM new_tick_liquidity")
+        finally:
+            self.con.unregister("new_tick_liquidity")
+
+    def percentage_traded(self):
+        """
+        Daily fraction of the liquidity traded per pool, one column per pool (0 on days
+        where a pool has no value), as in the result of the query
+        """
+        df = self.con.execute("SELECT Token, myDate, percentage_traded FROM percentage_traded").df()
+        result = df.pivot_table(index="myDate", columns="Token", values="percentage_traded", aggfunc="sum", fill_value=0)
+        result = result.rename(columns=RESULT_COLUMNS)
+        result.columns.name = None
+        return result.sort_index()
+
+    def tick_liquidity(self, token, day=None):
+        """Per-tick liquidity of a pool, on one day or on all days"""
+        query = "SELECT myDate, tick, liq_day, liq_total FROM tick_liquidity WHERE Token = ?"
+        params = [token]
+        if day is not None:
+            query += " AND myDate = ?"
+            params.append(pd.Timestamp(day).date())
+        return self.con.execute(query + " ORDER BY myDate, tick", params).df()
@@ -0,0 +1,46 @@
+import io
+import queue
+import contextlib
+import numpy as np
+from event import MarketEvent
+from ApyCache import ApyCache
+from Benchmarks import SyntheticRates
+
+
+def signals(apy_cache, n_bars=160, warmup=20):
+    from StatisticalArbitragePairs import StatisticalArbitragePairs
+
+    rates = SyntheticRates(["A", "B", "C"], n_bars=n_bars, seed=1)
+    events = queue.Queue()
+    strategy = StatisticalArbitragePairs(rates, events, [("A", "B"), ("B", "C")], lookback_window=40, apy_lookback=3,
+        strategy_start=rates.timestamps[warmup], apy_cache=apy_cache)
+    stream = []
+    rates.advance(warmup)
+    with contextlib.redirect_stdout(io.StringIO()): # The pairs strategy prints on every cointegrated bar
+        for _ in range(warmup, n_bars):
+            rates.advance()
+            strategy.calculate_signals(MarketEvent())
+            while not events.empty():
+                signal = events.get()
+                stream.append((signal.token, signal.signal_type, signal.timestamp))
+    return stream, rates
+
+
+def test_cold_start_run_fills_the_cache(tmp_path):
+    expected, rates = signals(None)
+    cache = ApyCache(str(tmp_path))
+    assert signals(cache)[0] == expected
+    cache.flush()
+
+    panel = rates.panel()
+    timestamps_ns = panel.index.as_unit("ns").asi8
+    for token in ["A", "B", "C"]:
+        cached_ts, cached_liq = cache.history(token)
+        assert np.array_equal(cached_ts, timestamps_ns)
+        assert np.array_equal(cached_liq, panel[token].values)
+        rebuilt = ApyCache(str(tmp_path / "rebuilt")).apys(token, 3, timestamps_ns, panel[token].values)
+        assert np.array_equal(cache.apys(token, 3), rebuilt, equal_nan=True)
+
+    warm = ApyCache(str(tmp_path))
+    assert signals(warm)[0] == expected
+    assert warm.hits == 3 and warm.invalidations == 0
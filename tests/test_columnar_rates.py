@@ -0,0 +1,59 @@
+import io
+import queue
+import contextlib
+import numpy as np
+import pytest
+from event import MarketEvent
+from ColumnarRates import ColumnarRatesStore
+from Benchmarks import SyntheticRates
+
+
+class TupleRates(object):
+    """The rate tuples of a columnar store, for the strategies' tuple path"""
+
+    def __init__(self, store):
+        self.store = store
+        self.token_list = store.token_list
+
+    def get_latest_rates(self, token, N=1):
+        return self.store.get_latest_rates(token, N)
+
+
+def signals(columnar, n_bars=160, warmup=20, missing=0.1):
+    from StatisticalArbitragePairs import StatisticalArbitragePairs
+
+    source = SyntheticRates(["A", "B", "C"], n_bars=n_bars, seed=1).panel()
+    holes = np.random.default_rng(0).random(source.shape) < missing # Bars without a value, e.g. stale feeds
+    holes[:warmup] = False
+    source = source.mask(holes)
+    store = ColumnarRatesStore(["A", "B", "C"], capacity=64)
+    rates = store if columnar else TupleRates(store)
+    events = queue.Queue()
+    strategy = StatisticalArbitragePairs(rates, events, [("A", "B"), ("B", "C")], lookback_window=40, apy_lookback=3,
+        strategy_start=source.index[warmup])
+    stream = []
+    with contextlib.redirect_stdout(io.StringIO()): # The pairs strategy prints on every cointegrated bar
+        for t, (timestamp, row) in enumerate(source.iterrows()):
+            store.update_bar(timestamp, row.values)
+            if t < warmup:
+                continue
+            strategy.calculate_signals(MarketEvent())
+            while not events.empty():
+                signal = events.get()
+                stream.append((signal.token, signal.signal_type, signal.timestamp))
+    return stream
+
+
+@pytest.mark.parametrize("missing", [0.0, 0.1])
+def test_columnar_and_tuple_paths_agree_with_missing_bars(missing):
+    expected = signals(columnar=False, missing=missing)
+    assert expected
+    assert signals(columnar=True, missing=missing) == expected
+
+
+def test_latest_skips_bars_without_a_value():
+    store = ColumnarRatesStore(["A", "B"], capacity=4)
+    store.update_bar("2022-01-01", [1.0, 2.0])
+    store.update_bar("2022-01-02", [1.1, np.nan])
+    assert store.latest("B") == store.get_latest_rates("B", N=4)[-1]
+    assert store.latest("A") == store.get_latest_rates("A", N=4)[-1]
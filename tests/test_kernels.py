@@ -0,0 +1,83 @@
+import io
+import queue
+import contextlib
+import pytest
+import numpy as np
+from event import MarketEvent
+from Benchmarks import SyntheticRates
+from Kernels import (KernelSet, NUMPY_KERNELS, RTOL, ATOL, available_backends, get_kernels, numba_kernels,
+    _apys_at_loop, _kalman_step_loop, _spread_loop)
+
+# The kernels the numba backend compiles, run uncompiled
+LOOP_KERNELS = KernelSet("loops", _apys_at_loop, _kalman_step_loop, _spread_loop)
+BACKENDS = [LOOP_KERNELS] + (["numba"] if "numba" in available_backends() else [])
+
+
+def pairs(rates, events, kernels):
+    from StatisticalArbitragePairs import StatisticalArbitragePairs
+    return StatisticalArbitragePairs(rates, events, [("A", "B"), ("B", "C")], lookback_window=40, apy_lookback=3,
+        strategy_start=rates.timestamps[20], kernels=kernels)
+
+
+def multi(rates, events, kernels):
+    from StatArbMultiTrade import StatArbMultiTrade
+    return StatArbMultiTrade(events, rates, lookback_window=15, kernels=kernels)
+
+
+def kalman(rates, events, kernels):
+    from KalmanFilterStatArb import KalmanFilterStatArb
+    return KalmanFilterStatArb(events, rates, lookback_window=10, kernels=kernels)
+
+
+def event_stream(build, kernels, n_bars=160, warmup=20):
+    rates = SyntheticRates(["A", "B", "C"], n_bars=n_bars, seed=1)
+    events = queue.Queue()
+    strategy = build(rates, events, kernels)
+    stream = []
+    rates.advance(warmup)
+    with contextlib.redirect_stdout(io.StringIO()): # The pairs strategy prints on every cointegrated bar
+        for _ in range(warmup, n_bars):
+            rates.advance()
+            strategy.calculate_signals(MarketEvent())
+            while not events.empty():
+                signal = events.get()
+                stream.append((signal.token, signal.signal_type, signal.timestamp, getattr(signal, "quantity", 1)))
+    return stream
+
+
+@pytest.mark.parametrize("backend", BACKENDS, ids=str)
+@pytest.mark.parametrize("build", [pairs, multi, kalman])
+def test_backends_give_the_same_event_stream(build, backend):
+    expected = event_stream(build, "numpy")
+    assert expected
+    assert event_stream(build, backend) == expected
+
+
+@pytest.mark.parametrize("backend", BACKENDS, ids=str)
+def test_backends_agree_with_the_numpy_kernels(backend):
+    kernels = get_kernels(backend)
+    rng = np.random.default_rng(0)
+    timestamps_ns = np.cumsum(rng.integers(3600*10**9, 86400*10**9, 300))
+    liq_idx = np.cumprod(1 + rng.uniform(0, 1e-3, 300))
+    idx = np.arange(1, 300)
+    for lookback in (1, 5, 30):
+        assert np.allclose(kernels.apys_at(timestamps_ns, liq_idx, lookback, idx),
+            NUMPY_KERNELS.apys_at(timestamps_ns, liq_idx, lookback, idx), rtol=RTOL, atol=ATOL)
+    for n in (2, 3, 6):
+        for _ in range(50):
+            theta, C, F = rng.normal(size=n), np.abs(rng.normal(size=(n, n))), rng.normal(size=n)
+            for first in (True, False):
+                args = (theta, C, 1e-4*np.eye(n), 1e-3, F, 0.3, first)
+                for got, expected in zip(kernels.kalman_step(*args), NUMPY_KERNELS.kalman_step(*args)):
+                    assert np.allclose(got, expected, rtol=RTOL, atol=ATOL)
+            latest_rates, evecs = rng.normal(size=n), rng.normal(size=n)
+            assert kernels.spread(latest_rates, evecs) == NUMPY_KERNELS.spread(latest_rates, evecs)
+
+
+def test_numba_backend_compiles_the_loop_kernels():
+    if "numba" not in available_backends():
+        pytest.skip("numba is not installed")
+    kernels = numba_kernels()
+    assert kernels.apys_at.py_func is _apys_at_loop
+    assert kernels.kalman_step.py_func is _kalman_step_loop
+    assert kernels.spread.py_func is _spread_loop
@@ -0,0 +1,107 @@
+import io
+import queue
+import contextlib
+import pytest
+from event import SignalEvent, MarketEvent
+from SizedSignal import SizedSignalEvent
+from SignalNetting import NettingStage
+from Benchmarks import SyntheticRates
+
+
+def apply_to_ledger(ledger, signals):
+    """Positions after the signals: LONG/SHORT add or remove units, EXIT closes the token"""
+    for signal in signals:
+        if signal.signal_type == "EXIT":
+            ledger[signal.token] = 0
+        elif signal.signal_type in ("LONG", "SHORT"):
+            units = getattr(signal, "quantity", 1)
+            ledger[signal.token] = ledger.get(signal.token, 0) + (units if signal.signal_type == "LONG" else -units)
+    return ledger
+
+
+def net(signals, **kwargs):
+    events = queue.Queue()
+    stage = NettingStage(events, **kwargs)
+    stage.put_many(signals)
+    stage.flush()
+    return [events.get() for _ in range(events.qsize())]
+
+
+@pytest.mark.parametrize("types", [
+    ["SHORT", "EXIT", "LONG"],
+    ["LONG", "SHORT"],
+    ["LONG", "EXIT"],
+    ["EXIT", "EXIT", "SHORT", "SHORT"],
+    ["SHORT", "EXIT", "LONG", "EXIT", "SHORT"],
+])
+def test_net_position_matches_raw_stream(types):
+    raw = [SignalEvent("B", signal_type, "2022-01-01") for signal_type in types]
+    netted = net(raw)
+    assert apply_to_ledger({"B": 3}, netted) == apply_to_ledger({"B": 3}, raw)
+    assert sum(signal.signal_type == "EXIT" for signal in netted) <= 1
+
+
+def test_exit_then_reopen_is_forwarded_in_order():
+    raw = [SignalEvent("B", "SHORT", 1), SignalEvent("B", "EXIT", 1), SignalEvent("B", "LONG", 1)]
+    netted = net(raw)
+    assert [(s.token, s.signal_type) for s in netted] == [("B", "EXIT"), ("B", "LONG")]
+
+
+def test_sized_units_cancel():
+    raw = [SizedSignalEvent("A", "LONG", 1, 3), SizedSignalEvent("A", "SHORT", 1, 2)]
+    netted = net(raw)
+    assert len(netted) == 1 and netted[0].signal_type == "LONG" and netted[0].quantity == 1
+
+
+def test_strategies_net_position_matches_raw_stream():
+    from StatisticalArbitragePairs import StatisticalArbitragePairs
+    from StatArbMultiTrade import StatArbMultiTrade
+    from KalmanFilterStatArb import KalmanFilterStatArb
+
+    rates = SyntheticRates(["A", "B", "C"], n_bars=160, seed=1)
+    events = queue.Queue()
+    stage = NettingStage(events)
+    raw = []
+
+    class Tap(object):
+        def put(self, event):
+            raw.append(event)
+            stage.put(event)
+
+    tap = Tap()
+    strategies = [
+        StatisticalArbitragePairs(rates, tap, [("A", "B"), ("B", "C")], lookback_window=40, apy_lookback=1,
+            strategy_start=rates.timestamps[20], per_pair_positions=True),
+        StatArbMultiTrade(tap, rates, lookback_window=15),
+        KalmanFilterStatArb(tap, rates, lookback_window=10),
+    ]
+    raw_ledger, netted_ledger = {}, {}
+    rates.advance(20)
+    with contextlib.redirect_stdout(io.StringIO()): # The pairs strategy prints on every cointegrated bar
+        for t in range(20, 160):
+            rates.advance()
+            for strategy in strategies:
+                strategy.calculate_signals(MarketEvent())
+            apply_to_ledger(raw_ledger, raw)
+            raw.clear()
+            stage.flush()
+            apply_to_ledger(netted_ledger, [events.get() for _ in range(events.qsize())])
+            assert netted_ledger == raw_ledger, f"bar {t}"
+    assert stage.signals_out < stage.signals_in
+
+
+def test_unit_events_reach_the_handler_as_unit_events():
+    raw = [SignalEvent("A", "LONG", 1) for _ in range(3)] + [SignalEvent("A", "SHORT", 1)]
+    netted = net(raw)
+    assert [type(s) for s in netted] == [SignalEvent, SignalEvent]
+    assert all(not hasattr(s, "quantity") for s in netted)
+    assert apply_to_ledger({}, netted) == {"A": 2}
+
+
+def test_sized_signals_stay_sized_unless_overridden():
+    raw = [SizedSignalEvent("A", "LONG", 1, 3)]
+    assert [(type(s), s.quantity) for s in net(raw)] == [(SizedSignalEvent, 3)]
+    assert len(net(raw, unit_events=True)) == 3
+    mixed = raw + [SignalEvent("A", "LONG", 1)]
+    assert len(net(mixed)) == 4
+    assert len(net(mixed, unit_events=False)) == 1
@@ -0,0 +1,45 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+duckdb = pytest.importorskip("duckdb")
+from VoltzPipeline import VoltzLiquidityPipeline
+
+POOLS = {"rETH": "rocket_july1_183days_vamm"}
+
+
+def events(rng, n, days=30):
+    timestamps = pd.Timestamp("2022-07-01") + pd.to_timedelta(np.sort(rng.uniform(0, days*86400, n)), unit="s")
+    lower = rng.integers(-20, 10, n)*60
+    return pd.DataFrame({"evt_block_time": timestamps, "amount": rng.uniform(1, 100, n), "tickLower": lower,
+        "tickUpper": lower + rng.integers(1, 15, n)*60, "tick": rng.integers(-1200, 600, n)})
+
+
+def export(directory, name, df):
+    duckdb.execute(f"COPY (SELECT * FROM df) TO '{directory / name}.parquet' (FORMAT parquet)")
+
+
+@pytest.mark.parametrize("sweep_line", [True, False])
+def test_update_catches_up_an_event_type_exported_behind_the_others(tmp_path, sweep_line):
+    rng = np.random.default_rng(0)
+    data = {"Mint": events(rng, 300), "Burn": events(rng, 100), "VAMMPriceChange": events(rng, 500)}
+    prefix = POOLS["rETH"]
+    (tmp_path / "full").mkdir()
+    (tmp_path / "inc").mkdir()
+    for event, df in data.items():
+        export(tmp_path / "full", f"{prefix}_evt_{event}", df)
+    full = VoltzLiquidityPipeline(str(tmp_path / "full"), pools=POOLS, sweep_line=sweep_line)
+    full.update()
+
+    # The first export has the price changes up to the 15th, but the mints and burns only up to the 12th
+    cuts = {"Mint": "2022-07-12 13:00", "Burn": "2022-07-12 13:00", "VAMMPriceChange": "2022-07-15 13:00"}
+    for event, df in data.items():
+        export(tmp_path / "inc", f"{prefix}_evt_{event}_1", df[df.evt_block_time < cuts[event]])
+    incremental = VoltzLiquidityPipeline(str(tmp_path / "inc"), pools=POOLS, sweep_line=sweep_line)
+    incremental.update()
+    for event, df in data.items():
+        export(tmp_path / "inc", f"{prefix}_evt_{event}_2", df[df.evt_block_time >= cuts[event]])
+    incremental.update()
+
+    pd.testing.assert_frame_equal(incremental.percentage_traded(), full.percentage_traded())
+    pd.testing.assert_frame_equal(incremental.tick_liquidity("rETH"), full.tick_liquidity("rETH"))